@@ -1,3 +1,3 @@
-from .utils import flag_is_affected
+from .utils import flag_is_affected, flags_affected
 
-flag_is_affected  # shut up pyflakes
+flag_is_affected, flags_affected  # shut up pyflakes
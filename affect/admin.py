@@ -1,10 +1,139 @@
-from django.contrib import admin
+from datetime import datetime
 
-from .models import Criteria, Flag
+from django import forms
+from django.conf.urls import patterns, url
+from django.contrib import admin, messages
+from django.http import HttpResponse
+from django.shortcuts import render
 
+from .counters import (BRANCHES, CRITERIA_HITS_KEY, FLAG_HITS_KEY,
+                       REQUESTS_KEY, get_counter)
+from .models import Assignment, Criteria, Exposure, Flag
+from .profiling import get_profiler
+from .rules import RuleSet
+from .transfer import dumps, export_rules, import_rules, loads
 
-class CriteriaAdmin(admin.ModelAdmin):
+
+class HitRateAdmin(admin.ModelAdmin):
+    """Adds a ``hits/`` view showing counted hits and the share of requests
+    they make up, for the latest ``hit_buckets`` counter buckets."""
+    change_list_template = 'admin/affect/change_list.html'
+    hit_buckets = 2
+
+    def hit_keys(self, name):
+        """Return ``(label, counter key)`` pairs counted for ``name``, none
+        by default."""
+        return []
+
+    def get_urls(self):
+        opts = self.model._meta
+        return patterns(
+            '',
+            url(r'^hits/$', self.admin_site.admin_view(self.hits_view),
+                name='%s_%s_hits' % (
+                    opts.app_label, opts.object_name.lower())),
+        ) + super(HitRateAdmin, self).get_urls()
+
+    def hits_view(self, request):
+        counter = get_counter()
+        context = {'title': 'Hit rates', 'opts': self.model._meta,
+                   'enabled': counter is not None}
+        if counter is None:
+            return render(request, 'admin/affect/hits.html', context)
+
+        names = self.model.objects.order_by('name').values_list(
+            'name', flat=True)
+        keys = dict((name, self.hit_keys(name)) for name in names)
+        counts = counter.read(
+            [REQUESTS_KEY] + [key for name in names for _, key in keys[name]],
+            self.hit_buckets)
+        requests = counts[REQUESTS_KEY]
+
+        rows = []
+        for name in names:
+            totals = [sum(bucket) for bucket in zip(
+                *[counts[key] for _, key in keys[name]])]
+            totals = totals or [0] * len(requests)
+            rows.append({
+                'name': name,
+                'branches': ', '.join(
+                    '%s: %d' % (label, counts[key][0])
+                    for label, key in keys[name] if label and counts[key][0]),
+                'counts': [
+                    (total, 100.0 * total / total_requests
+                     if total_requests else 0)
+                    for total, total_requests in zip(totals, requests)]})
+        rows.sort(key=lambda row: -row['counts'][0][0])
+
+        context.update({
+            'rows': rows, 'requests': requests,
+            'bucket_size': counter.bucket_size,
+            'buckets': [datetime.fromtimestamp(start)
+                        for start in counter.buckets(self.hit_buckets)]})
+        return render(request, 'admin/affect/hits.html', context)
+
+
+class ImportForm(forms.Form):
+    file = forms.FileField(help_text='A JSON rule set, as exported.')
+    delete = forms.BooleanField(required=False, help_text=(
+        'Delete flags and criteria missing from the rule set.'))
+    dry_run = forms.BooleanField(required=False, initial=True, help_text=(
+        'Only show what would change.'))
+
+
+class RuleSetAdmin(HitRateAdmin):
+    """Adds an action exporting the selected rows as a JSON rule set, and an
+    ``import/`` view applying an uploaded rule set."""
+    actions = ['export_selected']
+    export_argument = None
+
+    def get_urls(self):
+        opts = self.model._meta
+        return patterns(
+            '',
+            url(r'^import/$', self.admin_site.admin_view(self.import_view),
+                name='%s_%s_import' % (
+                    opts.app_label, opts.object_name.lower())),
+        ) + super(RuleSetAdmin, self).get_urls()
+
+    def export_selected(self, request, queryset):
+        response = HttpResponse(
+            dumps(export_rules(**{self.export_argument: queryset})),
+            content_type='application/json')
+        response['Content-Disposition'] = (
+            'attachment; filename=affect-rules.json')
+        return response
+    export_selected.short_description = 'Export selected as a rule set'
+
+    def import_view(self, request):
+        if not request.user.has_perm('affect.change_criteria') or (
+                not request.user.has_perm('affect.change_flag')):
+            return HttpResponse(status=403)
+        context = {'title': 'Import rules', 'opts': self.model._meta}
+        if request.method == 'POST':
+            form = ImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                try:
+                    context['result'] = import_rules(
+                        loads(form.cleaned_data['file'].read()),
+                        delete=form.cleaned_data['delete'],
+                        dry_run=form.cleaned_data['dry_run'])
+                except ValueError as e:
+                    messages.error(request, 'Could not import: %s' % e)
+                else:
+                    context['dry_run'] = form.cleaned_data['dry_run']
+        else:
+            form = ImportForm()
+        context['form'] = form
+        return render(request, 'admin/affect/import.html', context)
+
+
+class CriteriaAdmin(RuleSetAdmin):
+    """Adds a ``profile/`` view of the requests profiled in this process,
+    and an ``analysis/`` view of the current rules."""
     model = Criteria
+    export_argument = 'criteria'
+    change_list_template = 'admin/affect/criteria_change_list.html'
     raw_id_fields = ('users', 'groups')
     readonly_fields = ('created', 'modified',)
     list_display = ('name', 'note', 'flag_names', 'persistent', 'everyone',
@@ -13,26 +142,91 @@ class CriteriaAdmin(admin.ModelAdmin):
     fieldsets = (
         (None, {
             'fields': ('name', 'flags', ('persistent', 'max_cookie_age'))}),
+        ('Schedule', {
+            'fields': (('start', 'end'),)}),
         ('Active For', {
             'fields': ('everyone', 'testing', 'percent', 'superusers',
-                       'staff', 'authenticated', 'users', 'groups')}),
+                       'staff', 'authenticated', 'users', 'groups',
+                       'expression')}),
         ('Browsing', {
             'classes': ('collapse',),
             'fields': ('entry_url', 'referrer', 'device_type',
-                       'query_args',)}),
+                       'query_args', 'ip_ranges', 'countries',
+                       'languages')}),
         ('Details', {
             'classes': ('collapse',),
             'fields': ('note', 'created', 'modified')}),
     )
 
+    def get_urls(self):
+        return patterns(
+            '',
+            url(r'^profile/$', self.admin_site.admin_view(self.profile_view),
+                name='affect_criteria_profile'),
+            url(r'^analysis/$',
+                self.admin_site.admin_view(self.analysis_view),
+                name='affect_criteria_analysis'),
+        ) + super(CriteriaAdmin, self).get_urls()
+
+    def profile_view(self, request):
+        profiler = get_profiler()
+        context = {'title': 'Profile', 'opts': self.model._meta,
+                   'enabled': profiler is not None}
+        if profiler is not None:
+            if request.method == 'POST':
+                profiler.clear()
+            context.update({
+                'requests': profiler.requests, 'report': profiler.report(),
+                'criteria': [
+                    (name, count, total * 1000, average * 1000)
+                    for name, count, total, average in
+                    profiler.criteria_report()]})
+        return render(request, 'admin/affect/profile.html', context)
+
+    def analysis_view(self, request):
+        rules = RuleSet.load()
+        analysis = rules.analysis
+        return render(request, 'admin/affect/analysis.html', {
+            'title': 'Analysis', 'opts': self.model._meta,
+            'criteria': len(rules.criteria),
+            'evaluated': len(analysis.evaluated),
+            'constant': len(analysis.constant),
+            'always': sorted(analysis.always),
+            'dead_flags': sorted(analysis.dead_flags.items()),
+            'dropped': analysis.dropped, 'redundant': analysis.redundant})
+
     def flag_names(self, criteria):
         return ', '.join([f.name for f in criteria.flags.all()])
     flag_names.short_description = 'Flags'
 
+    def hit_keys(self, name):
+        return [(branch, CRITERIA_HITS_KEY % (name, branch))
+                for branch in BRANCHES]
 
-class FlagAdmin(admin.ModelAdmin):
+
+class FlagAdmin(RuleSetAdmin):
     model = Flag
+    export_argument = 'flags'
     readonly_fields = ('created', 'modified',)
 
+    def hit_keys(self, name):
+        return [('', FLAG_HITS_KEY % name)]
+
+
+class AssignmentAdmin(admin.ModelAdmin):
+    model = Assignment
+    raw_id_fields = ('user',)
+    list_display = ('user', 'decisions', 'modified')
+    search_fields = ('user__username',)
+
+
+class ExposureAdmin(admin.ModelAdmin):
+    model = Exposure
+    list_display = ('flag', 'active', 'user_id', 'sample_rate', 'created')
+    list_filter = ('flag', 'active')
+    date_hierarchy = 'created'
+
+admin.site.register(Assignment, AssignmentAdmin)
 admin.site.register(Criteria, CriteriaAdmin)
+admin.site.register(Exposure, ExposureAdmin)
 admin.site.register(Flag, FlagAdmin)
@@ -0,0 +1,144 @@
+"""Find criteria and flags that cannot change the flags requests get.
+
+Run on every rule set as it is built, so evaluation skips what the analysis
+finds:
+
+* criteria with ``everyone`` set are decided up front, the flags of those
+  for everyone are added to every request without evaluating anything;
+* flags that conflict with a flag every request keeps always lose;
+* criteria without a flag that can be kept are not evaluated, unless the
+  expression of another criteria refers to them, in which case they are
+  still decided for every request so their decisions persist.
+
+It also notes patterns and fields of a criteria that can never decide it,
+such as a referrer host another of its hosts covers, or ``staff`` when
+``authenticated`` is set.
+"""
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+from .expressions import references
+from .matching import REGEX_PREFIX
+
+
+class Analysis(namedtuple('Analysis', (
+        'evaluated', 'constant', 'always', 'dead_flags', 'dropped',
+        'redundant'))):
+    """The result of :func:`analyze`.
+
+    ``evaluated`` are the criteria to decide for each request, ``constant``
+    maps criteria with ``everyone`` set to their ``(active, branch)``
+    decision, ``always`` are the flags of criteria for everyone,
+    ``dead_flags`` maps flags that always lose a conflict to the flag they
+    lose to, ``dropped`` lists ``(criteria name, reason)`` for criteria left
+    out and ``redundant`` lists ``(criteria name, note)`` for parts of
+    criteria that never decide them.
+    """
+    __slots__ = ()
+
+
+#: Fields that never decide a criteria when ``authenticated`` is set, since
+#: only authenticated users have them and ``authenticated`` is tried first.
+#: ``superusers`` is left out as it is set by default.
+AUTHENTICATED_SHADOWS = ('staff', 'users', 'groups')
+
+
+def _covers(pattern, host):
+    """Return whether the referrer ``pattern`` matches every host ``host``
+    matches."""
+    if pattern.startswith('*.'):
+        domain = pattern[2:]
+        if host.startswith('*.'):
+            host = host[2:]
+        return host == domain or host.endswith('.' + domain)
+    if pattern.endswith('.*'):
+        prefix = pattern[:-2]
+        if host.endswith('.*'):
+            host = host[:-2]
+        return host == prefix or host.startswith(prefix + '.')
+    return False
+
+
+def _redundant_hosts(hosts):
+    hosts = sorted(set(host.strip().lower() for host in hosts) - set(['']))
+    for host in hosts:
+        for other in hosts:
+            if other != host and _covers(other, host):
+                yield 'referrer %s is covered by %s' % (host, other)
+                break
+
+
+def _redundant_paths(paths):
+    paths = sorted(set(paths))
+    globs = [path for path in paths
+             if ('*' in path or '?' in path) and
+             not path.startswith(REGEX_PREFIX)]
+    for path in paths:
+        if path.startswith(REGEX_PREFIX):
+            continue
+        for other in globs:
+            if other != path and fnmatchcase(path, other):
+                yield 'entry_url %s is covered by %s' % (path, other)
+                break
+
+
+def _redundant(record):
+    notes = list(_redundant_hosts(record.referrers))
+    notes.extend(_redundant_paths(record.entry_urls))
+    if record.authenticated:
+        notes.extend(
+            '%s never decides it, authenticated is tried first' % field
+            for field in AUTHENTICATED_SHADOWS if getattr(record, field))
+    return notes
+
+
+def analyze(criteria, flags):
+    """Analyze a rule set's criteria records and ``flags``, a dictionary of
+    flag names to flag records, returning an :class:`Analysis`."""
+    referenced = set()
+    for record in criteria:
+        if record.expression is not None:
+            referenced.update(references(record.expression))
+
+    constant = {}
+    always = set()
+    possible = set()
+    for record in criteria:
+        if record.everyone is not None:
+            constant[record] = (bool(record.everyone), 'everyone')
+            if record.everyone:
+                always.update(record.flags)
+        if record.everyone is not False:
+            possible.update(record.flags)
+
+    # A flag for everyone is kept by every request when no flag it
+    # conflicts with can be active, and the flags conflicting with it
+    # then always lose.
+    kept = [name for name in sorted(always)
+            if name in flags and flags[name].conflicts.isdisjoint(possible)]
+    dead_flags = {}
+    for flag in flags.values():
+        for name in kept:
+            if name in flag.conflicts:
+                dead_flags[flag.name] = name
+                break
+
+    evaluated, dropped = [], []
+    for record in criteria:
+        if record in constant:
+            continue
+        if record.name not in referenced:
+            if not record.flags:
+                dropped.append((record.name, 'has no active flags'))
+                continue
+            if all(name in dead_flags for name in record.flags):
+                dropped.append((record.name, 'its flags always lose to %s' % (
+                    ', '.join(sorted(set(dead_flags[name]
+                                         for name in record.flags))))))
+                continue
+        evaluated.append(record)
+
+    redundant = [(record.name, note) for record in criteria
+                 for note in _redundant(record)]
+    return Analysis(tuple(evaluated), constant, frozenset(always),
+                    dead_flags, sorted(dropped), sorted(redundant))
@@ -0,0 +1,193 @@
+"""Keep the persistent criteria decisions of authenticated users on the
+server.
+
+Each user's percent, persistent and testing decisions are kept together,
+by the name of the cookie they would otherwise be kept in, and read with
+one store lookup per request.  A user's first decision for a criteria is
+written through at once, so other processes do not decide it again, and
+Affect cookies are still set when that write fails.  Other changes are
+buffered in memory for each process and written in batches by a background
+thread, once ``AFFECTED_ASSIGNMENT_BATCH_SIZE`` users changed or
+``AFFECTED_ASSIGNMENT_FLUSH_INTERVAL`` seconds have passed since the last
+write.  Storing is off unless ``AFFECTED_ASSIGNMENT_STORE`` names a store.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.db import IntegrityError, transaction
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+try:
+    from django.utils import timezone as datetime
+except ImportError:
+    from datetime import datetime
+
+from .buffering import Buffered
+from .configured import Configured
+from .models import Assignment
+
+logger = logging.getLogger(__name__)
+
+CACHE_ASSIGNMENT_KEY = 'affect_assignment:%s'
+
+
+class CacheStore(object):
+    """Keep each user's decisions in one cache key, for ``timeout``
+    seconds after they last changed."""
+
+    def __init__(self, timeout=None, cache=None):
+        self.cache = default_cache if cache is None else cache
+        self.timeout = timeout or getattr(
+            settings, 'AFFECTED_ASSIGNMENT_TIMEOUT', 2592000)
+
+    def load(self, user_id):
+        return self.cache.get(CACHE_ASSIGNMENT_KEY % user_id) or {}
+
+    def save(self, assignments):
+        self.cache.set_many(dict(
+            (CACHE_ASSIGNMENT_KEY % user_id, decisions)
+            for user_id, decisions in assignments.items()), self.timeout)
+
+
+class ModelStore(object):
+    """Keep each user's decisions in one :class:`affect.models.Assignment`
+    row."""
+
+    def load(self, user_id):
+        try:
+            return Assignment.objects.only('decisions').get(
+                user=user_id).decisions or {}
+        except Assignment.DoesNotExist:
+            return {}
+
+    def save(self, assignments):
+        now = datetime.now()
+        existing = set(Assignment.objects.filter(
+            user__in=assignments).values_list('user', flat=True))
+        for user_id, decisions in assignments.items():
+            if user_id in existing:
+                Assignment.objects.filter(user=user_id).update(
+                    decisions=decisions, modified=now)
+                continue
+            try:
+                sid = transaction.savepoint()
+                Assignment.objects.create(
+                    user_id=user_id, decisions=decisions, modified=now)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                Assignment.objects.filter(user=user_id).update(
+                    decisions=decisions, modified=now)
+
+
+class StickyAssignments(Buffered):
+    """Read decisions from ``store`` and buffer changes to write back,
+    in a background thread when ``background`` is set."""
+
+    def __init__(self, store, batch_size=100, flush_interval=10,
+                 clock=time.time, background=True):
+        super(StickyAssignments, self).__init__(
+            batch_size, flush_interval, clock, background)
+        self.store = store
+
+    def load(self, user_id):
+        """Return ``{cookie name: active}`` for ``user_id``, including
+        changes not written yet, or ``None`` when the store failed."""
+        with self.lock:
+            if user_id in self.pending:
+                return self.pending[user_id]
+        try:
+            return self.store.load(user_id)
+        except Exception:
+            logger.exception('Could not load assignments of user %s',
+                             user_id)
+            return None
+
+    def update(self, user_id, stored, persist=None, tests=None):
+        """Keep the decisions of criteria records in ``persist`` and
+        ``tests`` for ``user_id``, when they differ from ``stored``.
+
+        Decisions for cookies not in ``stored`` are written at once, others
+        are buffered.  Returns ``False`` when writing failed, so the
+        decisions are only kept in cookies, otherwise ``True``.
+        """
+        decisions = dict(stored)
+        for criteria, active in (persist or {}).items():
+            decisions[criteria.cookie] = active
+        for criteria, active in (tests or {}).items():
+            decisions[criteria.testing_cookie] = active
+        if decisions == stored:
+            return True
+        if not set(decisions) <= set(stored):
+            return self._write(user_id, decisions)
+        now = self.clock()
+        with self.lock:
+            self.pending[user_id] = decisions
+            due = self.due(now)
+        if due:
+            self.flush_soon()
+        return True
+
+    def _write(self, user_id, decisions):
+        try:
+            self.store.save({user_id: decisions})
+        except Exception:
+            logger.exception('Could not write assignments of user %s',
+                             user_id)
+            return False
+        with self.lock:
+            self.pending.pop(user_id, None)
+        return True
+
+    def empty(self):
+        return {}
+
+    def take(self):
+        # Changes stay pending, and are loaded from there, until written.
+        return dict(self.pending)
+
+    def write(self, assignments):
+        self.store.save(assignments)
+
+    def drop(self, assignments):
+        # Dropped decisions are made again, so say whose they were.
+        logger.exception('Dropped assignments of users %s', ', '.join(
+            str(user_id) for user_id in sorted(assignments)))
+
+    def written(self, assignments):
+        with self.lock:
+            for user_id, decisions in assignments.items():
+                if self.pending.get(user_id) is decisions:
+                    del self.pending[user_id]
+
+
+def get_assignments():
+    """Return the sticky assignments for this process, or ``None`` when no
+    store is configured."""
+    return _assignments.get()
+
+
+def _build_assignments():
+    path = getattr(settings, 'AFFECTED_ASSIGNMENT_STORE', None)
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    assignments = StickyAssignments(
+        getattr(import_module(module), name)(),
+        batch_size=getattr(settings, 'AFFECTED_ASSIGNMENT_BATCH_SIZE', 100),
+        flush_interval=getattr(
+            settings, 'AFFECTED_ASSIGNMENT_FLUSH_INTERVAL', 10))
+    return assignments
+
+_assignments = Configured(_build_assignments, 'AFFECTED_ASSIGNMENT',
+                          close=StickyAssignments.flush, at_exit=True)
+
+
+def reset_assignments(**kwargs):
+    """Flush and forget the assignments, so they are rebuilt from
+    settings."""
+    _assignments.reset(**kwargs)
+
+setting_changed.connect(reset_assignments, dispatch_uid='affect_assignments')
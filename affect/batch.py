@@ -0,0 +1,173 @@
+"""Assign flags to many users outside of the request/response cycle.
+
+    from affect.batch import evaluate_batch
+    from affect.rules import RequestContext
+
+    contexts = (RequestContext(user_id=pk) for pk in user_ids)
+    for context, flags in evaluate_batch(contexts, processes=4):
+        ...
+
+Contexts are consumed in chunks, users and group memberships for a chunk are
+resolved with two queries, and only a bounded number of chunks are held in
+memory at a time, so arbitrarily large iterables can be streamed through.
+"""
+from collections import defaultdict, deque
+from itertools import islice
+import csv
+import json
+import multiprocessing
+
+from django.contrib.auth.models import User
+
+from .rules import RequestContext, RuleSet
+
+DEFAULT_CHUNK_SIZE = 500
+RECORD_FORMATS = ('csv', 'jsonl')
+
+_worker_rules = None
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most ``size`` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _bool(value):
+    if isinstance(value, basestring):
+        if not value:
+            return None
+        return value.lower() in ('1', 'true', 'yes')
+    return value
+
+
+def _ids(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return frozenset(int(v) for v in value if v != '')
+
+
+def context_from_record(record):
+    """Build a :class:`RequestContext` from a decoded CSV/JSONL record.
+
+    Values may be strings, as read from CSV, ``groups`` is a list or comma
+    separated group ids and ``cookies`` a dictionary or a JSON object. An
+    ``id`` is kept as the context ``key``, so results can be matched back.
+    """
+    cookies = record.get('cookies') or {}
+    if isinstance(cookies, basestring):
+        cookies = json.loads(cookies)
+    return RequestContext(
+        user_id=_int(record.get('user_id')),
+        group_ids=_ids(record.get('groups', record.get('group_ids'))),
+        is_authenticated=_bool(record.get('is_authenticated')),
+        is_staff=_bool(record.get('is_staff')),
+        is_superuser=_bool(record.get('is_superuser')),
+        referrer=record.get('referrer'), host=record.get('host'),
+        path=record.get('path'), query=record.get('query'),
+        user_agent=record.get('user_agent'), accept=record.get('accept'),
+        accept_language=record.get('accept_language'), ip=record.get('ip'),
+        cookies=cookies, key=record.get('id'))
+
+
+def read_records(stream, format='jsonl'):
+    """Lazily decode dictionaries from a CSV (with a header row) or JSONL
+    stream, skipping blank lines."""
+    if format == 'csv':
+        for record in csv.DictReader(stream):
+            yield record
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def resolve_users(contexts):
+    """Fill in staff, superuser and group ids from the database for
+    contexts where only the ``user_id`` is known."""
+    ids = set(c.user_id for c in contexts if c.user_id is not None and (
+        c.group_ids is None or c.is_staff is None or c.is_superuser is None))
+    if not ids:
+        return contexts
+
+    users = dict((pk, (staff, superuser)) for pk, staff, superuser in (
+        User.objects.filter(pk__in=ids).values_list(
+            'pk', 'is_staff', 'is_superuser')))
+    groups = defaultdict(set)
+    for user_id, group_id in User.groups.through.objects.filter(
+            user__in=ids).values_list('user_id', 'group_id'):
+        groups[user_id].add(group_id)
+
+    for context in contexts:
+        if context.user_id not in ids:
+            continue
+        staff, superuser = users.get(context.user_id, (False, False))
+        if context.is_staff is None:
+            context.is_staff = staff
+        if context.is_superuser is None:
+            context.is_superuser = superuser
+        if context.group_ids is None:
+            context.group_ids = frozenset(groups[context.user_id])
+    return contexts
+
+
+def evaluate_chunk(rules, contexts):
+    """Return the active flags of each context in a resolved chunk."""
+    return [rules.evaluate(context) for context in contexts]
+
+
+def _init_worker(rules):
+    global _worker_rules
+    _worker_rules = rules
+
+
+def _evaluate_in_worker(contexts):
+    return evaluate_chunk(_worker_rules, contexts)
+
+
+def evaluate_batch(contexts, rules=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                   processes=None):
+    """Yield ``(context, flags)`` for every context, in input order.
+
+    ``rules`` defaults to a freshly loaded :class:`affect.rules.RuleSet`.
+    When ``processes`` is given, evaluation of resolved chunks is spread over
+    a process pool, while user lookups stay in the calling process.
+    """
+    if rules is None:
+        rules = RuleSet.load()
+    chunks = (resolve_users(chunk) for chunk in chunked(contexts, chunk_size))
+
+    if not processes:
+        for chunk in chunks:
+            for item in zip(chunk, evaluate_chunk(rules, chunk)):
+                yield item
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (rules,))
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(
+                (chunk, pool.apply_async(_evaluate_in_worker, (chunk,))))
+            if len(pending) > processes * 2:
+                chunk, result = pending.popleft()
+                for item in zip(chunk, result.get()):
+                    yield item
+        while pending:
+            chunk, result = pending.popleft()
+            for item in zip(chunk, result.get()):
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
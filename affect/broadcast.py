@@ -0,0 +1,187 @@
+"""Broadcast rule changes to every worker.
+
+When ``AFFECTED_BROADCAST`` names a channel, each process keeps its rule set
+in memory and swaps in a freshly loaded one when a change is published on
+the channel, instead of reading the cache on every request.  Changes are
+published by the signal handlers that uncache criteria and flags.
+
+Channels call their subscribers from a daemon thread, which is started the
+first time rules are needed, so with preforking servers each worker
+subscribes after it is forked.
+"""
+import logging
+import os
+import tempfile
+import threading
+import uuid
+
+from django.conf import settings
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+
+from .configured import Configured
+
+logger = logging.getLogger(__name__)
+
+
+class Channel(object):
+    """Base class of broadcast channels.
+
+    Subclasses implement ``publish``, which sends a new unique token, and
+    ``listen``, which calls :meth:`notify` with each token received until
+    :attr:`closed` is set.  When ``listen`` fails it is retried after
+    ``retry_delay`` seconds, and subscribers are notified without a token
+    since changes may have been missed.
+    """
+    retry_delay = 1
+
+    def __init__(self):
+        self.callbacks = []
+        self.closed = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """Call ``callback`` with the token from the listening thread on
+        every change, subscribing the same callback again does nothing."""
+        with self.lock:
+            if callback not in self.callbacks:
+                self.callbacks.append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name='affect-broadcast')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def notify(self, token=None):
+        for callback in list(self.callbacks):
+            try:
+                callback(token)
+            except Exception:
+                logger.exception('Rule change subscriber failed')
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('Listening for rule changes failed')
+                if not self.closed.wait(self.retry_delay):
+                    self.notify()
+
+    def publish(self):
+        raise NotImplementedError
+
+    def listen(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Stop listening, the thread exits after its current wait."""
+        self.closed.set()
+
+
+class FileChannel(Channel):
+    """Publish changes by replacing a file with a new token, which
+    listeners poll for every ``AFFECTED_BROADCAST_INTERVAL`` seconds.
+
+    Works for the processes of one host, or hosts sharing the file system,
+    without any server.
+    """
+
+    def __init__(self, path=None, interval=None):
+        super(FileChannel, self).__init__()
+        self.path = path or getattr(
+            settings, 'AFFECTED_BROADCAST_FILE',
+            os.path.join(tempfile.gettempdir(), 'affect-rules'))
+        self.interval = interval or getattr(
+            settings, 'AFFECTED_BROADCAST_INTERVAL', 1)
+
+    def version(self):
+        """Return the current token, or ``None`` before any publish."""
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def publish(self):
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.rename(path, self.path)
+
+    def listen(self):
+        version = self.version()
+        while not self.closed.wait(self.interval):
+            current = self.version()
+            if current != version:
+                version = current
+                self.notify(current)
+
+
+class RedisChannel(Channel):
+    """Publish changes on the Redis pub/sub channel
+    ``AFFECTED_BROADCAST_CHANNEL`` of the server at
+    ``AFFECTED_BROADCAST_URL``.  Requires the ``redis`` package unless a
+    client with ``publish`` and ``pubsub`` methods is given.
+    """
+
+    def __init__(self, url=None, channel=None, client=None):
+        super(RedisChannel, self).__init__()
+        if client is None:
+            import redis
+            client = redis.StrictRedis.from_url(url or getattr(
+                settings, 'AFFECTED_BROADCAST_URL',
+                'redis://localhost:6379/0'))
+        self.client = client
+        self.channel = channel or getattr(
+            settings, 'AFFECTED_BROADCAST_CHANNEL', 'affect:rules')
+
+    def publish(self):
+        self.client.publish(self.channel, uuid.uuid4().hex)
+
+    def listen(self):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(self.channel)
+        try:
+            for message in pubsub.listen():
+                if self.closed.is_set():
+                    break
+                if message['type'] == 'message':
+                    self.notify(message['data'])
+        finally:
+            pubsub.close()
+
+
+def get_channel():
+    """Return the broadcast channel for this process, or ``None`` when
+    broadcasting is not configured."""
+    return _channel.get()
+
+
+def _build_channel():
+    path = getattr(settings, 'AFFECTED_BROADCAST', None)
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)()
+
+_channel = Configured(_build_channel, 'AFFECTED_BROADCAST',
+                      close=lambda channel: channel.close())
+
+
+def reset_channel(**kwargs):
+    """Close and forget the channel, so it is rebuilt from settings."""
+    _channel.reset(**kwargs)
+
+setting_changed.connect(reset_channel, dispatch_uid='affect_broadcast')
+
+
+def publish():
+    """Tell every subscribed process that rules changed."""
+    channel = get_channel()
+    if channel is not None:
+        try:
+            channel.publish()
+        except Exception:
+            logger.exception('Could not broadcast rule change')
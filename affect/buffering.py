@@ -0,0 +1,90 @@
+"""Buffer changes in memory and write them in batches.
+
+Exposures, hit counts and sticky assignments are collected by each process
+and written together, so requests do not each wait for a write.
+:class:`Buffered` holds the pending changes under a lock and decides when
+they are due, and errors while writing are logged and the batch dropped,
+so requests never fail because of them.
+"""
+import logging
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class Buffered(object):
+    """Collect changes in ``pending`` and write them once ``batch_size`` are
+    pending, when set, or ``flush_interval`` seconds after the last write,
+    in a background thread when ``background`` is set.
+
+    Subclasses implement ``empty``, returning an empty ``pending``, and
+    ``write``, and set ``dropped`` to the message logged when writing
+    fails, or override :meth:`drop`.  They change ``pending`` holding
+    ``lock`` and then call :meth:`flush_soon` when :meth:`due` said so.
+    """
+    dropped = 'Dropped %d changes'
+
+    def __init__(self, batch_size=None, flush_interval=10, clock=time.time,
+                 background=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.background = background
+        self.pending = self.empty()
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.last_flush = clock()
+
+    def due(self, now):
+        """Return whether the pending changes should be written, with
+        ``lock`` held."""
+        return (self.batch_size is not None and
+                len(self.pending) >= self.batch_size) or (
+            now - self.last_flush >= self.flush_interval)
+
+    def flush_soon(self):
+        """Flush in a background thread, unless one is flushing already,
+        or right away without ``background``."""
+        if not self.background:
+            self.flush()
+        elif self.flushing.acquire(False):
+            thread = threading.Thread(target=self._flush_thread)
+            thread.daemon = True
+            thread.start()
+
+    def _flush_thread(self):
+        try:
+            self.flush()
+        finally:
+            # The thread's own database connections would otherwise leak.
+            for connection in connections.all():
+                connection.close()
+            self.flushing.release()
+
+    def take(self):
+        """Return the pending changes to write, with ``lock`` held."""
+        pending, self.pending = self.pending, self.empty()
+        return pending
+
+    def written(self, pending):
+        """Called once ``pending`` was written or dropped."""
+
+    def flush(self):
+        """Write the pending changes, dropping them on errors."""
+        with self.lock:
+            pending = self.take()
+            self.last_flush = self.clock()
+        if not pending:
+            return
+        try:
+            self.write(pending)
+        except Exception:
+            self.drop(pending)
+        self.written(pending)
+
+    def drop(self, pending):
+        """Log the error writing ``pending``, which is dropped."""
+        logger.exception(self.dropped, len(pending))
@@ -0,0 +1,50 @@
+"""Objects built once per process from settings.
+
+Recorders, counters, stores and channels are configured by settings that
+are read the first time they are needed, so a process without them pays
+nothing.  :class:`Configured` builds such an object under a lock the first
+time it is read and forgets it when one of its settings changes, so tests
+overriding settings get a fresh one.
+"""
+import atexit
+import threading
+
+_UNSET = object()
+
+
+class Configured(object):
+    """The object returned by ``build``, or ``None`` when it is not
+    configured, for settings starting with ``prefix``.
+
+    ``close`` is called with the object when it is forgotten, and at exit
+    when ``at_exit`` is set, to flush whatever it buffered.
+    """
+
+    def __init__(self, build, prefix, close=None, at_exit=False):
+        self.build = build
+        self.prefix = prefix
+        self.close = close
+        self.at_exit = at_exit
+        self.value = _UNSET
+        self.lock = threading.Lock()
+
+    def get(self):
+        value = self.value
+        if value is _UNSET:
+            with self.lock:
+                if self.value is _UNSET:
+                    self.value = self.build()
+                    if self.at_exit and self.value is not None:
+                        atexit.register(self.close, self.value)
+                value = self.value
+        return value
+
+    def reset(self, **kwargs):
+        """Forget the object when ``setting`` is one of its settings, or
+        when called without one."""
+        if not kwargs.get('setting', self.prefix).startswith(self.prefix):
+            return
+        with self.lock:
+            value, self.value = self.value, _UNSET
+        if value not in (_UNSET, None) and self.close is not None:
+            self.close(value)
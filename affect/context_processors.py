@@ -0,0 +1,5 @@
+def affected_flags(request):
+    """Expose the request's affected flags to templates as
+    ``affected_flags``, a frozenset for ``{% if 'name' in affected_flags %}``
+    checks."""
+    return {'affected_flags': getattr(request, 'affected_flags', frozenset())}
@@ -0,0 +1,189 @@
+"""Aggregated counts of requests, criteria matches and flag activations.
+
+Counts are kept in memory for each process, keyed by a time bucket of
+``AFFECTED_COUNTER_BUCKET`` seconds, and merged into a shared store at most
+every ``AFFECTED_COUNTER_FLUSH_INTERVAL`` seconds, so a worker costs a few
+cache writes a minute rather than one per request.  Counting is off unless
+``AFFECTED_COUNTER_STORE`` names a store.
+
+Keys are ``requests``, ``criteria:<name>:<branch>`` for a criteria matched
+by one of :data:`BRANCHES`, and ``flag:<name>`` for a flag active after
+conflicts were resolved.
+"""
+from collections import defaultdict
+import time
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+
+from .buffering import Buffered
+from .configured import Configured
+from .models import HitCount
+
+REQUESTS_KEY = 'requests'
+CRITERIA_HITS_KEY = 'criteria:%s:%s'
+FLAG_HITS_KEY = 'flag:%s'
+CACHE_HITS_KEY = 'affect_hits:%s:%s'
+BRANCHES = ('everyone', 'testing', 'persistent', 'authenticated', 'staff',
+            'superusers', 'referrer', 'entry_url', 'query_args',
+            'ip_ranges', 'countries', 'languages', 'device_type', 'users',
+            'groups', 'expression', 'percent')
+#: Keys read per query, below SQLite's limit of 999 query parameters.
+READ_CHUNK_SIZE = 500
+
+
+class CacheStore(object):
+    """Merge counts into the cache with ``incr``, or ``incr_many`` when the
+    backend provides it.  Buckets expire after a day by default.
+    """
+
+    def __init__(self, timeout=86400, cache=None):
+        self.cache = default_cache if cache is None else cache
+        self.timeout = timeout
+
+    def merge(self, counts):
+        counts = dict((CACHE_HITS_KEY % key, n) for key, n in counts.items())
+        incr_many = getattr(self.cache, 'incr_many', None)
+        if incr_many is not None:
+            incr_many(counts)
+            return
+        for key, n in counts.items():
+            try:
+                self.cache.incr(key, n)
+            except ValueError:
+                if not self.cache.add(key, n, self.timeout):
+                    self.cache.incr(key, n)
+
+    def read(self, keys):
+        values = self.cache.get_many([CACHE_HITS_KEY % key for key in keys])
+        return dict((key, values.get(CACHE_HITS_KEY % key, 0))
+                    for key in keys)
+
+
+class ModelStore(object):
+    """Merge counts into :class:`affect.models.HitCount` rollup rows."""
+
+    def merge(self, counts):
+        for (bucket, key), n in counts.items():
+            rows = HitCount.objects.filter(bucket=bucket, key=key)
+            if rows.update(count=F('count') + n):
+                continue
+            try:
+                sid = transaction.savepoint()
+                HitCount.objects.create(bucket=bucket, key=key, count=n)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                rows.update(count=F('count') + n)
+
+    def read(self, keys):
+        counts = dict.fromkeys(keys, 0)
+        buckets = sorted(set(bucket for bucket, _ in keys))
+        names = sorted(set(key for _, key in keys))
+        for start in range(0, len(names), READ_CHUNK_SIZE):
+            for bucket, key, count in HitCount.objects.filter(
+                    bucket__in=buckets,
+                    key__in=names[start:start + READ_CHUNK_SIZE]
+            ).values_list('bucket', 'key', 'count'):
+                if (bucket, key) in counts:
+                    counts[(bucket, key)] = count
+        return counts
+
+
+class HitCounter(Buffered):
+    """Count hits in memory and merge them into ``store`` periodically."""
+    dropped = 'Dropped %d hit counts'
+
+    def __init__(self, store, bucket_size=3600, flush_interval=60,
+                 clock=time.time):
+        super(HitCounter, self).__init__(
+            flush_interval=flush_interval, clock=clock)
+        self.store = store
+        self.bucket_size = bucket_size
+
+    def bucket(self, now=None):
+        """Start of the bucket holding ``now``, in seconds since epoch."""
+        if now is None:
+            now = self.clock()
+        return int(now // self.bucket_size * self.bucket_size)
+
+    def incr(self, *keys):
+        """Count one hit for each key."""
+        now = self.clock()
+        bucket = self.bucket(now)
+        with self.lock:
+            for key in keys:
+                self.pending[(bucket, key)] += 1
+            due = self.due(now)
+        if due:
+            self.flush_soon()
+
+    def empty(self):
+        return defaultdict(int)
+
+    def write(self, counts):
+        self.store.merge(counts)
+
+    def buckets(self, buckets=1):
+        """Starts of the latest ``buckets`` buckets, newest first."""
+        latest = self.bucket()
+        return [latest - i * self.bucket_size for i in range(buckets)]
+
+    def read(self, keys, buckets=1):
+        """Return ``{key: [count, ...]}`` for the latest ``buckets`` buckets,
+        newest first, as merged into the store."""
+        starts = self.buckets(buckets)
+        counts = self.store.read(
+            [(start, key) for start in starts for key in keys])
+        return dict((key, [counts[(start, key)] for start in starts])
+                    for key in keys)
+
+
+def get_counter():
+    """Return the hit counter for this process, or ``None`` when counting
+    is not configured."""
+    return _counter.get()
+
+
+def _build_counter():
+    path = getattr(settings, 'AFFECTED_COUNTER_STORE', None)
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    counter = HitCounter(
+        getattr(import_module(module), name)(),
+        bucket_size=getattr(settings, 'AFFECTED_COUNTER_BUCKET', 3600),
+        flush_interval=getattr(
+            settings, 'AFFECTED_COUNTER_FLUSH_INTERVAL', 60))
+    return counter
+
+_counter = Configured(_build_counter, 'AFFECTED_COUNTER',
+                      close=HitCounter.flush, at_exit=True)
+
+
+def reset_counter(**kwargs):
+    """Flush and forget the counter, so it is rebuilt from settings."""
+    _counter.reset(**kwargs)
+
+setting_changed.connect(reset_counter, dispatch_uid='affect_counters')
+
+
+def count_criteria(criteria, branch, active=True):
+    """Count ``criteria`` as matched by ``branch`` if it is active, returns
+    ``active`` so deciding branches can ``return count_criteria(...)``."""
+    if active:
+        counter = get_counter()
+        if counter is not None:
+            counter.incr(CRITERIA_HITS_KEY % (criteria, branch))
+    return active
+
+
+def count_request(flags):
+    """Count a request and the flags it was given."""
+    counter = get_counter()
+    if counter is not None:
+        counter.incr(REQUESTS_KEY, *[FLAG_HITS_KEY % name for name in flags])
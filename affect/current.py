@@ -0,0 +1,144 @@
+"""The flags of the request being handled, for code without the request.
+
+:class:`affect.middleware.AffectMiddleware` makes the flags it assigned the
+current :class:`FlagAssignment` of the thread handling the request, so
+helpers and background tasks can check them with :func:`is_affected`::
+
+    from affect.current import is_affected
+
+    @task
+    def send_newsletter(user_id):
+        if is_affected('new_layout'):
+            ...
+
+When Celery is installed, tasks sent while an assignment is current carry
+it in the ``affect_flags`` message header, and it is current again while
+the task runs, so workers check flags without evaluating any rules or
+reading the cache or database.  Other queues can send
+:meth:`FlagAssignment.dumps` along and restore it with :func:`activated`.
+"""
+from contextlib import contextmanager
+import threading
+
+try:
+    from celery import signals as celery_signals
+except ImportError:
+    celery_signals = None
+
+HEADER = 'affect_flags'
+
+
+class FlagAssignment(object):
+    """The names of the flags given to a request, and the ``version`` of
+    the rule set that decided them, its build time."""
+    __slots__ = ('flags', 'version')
+
+    def __init__(self, flags, version=None):
+        self.flags = frozenset(flags)
+        self.version = version
+
+    def __eq__(self, other):
+        return (type(other) is type(self) and other.flags == self.flags and
+                other.version == self.version)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<FlagAssignment %s>' % ','.join(sorted(self.flags))
+
+    def dumps(self):
+        """Serialize as ``<version>:<flag>,<flag>...``, flag names being
+        slugs."""
+        return '%s:%s' % (
+            '' if self.version is None else repr(self.version),
+            ','.join(sorted(self.flags)))
+
+    @classmethod
+    def loads(cls, data):
+        """Parse :meth:`dumps` output, raising ``ValueError`` when it is
+        malformed."""
+        version, sep, flags = data.partition(':')
+        if not sep:
+            raise ValueError('Not a flag assignment: %r' % data)
+        return cls(filter(None, flags.split(',')),
+                   float(version) if version else None)
+
+
+_local = threading.local()
+
+
+def get_current():
+    """Return the thread's current :class:`FlagAssignment`, or ``None``."""
+    return getattr(_local, 'assignment', None)
+
+
+def set_current(assignment):
+    """Make ``assignment`` current for the thread, returning the one it
+    replaces."""
+    previous = get_current()
+    _local.assignment = assignment
+    return previous
+
+
+@contextmanager
+def activated(assignment):
+    """Make ``assignment`` current for the block."""
+    previous = set_current(assignment)
+    try:
+        yield assignment
+    finally:
+        set_current(previous)
+
+
+def is_affected(flag_name):
+    """Return whether ``flag_name`` is among the current flags, ``False``
+    when there is no current assignment."""
+    assignment = get_current()
+    return assignment is not None and flag_name in assignment.flags
+
+
+def _header(request):
+    """Read the header from a Celery task request, where message headers
+    are attributes with protocol 2 and in ``headers`` before."""
+    value = getattr(request, HEADER, None)
+    if value is None:
+        value = (getattr(request, 'headers', None) or {}).get(HEADER)
+    return value
+
+
+def add_header(headers=None, **kwargs):
+    """``before_task_publish`` handler adding the current assignment to the
+    headers of a task message."""
+    assignment = get_current()
+    if assignment is not None and headers is not None:
+        headers[HEADER] = assignment.dumps()
+
+
+def restore(task=None, **kwargs):
+    """``task_prerun`` handler making the assignment a task was sent with
+    current while it runs."""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(get_current())
+    data = _header(task.request) if task is not None else None
+    if data:
+        try:
+            set_current(FlagAssignment.loads(data))
+        except ValueError:
+            set_current(None)
+
+
+def release(**kwargs):
+    """``task_postrun`` handler restoring the assignment current before
+    the task ran."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        set_current(stack.pop())
+
+if celery_signals is not None:
+    celery_signals.before_task_publish.connect(
+        add_header, dispatch_uid='affect_add_header')
+    celery_signals.task_prerun.connect(restore, dispatch_uid='affect_restore')
+    celery_signals.task_postrun.connect(
+        release, dispatch_uid='affect_release')
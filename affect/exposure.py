@@ -0,0 +1,163 @@
+"""Record which flags requests were exposed to.
+
+Only flags looked up with :func:`affect.flag_is_affected` while handling a
+request are recorded, once per request.  Exposures are buffered in memory for
+each process and handed to a sink in batches, once
+``AFFECTED_EXPOSURE_BATCH_SIZE`` are buffered or
+``AFFECTED_EXPOSURE_FLUSH_INTERVAL`` seconds have passed since the last
+flush.  Recording is off unless ``AFFECTED_EXPOSURE_SINK`` names a sink.
+"""
+from Queue import Queue
+from collections import namedtuple
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+try:
+    from django.utils import timezone as datetime
+except ImportError:
+    from datetime import datetime
+
+from .buffering import Buffered
+from .configured import Configured
+from .models import Exposure
+
+ExposureEvent = namedtuple(
+    'ExposureEvent', ('flag', 'active', 'user_id', 'sample_rate', 'created'))
+
+exposure_queue = Queue()
+
+
+class ModelSink(object):
+    """Insert exposures into :class:`affect.models.Exposure` in bulk."""
+
+    def __call__(self, events):
+        Exposure.objects.bulk_create(
+            [Exposure(**event._asdict()) for event in events])
+
+
+class LoggingSink(object):
+    """Log one line per exposure, route the logger to a file to keep them."""
+
+    def __init__(self, name='affect.exposure'):
+        self.logger = logging.getLogger(name)
+
+    def __call__(self, events):
+        for event in events:
+            self.logger.info(
+                '%s %s %s %s %s', event.created.isoformat(), event.flag,
+                int(event.active), event.user_id or '-', event.sample_rate)
+
+
+class QueueSink(object):
+    """Put each batch on a local queue, a stand-in for a message broker."""
+
+    def __init__(self, queue=None):
+        self.queue = exposure_queue if queue is None else queue
+
+    def __call__(self, events):
+        self.queue.put(list(events))
+
+
+class ExposureRecorder(Buffered):
+    """Buffer exposures and flush them to ``sink`` in batches.
+
+    ``sample_rate`` is the fraction of exposures kept.  When
+    ``max_per_second`` is set and the previous second saw more exposures
+    than that, the rate is lowered in proportion, every recorded exposure
+    keeps the rate it was sampled at so counts can be weighted back up.
+    """
+    dropped = 'Dropped %d flag exposures'
+
+    def __init__(self, sink, batch_size=100, flush_interval=10,
+                 sample_rate=1.0, max_per_second=None, clock=time.time):
+        super(ExposureRecorder, self).__init__(
+            batch_size, flush_interval, clock)
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.second = int(self.last_flush)
+        self.seen = 0
+        self.load_rate = 1.0
+
+    def rate(self, now):
+        """Count an exposure and return the rate it should be sampled at."""
+        second = int(now)
+        if second != self.second:
+            if self.max_per_second and second == self.second + 1 and (
+                    self.seen > self.max_per_second):
+                self.load_rate = float(self.max_per_second) / self.seen
+            else:
+                self.load_rate = 1.0
+            self.second, self.seen = second, 0
+        self.seen += 1
+        return self.sample_rate * self.load_rate
+
+    def record(self, checked, affected, user_id=None):
+        """Buffer an exposure for each flag name in ``checked``."""
+        now = self.clock()
+        created = datetime.now()
+        with self.lock:
+            for flag in checked:
+                rate = self.rate(now)
+                if rate < 1 and random.random() >= rate:
+                    continue
+                self.pending.append(ExposureEvent(
+                    flag, flag in affected, user_id, rate, created))
+            due = self.due(now)
+        if due:
+            self.flush_soon()
+
+    def empty(self):
+        return []
+
+    def write(self, events):
+        self.sink(events)
+
+
+def get_recorder():
+    """Return the recorder for this process, or ``None`` when exposure
+    recording is not configured."""
+    return _recorder.get()
+
+
+def _build_recorder():
+    path = getattr(settings, 'AFFECTED_EXPOSURE_SINK', None)
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    recorder = ExposureRecorder(
+        getattr(import_module(module), name)(),
+        batch_size=getattr(settings, 'AFFECTED_EXPOSURE_BATCH_SIZE', 100),
+        flush_interval=getattr(
+            settings, 'AFFECTED_EXPOSURE_FLUSH_INTERVAL', 10),
+        sample_rate=getattr(settings, 'AFFECTED_EXPOSURE_SAMPLE_RATE', 1.0),
+        max_per_second=getattr(
+            settings, 'AFFECTED_EXPOSURE_MAX_PER_SECOND', None))
+    return recorder
+
+_recorder = Configured(_build_recorder, 'AFFECTED_EXPOSURE',
+                       close=ExposureRecorder.flush, at_exit=True)
+
+
+def reset_recorder(**kwargs):
+    """Flush and forget the recorder, so it is rebuilt from settings."""
+    _recorder.reset(**kwargs)
+
+setting_changed.connect(reset_recorder, dispatch_uid='affect_exposure')
+
+
+def record_request(request):
+    """Record the flags checked while handling ``request``."""
+    checked = getattr(request, 'affected_checked', None)
+    recorder = get_recorder()
+    if not checked or recorder is None:
+        return
+    user = getattr(request, 'user', None)
+    user_id = None
+    if user is not None and user.is_authenticated():
+        user_id = user.pk
+    recorder.record(checked, getattr(request, 'affected_flags', ()), user_id)
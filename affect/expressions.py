@@ -0,0 +1,221 @@
+"""Boolean expressions over request predicates and other criteria.
+
+    mobile and referrer:*.google.com and not staff
+    (criteria:spring_sale or query:utm_campaign=spring-*) and not user:42
+
+Expressions combine predicates with ``and``, ``or``, ``not`` and
+parentheses.  The predicates are ``authenticated``, ``staff``,
+``superuser``, ``mobile``, ``desktop`` and ``simple`` devices, and
+``referrer:<host>``, ``entry_url:<path>``, ``query:<key>=<value>`` and
+``language:<tag>`` with the patterns of the criteria fields of the same
+names, ``user:<id>``, ``group:<id>`` and ``criteria:<name>`` for whether
+another criteria is active.  Values cannot contain spaces or parentheses.
+
+The expressions of a rule set are compiled into one graph of
+:class:`Node`, where equal sub-expressions of any criteria are the same
+node, so each is evaluated at most once per request.  The operands of
+``and`` and ``or`` are ordered by an estimated cost, cheapest first, to
+make the most of short circuiting.
+"""
+import re
+
+TOKEN = re.compile(r'\s*(\(|\)|[^\s()]+)')
+OPERATORS = ('and', 'or', 'not')
+FLAGS = ('authenticated', 'staff', 'superuser')
+DEVICES = ('mobile', 'desktop', 'simple')
+VALUES = ('referrer', 'entry_url', 'query', 'language', 'user', 'group',
+          'criteria')
+INTEGERS = ('user', 'group')
+
+#: Estimated cost of evaluating each kind of predicate.
+COSTS = dict([(kind, 1) for kind in FLAGS + VALUES] +
+             [(kind, 5) for kind in DEVICES] + [('criteria', 20)])
+
+#: An expression that is never true.
+NEVER = ('or',)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def parse(text):
+    """Parse ``text`` into a tree of tuples, ``(operator, operand, ...)``
+    for operators and ``(kind, value)`` for predicates.  ``and`` and
+    ``or`` operands are flattened and sorted, so equal expressions have
+    equal trees.  Raises :class:`ExpressionError` when invalid."""
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        tokens.append(match.group(1))
+        position = match.end()
+    tokens.reverse()
+    tree = _or(tokens)
+    if tokens:
+        raise ExpressionError('Unexpected %r' % tokens[-1])
+    return tree
+
+
+def _combine(operator, operands):
+    if len(operands) == 1:
+        return operands[0]
+    flat = set()
+    for operand in operands:
+        if operand[0] == operator:
+            flat.update(operand[1:])
+        else:
+            flat.add(operand)
+    return (operator,) + tuple(sorted(flat))
+
+
+def _or(tokens):
+    operands = [_and(tokens)]
+    while tokens and tokens[-1].lower() == 'or':
+        tokens.pop()
+        operands.append(_and(tokens))
+    return _combine('or', operands)
+
+
+def _and(tokens):
+    operands = [_not(tokens)]
+    while tokens and tokens[-1].lower() == 'and':
+        tokens.pop()
+        operands.append(_not(tokens))
+    return _combine('and', operands)
+
+
+def _not(tokens):
+    if tokens and tokens[-1].lower() == 'not':
+        tokens.pop()
+        operand = _not(tokens)
+        if operand[0] == 'not':
+            return operand[1]
+        return ('not', operand)
+    return _atom(tokens)
+
+
+def _atom(tokens):
+    if not tokens:
+        raise ExpressionError('Unexpected end of expression')
+    token = tokens.pop()
+    if token == '(':
+        tree = _or(tokens)
+        if not tokens or tokens.pop() != ')':
+            raise ExpressionError('Missing )')
+        return tree
+    if token == ')' or token.lower() in OPERATORS:
+        raise ExpressionError('Unexpected %r' % token)
+    kind, _, value = token.partition(':')
+    kind = kind.lower()
+    if kind in FLAGS + DEVICES and not value:
+        return (kind, None)
+    if kind not in VALUES:
+        raise ExpressionError('Unknown predicate %r' % token)
+    if not value:
+        raise ExpressionError('Missing value for %r' % token)
+    if kind in INTEGERS:
+        try:
+            value = int(value)
+        except ValueError:
+            raise ExpressionError('%r is not a number' % token)
+    elif kind == 'query':
+        key, _, expected = value.partition('=')
+        value = (key, expected or '*')
+    elif kind in ('referrer', 'language'):
+        value = value.lower()
+    return (kind, value)
+
+
+def references(tree):
+    """Return the set of criteria names ``tree`` refers to."""
+    if tree[0] == 'criteria':
+        return set([tree[1]])
+    if tree[0] in OPERATORS:
+        return set().union(*[references(operand) for operand in tree[1:]])
+    return set()
+
+
+def without_references(tree, names):
+    """Return ``tree`` with its references to criteria not in ``names``
+    replaced by :data:`NEVER`, keeping the rest of the expression."""
+    if tree[0] == 'criteria':
+        return tree if tree[1] in names else NEVER
+    if tree[0] in OPERATORS:
+        return (tree[0],) + tuple(
+            without_references(operand, names) for operand in tree[1:])
+    return tree
+
+
+def find_cycle(graph, start):
+    """Return a list of names leading from ``start`` back to itself through
+    ``graph``, a dictionary of names to the names they refer to, or
+    ``None`` when there is no such path."""
+    path = [start]
+    seen = set()
+
+    def visit(name):
+        for reference in sorted(graph.get(name, ())):
+            if reference == start:
+                return path + [start]
+            if reference in seen:
+                continue
+            seen.add(reference)
+            path.append(reference)
+            cycle = visit(reference)
+            if cycle:
+                return cycle
+            path.pop()
+
+    return visit(start)
+
+
+class Node(object):
+    """A compiled expression, ``children`` are the operands of operators
+    and ``value`` the value of predicates.  Nodes hash by identity, equal
+    expressions compiled by one :class:`Compiler` are the same node."""
+    __slots__ = ('kind', 'value', 'children', 'cost')
+
+    def __init__(self, kind, value=None, children=(), cost=0):
+        self.kind = kind
+        self.value = value
+        self.children = children
+        self.cost = cost
+
+    def __getstate__(self):
+        return (self.kind, self.value, self.children, self.cost)
+
+    def __setstate__(self, state):
+        self.kind, self.value, self.children, self.cost = state
+
+    def __repr__(self):
+        return '<Node %s %r>' % (self.kind, self.value or self.children)
+
+
+class Compiler(object):
+    """Compile parsed expressions into shared :class:`Node` graphs.
+
+    ``leaves`` maps each predicate kind to the nodes compiled for it, so
+    they can be added to the indexes of a rule set.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.leaves = dict((kind, []) for kind in COSTS)
+
+    def compile(self, tree):
+        node = self.nodes.get(tree)
+        if node is None:
+            kind = tree[0]
+            if kind in OPERATORS:
+                children = sorted(
+                    (self.compile(operand) for operand in tree[1:]),
+                    key=lambda child: child.cost)
+                node = Node(kind, children=tuple(children),
+                            cost=sum(child.cost for child in children))
+            else:
+                node = Node(kind, tree[1], cost=COSTS[kind])
+                self.leaves[kind].append(node)
+            self.nodes[tree] = node
+        return node
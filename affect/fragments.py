@@ -0,0 +1,60 @@
+"""Cache template fragments once for each combination of relevant flags.
+
+Fragments that depend on a few flags are cached under a key made of the
+fragment name, the relevant flags that are active and any other values the
+fragment varies on, so each fragment is rendered once per combination of
+those flags rather than once per user.  Flags are read from the
+``request`` in the template context, and recorded as checked like
+:func:`affect.flags_affected`, or else from ``affected_flags``.
+"""
+import hashlib
+
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+from .utils import flags_affected
+
+FRAGMENT_KEY = 'affect_fragment:%s:%s'
+
+
+def flag_names(values):
+    """Flatten flag name arguments, which are names or lists of names."""
+    names = []
+    for value in values:
+        if isinstance(value, basestring):
+            names.append(value)
+        else:
+            names.extend(value or ())
+    return names
+
+
+def active_flags(context, names):
+    """Return which of ``names`` are active, from a template context."""
+    request = context.get('request')
+    if request is not None and hasattr(request, 'affected_flags'):
+        return sorted(name for name, active in flags_affected(
+            request, *names).items() if active)
+    flags = context.get('affected_flags') or ()
+    return sorted(name for name in set(names) if name in flags)
+
+
+def fragment_key(name, active, vary_on=()):
+    """Cache key of fragment ``name`` for the ``active`` flags."""
+    digest = hashlib.md5('\0'.join(
+        [smart_str(flag) for flag in sorted(active)] + ['\1'] +
+        [smart_str(value) for value in vary_on]))
+    return FRAGMENT_KEY % (name, digest.hexdigest())
+
+
+def cached_fragment(name, timeout, active, vary_on, render):
+    """Return the cached fragment, calling ``render`` to render and cache
+    it for ``timeout`` seconds when missing.  A ``timeout`` of ``None`` is
+    the cache's default timeout, which Django 1.6 would take as forever."""
+    key = fragment_key(name, active, vary_on)
+    value = cache.get(key)
+    if value is None:
+        value = render()
+        if timeout is None:
+            timeout = cache.default_timeout
+        cache.set(key, value, timeout)
+    return value
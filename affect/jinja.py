@@ -0,0 +1,37 @@
+"""Jinja2 version of ``{% cache_affected %}``.
+
+Add ``affect.jinja.CacheAffectedExtension`` to the environment's
+extensions, then::
+
+    {% cache_affected 'header', ['rev_b', 'new_nav'], 600 %}
+        .. markup depending on the flags ..
+    {% endcache_affected %}
+
+The arguments are the fragment name, the flags, an optional timeout, by
+default the cache's default timeout, and an optional list of other values
+to vary on.  Requires Jinja2.
+"""
+from jinja2 import Markup, nodes
+from jinja2.ext import Extension
+
+from .fragments import active_flags, cached_fragment, flag_names
+
+
+class CacheAffectedExtension(Extension):
+    tags = set(['cache_affected'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.ContextReference(), parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(
+            ['name:endcache_affected'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, context, name, flags, timeout=None, vary_on=(),
+               caller=None):
+        active = active_flags(context, flag_names([flags]))
+        return Markup(cached_fragment(
+            name, timeout, active, vary_on, lambda: unicode(caller())))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...rules import RuleSet
+
+
+class Command(BaseCommand):
+    help = ('Report criteria that are not evaluated for each request, '
+            'because they are decided up front or can never give a flag, '
+            'flags that always lose a conflict, and parts of criteria that '
+            'never decide them.')
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('No arguments are taken.')
+        rules = RuleSet.load()
+        analysis = rules.analysis
+        write = self.stdout.write
+        write('%d criteria: %d evaluated for each request, %d decided up '
+              'front, %d dropped\n' % (
+                  len(rules.criteria), len(analysis.evaluated),
+                  len(analysis.constant), len(analysis.dropped)))
+        if analysis.always:
+            write('Flags for everyone: %s\n' % ', '.join(
+                sorted(analysis.always)))
+        if analysis.dead_flags:
+            write('Flags that always lose:\n')
+            for name, winner in sorted(analysis.dead_flags.items()):
+                write('  %s loses to %s\n' % (name, winner))
+        if analysis.dropped:
+            write('Dropped criteria:\n')
+            for name, reason in analysis.dropped:
+                write('  %s %s\n' % (name, reason))
+        if analysis.redundant:
+            write('Redundant:\n')
+            for name, note in analysis.redundant:
+                write('  %s: %s\n' % (name, note))
@@ -0,0 +1,93 @@
+from optparse import make_option
+import csv
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...batch import (DEFAULT_CHUNK_SIZE, RECORD_FORMATS, context_from_record,
+                      evaluate_batch, read_records)
+
+
+def _format(option, path):
+    if option:
+        return option
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+class Command(BaseCommand):
+    args = '[input file]'
+    help = ('Assign flags to users or request contexts read from a CSV or '
+            'JSONL file (or stdin) and stream the results as CSV or JSONL.')
+    option_list = BaseCommand.option_list + (
+        make_option('-o', '--output', default='-',
+                    help='File to write results to, defaults to stdout.'),
+        make_option('--input-format', choices=RECORD_FORMATS,
+                    help='Input format, guessed from the file extension.'),
+        make_option('--output-format', choices=RECORD_FORMATS,
+                    help='Output format, guessed from the file extension.'),
+        make_option('--chunk-size', type='int', default=DEFAULT_CHUNK_SIZE,
+                    help='Number of records evaluated together.'),
+        make_option('--workers', type='int', default=0,
+                    help='Number of processes evaluating chunks.'),
+        make_option('--progress', type='int', default=0,
+                    help='Report throughput every N records.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Only one input file may be given.')
+        path = args[0] if args else '-'
+        output = options['output']
+        input_format = _format(options['input_format'], path)
+        output_format = _format(options['output_format'], output)
+        verbosity = int(options.get('verbosity', 1))
+
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        out = self.stdout if output == '-' else open(output, 'wb')
+        try:
+            contexts = (context_from_record(record)
+                        for record in read_records(stream, input_format))
+            results = evaluate_batch(
+                contexts, chunk_size=options['chunk_size'],
+                processes=options['workers'])
+            count, elapsed = self.write(
+                results, out, output_format, options['progress'])
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if out is not self.stdout:
+                out.close()
+
+        if verbosity:
+            self.report(count, elapsed)
+
+    def write(self, results, out, format, progress):
+        started = time.time()
+        count = 0
+        if format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(['id', 'user_id', 'flags'])
+        for context, flags in results:
+            flags = sorted(flags)
+            if format == 'csv':
+                writer.writerow([
+                    context.key if context.key is not None else '',
+                    context.user_id if context.user_id is not None else '',
+                    ','.join(flags)])
+            else:
+                out.write(json.dumps({
+                    'id': context.key, 'user_id': context.user_id,
+                    'flags': flags}) + '\n')
+            count += 1
+            if progress and not count % progress:
+                self.report(count, time.time() - started)
+        return count, time.time() - started
+
+    def report(self, count, elapsed):
+        rate = count / elapsed if elapsed else 0
+        self.stderr.write(
+            'Assigned %d records in %.1fs (%.0f/s)\n' % (count, elapsed, rate))
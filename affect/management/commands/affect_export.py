@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...transfer import FORMATS, dumps, export_rules
+
+
+def _format(option, path):
+    if option:
+        return option
+    if path.endswith(('.yaml', '.yml')):
+        return 'yaml'
+    return 'json'
+
+
+class Command(BaseCommand):
+    args = '[output file]'
+    help = ('Export every flag and criteria as a JSON or YAML rule set, to '
+            'a file or stdout.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=FORMATS,
+                    help='Output format, guessed from the file extension.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Only one output file may be given.')
+        path = args[0] if args else '-'
+        try:
+            data = dumps(export_rules(), _format(options['format'], path))
+        except ValueError as e:
+            raise CommandError(e)
+        if path == '-':
+            self.stdout.write(data)
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
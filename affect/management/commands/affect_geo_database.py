@@ -0,0 +1,41 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...networks import write_geo_database
+
+
+class Command(BaseCommand):
+    args = '<input file> <output file>'
+    help = ('Build the AFFECTED_GEO_DATABASE file from CSV rows of a CIDR '
+            'block and a country code, or of the first and last address of '
+            'a range and a country code, read from a file (or stdin).')
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('An input file, or - for stdin, and an output '
+                               'file are required.')
+        path, output = args
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        try:
+            count = write_geo_database(output, self.rows(stream))
+        except ValueError as e:
+            raise CommandError(e)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if int(options.get('verbosity', 1)):
+            self.stderr.write('Wrote %d ranges to %s' % (count, output))
+
+    def rows(self, stream):
+        for line, row in enumerate(csv.reader(stream), 1):
+            row = [value.strip() for value in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) == 2:
+                yield row[0], '', row[1]
+            elif len(row) == 3:
+                yield row[0], row[1], row[2]
+            else:
+                raise CommandError('Expected 2 or 3 columns on line %d' % line)
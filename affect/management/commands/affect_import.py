@@ -0,0 +1,47 @@
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...transfer import FORMATS, import_rules, loads
+from .affect_export import _format
+
+
+class Command(BaseCommand):
+    args = '<input file>'
+    help = ('Make the flags and criteria in the database match a JSON or '
+            'YAML rule set read from a file (or stdin), in one transaction.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=FORMATS,
+                    help='Input format, guessed from the file extension.'),
+        make_option('--delete', action='store_true', default=False,
+                    help='Delete flags and criteria missing from the rule '
+                    'set.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Report the changes without saving them.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('One input file, or - for stdin, is required.')
+        path = args[0]
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        try:
+            result = import_rules(
+                loads(stream.read(), _format(options['format'], path)),
+                delete=options['delete'], dry_run=options['dry_run'])
+        except ValueError as e:
+            raise CommandError(e)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.write(result, options['dry_run'])
+
+    def write(self, result, dry_run):
+        for mark, changes in (('+', result.created), ('~', result.updated),
+                              ('-', result.deleted)):
+            for kind, name in changes:
+                self.stdout.write('%s %s %s\n' % (mark, kind, name))
+        self.stdout.write('%d created, %d updated, %d deleted%s\n' % (
+            len(result.created), len(result.updated), len(result.deleted),
+            ' (dry run, nothing saved)' if dry_run else ''))
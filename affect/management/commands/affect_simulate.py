@@ -0,0 +1,63 @@
+from optparse import make_option
+import json
+import sys
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from ...batch import RECORD_FORMATS, context_from_record, read_records
+from ...simulate import simulate
+from .affect_assign import _format
+
+
+class Command(BaseCommand):
+    args = '[input file]'
+    help = ('Replay request contexts read from a CSV or JSONL file (or '
+            'stdin) against the current rules and the rules with proposed '
+            'criteria changes, and report how many records each flag '
+            'reaches under both.')
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--changes',
+                    help='JSON file mapping criteria names to changed field '
+                    'values, or to null to remove the criteria.'),
+        make_option('--input-format', choices=RECORD_FORMATS,
+                    help='Input format, guessed from the file extension.'),
+        make_option('--seed', type='int', default=0,
+                    help='Seed for the numbers percent criteria draw.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Only one input file may be given.')
+        if not options['changes']:
+            raise CommandError('--changes is required.')
+        path = args[0] if args else '-'
+        with open(options['changes']) as f:
+            changes = json.load(f)
+
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        try:
+            contexts = [context_from_record(record) for record in read_records(
+                stream, _format(options['input_format'], path))]
+            report = simulate(contexts, changes, seed=options['seed'])
+        except (ImproperlyConfigured, ValueError) as e:
+            raise CommandError(e)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.write(report)
+
+    def write(self, report):
+        self.stdout.write('%d records, %d would get different flags\n' % (
+            report.records, report.changed))
+        if not report.flags:
+            return
+        width = max(len(impact.flag) for impact in report.flags)
+        self.stdout.write('%-*s %9s %9s %9s %9s %9s %9s\n' % (
+            width, 'flag', 'current', 'proposed', 'delta', 'gained', 'lost',
+            'conflicts'))
+        for impact in report.flags:
+            self.stdout.write('%-*s %9d %9d %+9d %9d %9d %4d/%-4d\n' % (
+                width, impact.flag, impact.current, impact.proposed,
+                impact.proposed - impact.current, impact.gained, impact.lost,
+                impact.current_conflicts, impact.proposed_conflicts))
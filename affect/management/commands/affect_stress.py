@@ -0,0 +1,113 @@
+from optparse import make_option
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...rules import RequestContext, RuleSet, Snapshot
+
+
+def sample_contexts(rules, count):
+    """Build ``count`` contexts that match the criteria of ``rules`` in
+    turn, with decision cookies for percent criteria so results do not
+    depend on chance."""
+    percent = [record for record in rules.criteria if record.percent > 0]
+    contexts = []
+    for i in range(count):
+        cookies = dict((record.cookie, str(bool((i + n) % 2)))
+                       for n, record in enumerate(percent))
+        context = RequestContext(cookies=cookies)
+        if rules.criteria:
+            record = rules.criteria[i % len(rules.criteria)]
+            referrers = [r for r in record.referrers if '*' not in r]
+            if referrers and i % 3:
+                context.referrer = 'http://%s/' % referrers[0]
+            paths = [p for p in record.entry_urls if ':' not in p]
+            if paths:
+                context.path = paths[0].replace('*', 'x')
+            context.query = dict(
+                (key, value) for key, value in record.query_args
+                if ':' not in key + value)
+            if record.users and i % 2:
+                context.user_id = min(record.users)
+                context.is_authenticated = True
+        contexts.append(context)
+    return contexts
+
+
+def stress(rules, contexts, threads, seconds):
+    """Evaluate ``contexts`` from ``threads`` threads for ``seconds`` while
+    another thread keeps swapping in rebuilt copies of ``rules``.
+
+    Returns the number of evaluations, of results that differ from a
+    single threaded evaluation, and of swaps.
+    """
+    expected = [rules.evaluate(context) for context in contexts]
+    snapshot = Snapshot(None)
+    snapshot.swap(rules)
+    stop = threading.Event()
+    results = []
+    swaps = [0]
+
+    def read(offset):
+        count = mismatches = 0
+        while not stop.is_set():
+            i = (offset + count) % len(contexts)
+            if snapshot.get().evaluate(contexts[i]) != expected[i]:
+                mismatches += 1
+            count += 1
+        results.append((count, mismatches))
+
+    def swap():
+        while not stop.wait(0.001):
+            snapshot.swap(RuleSet(rules.criteria, rules.flags))
+            swaps[0] += 1
+
+    workers = [threading.Thread(target=read, args=(n * 7919,))
+               for n in range(threads)]
+    workers.append(threading.Thread(target=swap))
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return (sum(count for count, _ in results),
+            sum(mismatches for _, mismatches in results), swaps[0])
+
+
+class Command(BaseCommand):
+    help = ('Evaluate the current rules from several threads while the '
+            'rule set is swapped, checking every result against a single '
+            'threaded evaluation and reporting throughput.')
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', default='1,2,4,8',
+                    help='Comma separated thread counts to run.'),
+        make_option('--seconds', type='float', default=2.0,
+                    help='Seconds to run each thread count for.'),
+        make_option('--contexts', type='int', default=1000,
+                    help='Number of sample request contexts.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(n) for n in options['threads'].split(',')]
+        except ValueError:
+            raise CommandError('--threads must be comma separated numbers.')
+        rules = RuleSet.load()
+        contexts = sample_contexts(rules, max(options['contexts'], 1))
+        self.stdout.write('%d criteria, %d contexts\n' % (
+            len(rules.criteria), len(contexts)))
+        self.stdout.write('%7s %12s %12s %7s %10s\n' % (
+            'threads', 'evals/s', 'per thread', 'swaps', 'mismatches'))
+        failed = False
+        for threads in counts:
+            evaluations, mismatches, swaps = stress(
+                rules, contexts, threads, options['seconds'])
+            rate = evaluations / options['seconds']
+            self.stdout.write('%7d %12.0f %12.0f %7d %10d\n' % (
+                threads, rate, rate / threads, swaps, mismatches))
+            failed = failed or mismatches
+        if failed:
+            raise CommandError('Results differed from single threaded '
+                               'evaluation.')
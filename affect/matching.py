@@ -0,0 +1,410 @@
+"""Indexes that match request values against the patterns of every criteria
+at once.
+
+``query_args`` keys and values may each be an exact string, ``*`` for any
+non-empty value, a glob using ``*`` and ``?`` such as ``utm_*``, or a
+regular expression prefixed with ``re:`` such as ``re:^cpc-[0-9]+$``, which
+is searched for anywhere in the value.  Invalid expressions never match.
+
+``entry_url`` paths take the same patterns, and also ``name:`` followed by
+a URL name such as ``name:admin:index``.  Paths ending in ``/*`` are kept
+in a trie of path segments.
+
+``referrer`` hosts are exact, ``*.example.com`` for example.com and any of
+its subdomains, or ``news.*`` for any host whose leftmost labels are
+``news``.  They are kept in tries of reversed and forward host labels.
+
+``languages`` are language tags such as ``fr`` or ``pt-br``, matching the
+tags a request's ``Accept-Language`` header accepts and the tags they
+prefix, so ``fr`` matches ``fr-ca``.  Parsed headers are kept in a bounded
+LRU cache keyed by the raw header, since most requests send one of a few
+common headers.
+"""
+from collections import OrderedDict, defaultdict
+import re
+import threading
+
+from django.conf import settings
+from django.core.urlresolvers import Resolver404, resolve
+from django.test.signals import setting_changed
+
+from .configured import Configured
+
+REGEX_PREFIX = 're:'
+NAME_PREFIX = 'name:'
+ANY_VALUE = '*'
+NEVER = re.compile(r'(?!)')
+LANGUAGE_TAG = re.compile(r'^[a-z]{1,8}(-[a-z0-9]{1,8})*$')
+# Unescaped \1, (?P=name) and (?(1)...), which refer to groups by number or
+# name, so they change meaning when a pattern is combined with others.
+GROUP_REFERENCE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P=|\(\?\()')
+
+
+def compile_pattern(pattern):
+    """Return a compiled expression for a glob or ``re:`` pattern, or
+    ``None`` when ``pattern`` is matched exactly."""
+    if pattern.startswith(REGEX_PREFIX):
+        try:
+            return re.compile(pattern[len(REGEX_PREFIX):])
+        except re.error:
+            return NEVER
+    if '*' not in pattern and '?' not in pattern:
+        return None
+    return re.compile(r'^%s\Z' % ''.join(
+        '.*' if c == '*' else '.' if c == '?' else re.escape(c)
+        for c in pattern))
+
+
+def query_pairs(query_args):
+    """Flatten a ``query_args`` dictionary into sorted ``(key, value)``
+    pattern pairs, skipping values that are not strings."""
+    pairs = set()
+    for key, value in (query_args or {}).items():
+        if not isinstance(value, list):
+            value = [value]
+        pairs.update((key, v) for v in value if isinstance(v, basestring))
+    return tuple(sorted(pairs))
+
+
+def _combine(items):
+    """Return one expression matching whenever any of the ``(pattern,
+    value)`` pairs of ``items`` might, and the pairs whose pattern must be
+    tried on its own since it refers to its groups."""
+    combined = [p for p, _ in items if not GROUP_REFERENCE.search(p.pattern)]
+    separate = tuple((p, v) for p, v in items
+                     if GROUP_REFERENCE.search(p.pattern))
+    if not combined:
+        return None, separate
+    try:
+        return re.compile(
+            '|'.join('(?:%s)' % p.pattern for p in combined)), separate
+    except (re.error, AssertionError, OverflowError):
+        # Too many groups to combine, try each pattern.
+        return re.compile(''), separate
+
+
+class ValueIndex(object):
+    """Values expected for one querystring key."""
+
+    def __init__(self):
+        self.any = set()
+        self.exact = defaultdict(set)
+        self.patterns = defaultdict(set)
+        self.combined = None
+        self.separate = ()
+
+    def add(self, value, target):
+        if value == ANY_VALUE:
+            self.any.add(target)
+        else:
+            pattern = compile_pattern(value)
+            if pattern is None:
+                self.exact[value].add(target)
+            else:
+                self.patterns[pattern.pattern].add(target)
+
+    def freeze(self):
+        self.any = frozenset(self.any)
+        self.exact = dict((v, frozenset(t)) for v, t in self.exact.items())
+        self.patterns = tuple(
+            (re.compile(p), frozenset(t))
+            for p, t in sorted(self.patterns.items()))
+        self.combined, self.separate = _combine(self.patterns)
+
+    def match(self, value, matched):
+        matched.update(self.any)
+        if value in self.exact:
+            matched.update(self.exact[value])
+        if self.combined is not None and self.combined.search(value):
+            candidates = self.patterns
+        else:
+            candidates = self.separate
+        for pattern, targets in candidates:
+            if pattern.search(value):
+                matched.update(targets)
+
+
+class QueryIndex(object):
+    """Match a querystring against the ``query_args`` of many targets.
+
+    Keys are looked up in a dictionary, key patterns are tried only when
+    a single combined expression of them matches, and likewise for value
+    patterns, so a querystring is scanned once however many targets there
+    are.  Patterns referring to their own groups, such as ``(.)\1``, are
+    always tried on their own.
+    """
+
+    def __init__(self, rules=()):
+        keys = defaultdict(ValueIndex)
+        patterns = defaultdict(ValueIndex)
+        for target, pairs in rules:
+            for key, value in pairs:
+                pattern = compile_pattern(key)
+                if pattern is None:
+                    keys[key].add(value, target)
+                else:
+                    patterns[pattern.pattern].add(value, target)
+        for values in keys.values() + patterns.values():
+            values.freeze()
+        self.keys = dict(keys)
+        self.patterns = tuple(
+            (re.compile(p), values) for p, values in sorted(patterns.items()))
+        self.combined, self.separate = _combine(self.patterns)
+
+    def __nonzero__(self):
+        return bool(self.keys or self.patterns)
+
+    def match(self, query):
+        """Return the set of targets with a pair matching ``query``, a
+        dictionary or ``QueryDict``.  Empty values never match."""
+        matched = set()
+        if not self:
+            return matched
+        for key, value in query.items():
+            if not value:
+                continue
+            if key in self.keys:
+                self.keys[key].match(value, matched)
+            if self.combined is not None and self.combined.search(key):
+                candidates = self.patterns
+            else:
+                candidates = self.separate
+            for pattern, values in candidates:
+                if pattern.search(key):
+                    values.match(value, matched)
+        return matched
+
+
+class PathIndex(object):
+    """Match a path against the ``entry_url`` paths of many targets.
+
+    Exact paths are looked up in a dictionary, ``/*`` prefixes are found
+    in one walk down a trie of path segments, other patterns are tried only
+    when a combined expression of them matches, and the URL name is
+    resolved only when some target uses one.
+    """
+
+    def __init__(self, rules=()):
+        self.paths = ValueIndex()
+        self.prefixes = {}
+        names = defaultdict(set)
+        for target, paths in rules:
+            for path in paths:
+                if path.startswith(NAME_PREFIX):
+                    names[path[len(NAME_PREFIX):]].add(target)
+                elif (path.endswith('/*') and
+                        compile_pattern(path[:-1]) is None):
+                    node = self.prefixes
+                    for segment in path[:-2].split('/'):
+                        node = node.setdefault(segment, {})
+                    node.setdefault(None, set()).add(target)
+                else:
+                    self.paths.add(path, target)
+        self.paths.freeze()
+        self.names = dict((n, frozenset(t)) for n, t in names.items())
+
+    def __nonzero__(self):
+        return bool(self.paths.any or self.paths.exact or
+                    self.paths.patterns or self.prefixes or self.names)
+
+    def match(self, path):
+        """Return the set of targets with a path matching ``path``."""
+        matched = set()
+        if not path or not self:
+            return matched
+        self.paths.match(path, matched)
+        if self.prefixes:
+            node = self.prefixes
+            segments = path.split('/')
+            for segment in segments[:-1]:
+                node = node.get(segment)
+                if node is None:
+                    break
+                matched.update(node.get(None, ()))
+        if self.names:
+            try:
+                match = resolve(path)
+            except Resolver404:
+                pass
+            else:
+                matched.update(self.names.get(
+                    ':'.join(match.namespaces + [match.url_name]), ()))
+        return matched
+
+
+class HostIndex(object):
+    """Match a hostname against the ``referrer`` hosts of many targets.
+
+    Exact and ``*.`` hosts share a trie of reversed labels, so one walk
+    from the top level domain finds every domain the host belongs to.
+    ``.*`` hosts are in a trie of forward labels, walked once from the
+    left.
+    """
+    EXACT = 0
+    DOMAIN = 1
+
+    def __init__(self, rules=()):
+        self.suffixes = {}
+        self.prefixes = {}
+        for target, hosts in rules:
+            for host in hosts:
+                host = host.strip().lower()
+                if host.startswith('*.'):
+                    self._add(self.suffixes, reversed(host[2:].split('.')),
+                              self.DOMAIN, target)
+                elif host.endswith('.*'):
+                    self._add(self.prefixes, host[:-2].split('.'),
+                              self.DOMAIN, target)
+                elif host:
+                    self._add(self.suffixes, reversed(host.split('.')),
+                              self.EXACT, target)
+
+    @staticmethod
+    def _add(node, labels, kind, target):
+        for label in labels:
+            node = node.setdefault(label, {})
+        node.setdefault(kind, set()).add(target)
+
+    def __nonzero__(self):
+        return bool(self.suffixes or self.prefixes)
+
+    def match(self, host):
+        """Return the set of targets with a host matching ``host``, a
+        lowercase hostname."""
+        matched = set()
+        if not host or not self:
+            return matched
+        labels = host.split('.')
+        node = self.suffixes
+        for label in reversed(labels):
+            node = node.get(label)
+            if node is None:
+                break
+            matched.update(node.get(self.DOMAIN, ()))
+        else:
+            matched.update(node.get(self.EXACT, ()))
+        node = self.prefixes
+        for label in labels[:-1]:
+            node = node.get(label)
+            if node is None:
+                break
+            matched.update(node.get(self.DOMAIN, ()))
+        return matched
+
+
+class LRUCache(object):
+    """A thread safe dictionary of at most ``size`` items, dropping the
+    least recently used."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+_languages = Configured(lambda: LRUCache(getattr(
+    settings, 'AFFECTED_LANGUAGE_CACHE_SIZE', 1000)), 'AFFECTED_LANGUAGE')
+
+
+def get_language_cache():
+    """Return the cache of parsed ``Accept-Language`` headers of this
+    process, of ``AFFECTED_LANGUAGE_CACHE_SIZE`` headers."""
+    return _languages.get()
+
+
+def reset_language_cache(**kwargs):
+    """Forget the parsed headers, so the cache is rebuilt from settings."""
+    _languages.reset(**kwargs)
+
+setting_changed.connect(reset_language_cache, dispatch_uid='affect_matching')
+
+
+def _parse_accept_language(header):
+    accepted = []
+    for position, part in enumerate(header.split(',')):
+        tag, _, params = part.partition(';')
+        tag = tag.strip().lower()
+        if not LANGUAGE_TAG.match(tag):
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            accepted.append((-quality, position, tag))
+    tags = []
+    for _, _, tag in sorted(accepted):
+        if tag not in tags:
+            tags.append(tag)
+    return tuple(tags)
+
+
+def parse_accept_language(header):
+    """Return the lowercase language tags an ``Accept-Language`` header
+    accepts, most preferred first.  Tags with a quality of 0, ``*`` and
+    malformed tags are left out."""
+    if not header:
+        return ()
+    cache = get_language_cache()
+    tags = cache.get(header)
+    if tags is None:
+        tags = _parse_accept_language(header)
+        cache.set(header, tags)
+    return tags
+
+
+class LanguageIndex(object):
+    """Match an ``Accept-Language`` header against the ``languages`` of many
+    targets.
+
+    Tags are looked up in one dictionary, once for each accepted tag and
+    each of its prefixes, so the header is parsed once however many targets
+    there are.
+    """
+
+    def __init__(self, rules=()):
+        languages = defaultdict(set)
+        for target, tags in rules:
+            for tag in tags:
+                tag = tag.strip().lower()
+                if tag:
+                    languages[tag].add(target)
+        self.languages = dict(
+            (tag, frozenset(targets)) for tag, targets in languages.items())
+
+    def __nonzero__(self):
+        return bool(self.languages)
+
+    def match(self, header):
+        """Return the set of targets with a language ``header`` accepts."""
+        matched = set()
+        if not header or not self:
+            return matched
+        for tag in parse_accept_language(header):
+            while tag:
+                matched.update(self.languages.get(tag, ()))
+                tag = tag.rpartition('-')[0]
+        return matched
@@ -1,53 +1,73 @@
-from django.core.cache import cache
 from django.utils.encoding import smart_str
 
-from .models import Criteria
-from .utils import (ALL_CRITERIA_KEY, CRITERIA_FLAGS_KEY, FLAG_CONFLICTS_KEY,
-                    cache_criteria, meets_criteria, settings)
+from .assignments import get_assignments
+from .counters import count_criteria, count_request
+from .current import FlagAssignment, set_current
+from .exposure import get_recorder, record_request
+from .profiling import finish_request, profiled, start_request
+from .rules import RequestContext, get_rules
+from .utils import cookie_name, settings, testing_cookie_name
 
 
 class AffectMiddleware(object):
     def process_request(self, request):
-        request.affected_persist = {}
-        flags = {}
-
-        all_criteria = cache.get(ALL_CRITERIA_KEY)
-        if all_criteria is None:
-            all_criteria = Criteria.objects.all()
-            cache.add(ALL_CRITERIA_KEY, all_criteria)
+        start_request(request)
+        with profiled(request):
+            self.evaluate(request)
 
-        for criteria in all_criteria:
-            active = meets_criteria(request, criteria)
+    def evaluate(self, request):
+        request.affected_persist = {}
+        rules = get_rules()
+        context = RequestContext.from_request(
+            request, groups=rules.uses_groups)
+        assignments = get_assignments()
+        stored = None
+        if assignments is not None and context.user_id is not None:
+            stored = assignments.load(context.user_id)
+        if stored:
+            context.cookies = dict(context.cookies)
+            for name, active in stored.items():
+                context.cookies[name] = str(active)
+        decisions = {}
+        flags = rules.evaluate(
+            context, decisions, getattr(request, 'affected_timings', None))
 
-            if criteria.persistent:
+        for criteria, (active, branch) in decisions.items():
+            if criteria.persistent or branch == 'percent':
                 request.affected_persist[criteria] = active
+            if branch == 'testing' and (
+                    criteria.testing_cookie in context.query):
+                if not hasattr(request, 'affected_tests'):
+                    request.affected_tests = {}
+                request.affected_tests[criteria] = active
+            count_criteria(criteria.name, branch, active)
 
-            if active:
-                criteria_flags = cache.get(CRITERIA_FLAGS_KEY % criteria.name)
-                if criteria_flags is None:
-                    criteria_flags = criteria.flags.filter(active=True)
-                    cache_criteria(instance=criteria)
-                for flag in criteria_flags:
-                    flags[flag.name] = flag
-
-        for name, flag in flags.items():
-            flag_conflicts = cache.get(FLAG_CONFLICTS_KEY % name)
-            if flag_conflicts is None:
-                flag_conflicts = flag.conflicts.filter(
-                    active=True, priority__gte=flag.priority)
-                cache.add(FLAG_CONFLICTS_KEY % name, flag_conflicts)
-            for conflict in flag_conflicts:
-                if conflict in flags.values():
-                    flags.pop(name)
+        if stored is not None and assignments.update(
+                context.user_id, stored, request.affected_persist,
+                getattr(request, 'affected_tests', None)):
+            request.affected_persist = {}
+            request.affected_tests = {}
 
-        request.affected_flags = flags.keys()
+        request.affected_flags = flags
+        set_current(FlagAssignment(flags, rules.built))
+        count_request(request.affected_flags)
+        if get_recorder() is not None:
+            request.affected_checked = set()
 
     def process_response(self, request, response):
+        with profiled(request):
+            self.set_cookies(request, response)
+            record_request(request)
+        finish_request(request)
+        set_current(None)
+        return response
+
+    def set_cookies(self, request, response):
         secure = getattr(settings, 'AFFECTED_SECURE_COOKIE', False)
 
         if hasattr(request, 'affected_persist'):
             for criteria, active in request.affected_persist.items():
-                name = smart_str(settings.AFFECTED_COOKIE % criteria.name)
+                name = smart_str(cookie_name(criteria.name))
                 if criteria.max_cookie_age:
                     age = criteria.max_cookie_age
                 else:
@@ -57,13 +77,10 @@ class AffectMiddleware(object):
 
         if hasattr(request, 'affected_tests'):
             for criteria, active in request.affected_tests.items():
-                name = smart_str(
-                    settings.AFFECTED_TESTING_COOKIE % criteria.name)
+                name = smart_str(testing_cookie_name(criteria.name))
                 if criteria.max_cookie_age:
                     age = criteria.max_cookie_age
                 else:
                     age = None
                 response.set_cookie(
                     name, value=active, max_age=age, secure=secure)
-
-        return response
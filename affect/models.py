@@ -3,11 +3,37 @@ try:
 except ImportError:
     from datetime import datetime
 from django.contrib.auth.models import Group, User
+from django.core.exceptions import ValidationError
 from django.db import models
 from django_extensions.db.fields.json import JSONField
 
+from .expressions import ExpressionError, find_cycle, parse, references
+from .matching import LANGUAGE_TAG
+from .networks import range_keys
 
-class Flag(models.Model):
+
+class ScheduleMixin(object):
+    """Optional ``start`` and ``end`` times outside of which an object is
+    ignored."""
+
+    def scheduled(self, now=None):
+        """Return whether ``now``, by default the current time, is within
+        the schedule."""
+        if now is None:
+            now = datetime.now()
+        return ((self.start is None or self.start <= now) and
+                (self.end is None or now < self.end))
+
+    def clean(self):
+        self.clean_values()
+
+    def clean_values(self):
+        """Validate the field values that are checked without queries."""
+        if self.start and self.end and self.end <= self.start:
+            raise ValidationError('The end must be after the start.')
+
+
+class Flag(ScheduleMixin, models.Model):
     name = models.SlugField(
         unique=True,
         help_text='Key that will be attached to the request')
@@ -20,6 +46,14 @@ class Flag(models.Model):
         default=0,
         help_text='If flag conflicts with other flags, highest priority is '
         'applied (0 - low priority, 100 - high priority)')
+    start = models.DateTimeField(
+        blank=True, null=True,
+        help_text='When this flag starts being given to requests, blank for '
+        'as soon as it is active.')
+    end = models.DateTimeField(
+        blank=True, null=True,
+        help_text='When this flag stops being given to requests, blank for '
+        'never.')
     created = models.DateTimeField(
         default=datetime.now, db_index=True, editable=False,
         help_text=('Date when this flag was created.'))
@@ -35,7 +69,7 @@ class Flag(models.Model):
         super(Flag, self).save(*args, **kwargs)
 
 
-class Criteria(models.Model):
+class Criteria(ScheduleMixin, models.Model):
     name = models.SlugField(
         unique=True,
         help_text='Name used when storing cookie for criteria decisions.')
@@ -82,22 +116,47 @@ class Criteria(models.Model):
             'client-side, use css and js feature detection instead)'))
     entry_url = models.TextField(blank=True, default='', help_text=(
         'Activate this criteria for users who enter on one of these urls '
-        '(comma separated list)'))
+        '(comma separated list, /blog/* matches paths under /blog/, * and ? '
+        'are wildcards, "re:" prefixes a regular expression and "name:" a '
+        'URL name)'))
     referrer = models.TextField(blank=True, default='', help_text=(
         'Activate this criteria for users who entered from one of these '
-        'domains (comma separated list)'))
+        'domains (comma separated list, *.example.com matches example.com '
+        'and its subdomains, news.* matches any host starting news.)'))
     query_args = JSONField(
         blank=True, null=True, default=None,
         help_text='Dictionary of key value pairs to expect in the querystring.'
         '(ie. {"foo": "bar"} matches ?foo=bar; {"foo": "*"} matches ?foo=<any '
-        'value>; {"foo": ["bar", "baz"] matches ?foo=bar or ?foo=baz)')
-    #languages = models.TextField(blank=True, default='', help_text=(
-    #    'Activate this criteria for users with one of these languages (comma '
-    #    'separated list)'))
+        'value>; {"foo": ["bar", "baz"] matches ?foo=bar or ?foo=baz; '
+        '{"utm_*": "spring-*"} matches any utm_ key with a value starting '
+        'spring-; "re:" prefixes a regular expression)')
+    ip_ranges = models.TextField(blank=True, default='', help_text=(
+        'Activate this criteria for clients with one of these addresses '
+        '(comma separated list of IPv4 or IPv6 addresses and CIDR blocks, '
+        'ie. 192.0.2.0/24, 2001:db8::/32)'))
+    countries = models.TextField(blank=True, default='', help_text=(
+        'Activate this criteria for clients in one of these countries, '
+        'looked up in the AFFECTED_GEO_DATABASE file (comma separated list '
+        'of ISO 3166 codes, ie. US, GB)'))
+    expression = models.TextField(blank=True, default='', help_text=(
+        'Activate this criteria for requests matching a boolean expression '
+        '(ie. "mobile and referrer:*.google.com and not staff"; combine '
+        'authenticated, staff, superuser, mobile, desktop, simple, '
+        'referrer:<host>, entry_url:<path>, query:<key>=<value>, '
+        'language:<tag>, user:<id>, group:<id> and criteria:<name> with and, '
+        'or, not and parentheses)'))
+    languages = models.TextField(blank=True, default='', help_text=(
+        'Activate this criteria for users whose browser accepts one of these '
+        'languages (comma separated list of language tags, ie. fr, pt-BR; fr '
+        'also matches fr-CA)'))
     groups = models.ManyToManyField(Group, blank=True, help_text=(
         'Activate this criteria for these user groups.'))
     users = models.ManyToManyField(User, blank=True, help_text=(
         'Activate this criteria for these users.'))
+    start = models.DateTimeField(blank=True, null=True, help_text=(
+        'When this criteria starts being evaluated, blank for immediately.'))
+    end = models.DateTimeField(blank=True, null=True, help_text=(
+        'When this criteria stops being evaluated, blank for never.'))
     note = models.TextField(blank=True, help_text=(
         'Note where this criteria is used.'))
     created = models.DateTimeField(
@@ -113,6 +172,122 @@ class Criteria(models.Model):
     def __unicode__(self):
         return self.name
 
+    def clean_values(self):
+        super(Criteria, self).clean_values()
+        invalid = []
+        for text in filter(None, self.ip_ranges.split(',')):
+            try:
+                range_keys(text)
+            except ValueError:
+                invalid.append(text.strip())
+        if invalid:
+            raise ValidationError('Invalid IP ranges: %s' % ', '.join(invalid))
+        invalid = [code.strip() for code in self.countries.split(',')
+                   if code.strip() and not (
+                       len(code.strip()) == 2 and code.strip().isalpha())]
+        if invalid:
+            raise ValidationError('Invalid countries: %s' % ', '.join(invalid))
+        invalid = [tag.strip() for tag in self.languages.split(',')
+                   if tag.strip() and
+                   not LANGUAGE_TAG.match(tag.strip().lower())]
+        if invalid:
+            raise ValidationError('Invalid languages: %s' % ', '.join(invalid))
+
+    def clean(self):
+        super(Criteria, self).clean()
+        if not self.expression:
+            return
+        try:
+            tree = parse(self.expression)
+        except ExpressionError as e:
+            raise ValidationError('Invalid expression: %s' % e)
+        graph = {self.name: references(tree)}
+        for name, expression in Criteria.objects.exclude(
+                pk=self.pk).values_list('name', 'expression'):
+            graph[name] = set()
+            if expression:
+                try:
+                    graph[name] = references(parse(expression))
+                except ExpressionError:
+                    pass
+        unknown = graph[self.name] - set(graph)
+        if unknown:
+            raise ValidationError('Unknown criteria in expression: %s' % (
+                ', '.join(sorted(unknown))))
+        cycle = find_cycle(graph, self.name)
+        if cycle:
+            raise ValidationError(
+                'Expression refers back to this criteria: %s' % (
+                    ' -> '.join(cycle)))
+
     def save(self, *args, **kwargs):
         self.modified = datetime.now()
         super(Criteria, self).save(*args, **kwargs)
+
+
+class Exposure(models.Model):
+    flag = models.SlugField(
+        db_index=True, help_text='Name of the flag that was checked.')
+    active = models.BooleanField(
+        default=False, help_text='Whether the flag was affected when checked.')
+    user_id = models.IntegerField(
+        blank=True, null=True, help_text='Authenticated user, if any.')
+    sample_rate = models.FloatField(
+        default=1.0, help_text='Fraction of exposures recorded when this one '
+        'was, weight counts by its inverse.')
+    created = models.DateTimeField(
+        default=datetime.now, db_index=True, editable=False,
+        help_text=('Date when the flag was checked.'))
+
+    def __unicode__(self):
+        return self.flag
+
+
+class HitCount(models.Model):
+    key = models.CharField(
+        max_length=100, help_text='What was counted, such as "requests", '
+        '"criteria:<name>:<branch>" or "flag:<name>".')
+    bucket = models.IntegerField(
+        help_text='Start of the counted period, in seconds since epoch.')
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('bucket', 'key')
+
+    def __unicode__(self):
+        return u'%s@%s' % (self.key, self.bucket)
+
+
+class Assignment(models.Model):
+    user = models.OneToOneField(
+        User, primary_key=True, related_name='affected_assignment')
+    decisions = JSONField(
+        blank=True, null=True, default=None,
+        help_text='Persistent criteria decisions of the user, by the name of '
+        'the cookie they would otherwise be kept in.')
+    modified = models.DateTimeField(
+        default=datetime.now, editable=False,
+        help_text=('Date when the decisions last changed.'))
+
+    def __unicode__(self):
+        return unicode(self.user_id)
+
+
+class CompiledRules(models.Model):
+    version = models.CharField(
+        max_length=32, unique=True, default='',
+        help_text='Token of the rules version the rule set was built for, '
+        'rows of other versions are ignored.')
+    format = models.PositiveSmallIntegerField(
+        help_text='Version of the stored format, rows of other versions are '
+        'rebuilt.')
+    data = models.TextField(help_text='The built rule set, as JSON.')
+    built = models.DateTimeField(
+        default=datetime.now, editable=False,
+        help_text='Date when the rule set was built.')
+
+    class Meta:
+        verbose_name_plural = 'compiled rules'
+
+    def __unicode__(self):
+        return unicode(self.built)
@@ -0,0 +1,270 @@
+"""Match client addresses against IP ranges and a local geo database.
+
+Addresses are IPv4 or IPv6.  IPv4 addresses are mapped into IPv6, as
+``::ffff:a.b.c.d``, so both share one key space of 16 byte big-endian
+strings, which sort like the numbers they encode.  Ranges are single
+addresses or CIDR blocks such as ``192.0.2.0/24`` or ``2001:db8::/32``.
+
+:class:`RangeIndex` compiles the ranges of many targets into one sorted
+array of the starts of non-overlapping intervals, each with the set of
+targets covering it, so looking up an address is one binary search however
+many ranges there are.  :class:`GeoDatabase` binary searches a file of
+sorted ``(first, last, country)`` records the same way, through a memory
+map, so it is shared by the processes of a host and never read whole.
+
+The client address is ``REMOTE_ADDR``, unless that is one of the
+``AFFECTED_TRUSTED_PROXIES``, in which case ``X-Forwarded-For`` is read from
+the right, skipping trusted proxies, and the first other address is the
+client's.
+"""
+from collections import defaultdict
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+from .configured import Configured
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 16
+IPV4_PREFIX = '\0' * 10 + '\xff\xff'
+LAST_KEY = '\xff' * KEY_SIZE
+
+GEO_MAGIC = 'AFGE'
+GEO_FORMAT = 1
+GEO_HEADER = struct.Struct('!4sBI')
+GEO_RECORD = 2 * KEY_SIZE + 2
+
+_EMPTY = frozenset()
+
+
+def address_key(address):
+    """Return the key of an IPv4 or IPv6 address, raising ``ValueError``
+    when it is invalid."""
+    try:
+        address = str(address).strip()
+        if ':' in address:
+            return socket.inet_pton(socket.AF_INET6, address)
+        return IPV4_PREFIX + socket.inet_pton(socket.AF_INET, address)
+    except (socket.error, UnicodeError, ValueError):
+        raise ValueError('Invalid address %r' % address)
+
+
+def _number(key):
+    return int(key.encode('hex'), 16)
+
+
+def _key(number):
+    return ('%032x' % number).decode('hex')
+
+
+def range_keys(text):
+    """Return the keys of the first and last addresses of an address or
+    CIDR block, raising ``ValueError`` when it is invalid."""
+    address, sep, bits = text.strip().partition('/')
+    key = address_key(address)
+    prefix = 128
+    if sep:
+        ipv4 = ':' not in address
+        try:
+            prefix = int(bits) + (96 if ipv4 else 0)
+        except ValueError:
+            prefix = -1
+        if not (96 if ipv4 else 0) <= prefix <= 128:
+            raise ValueError('Invalid prefix length in %r' % text)
+    host_bits = 128 - prefix
+    start = _number(key) >> host_bits << host_bits
+    return _key(start), _key(start | ((1 << host_bits) - 1))
+
+
+def _search(data, count, size, key, offset=0):
+    """Return the index of the last of ``count`` records of ``size`` bytes
+    in ``data`` starting with a key up to ``key``, or -1."""
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        start = offset + middle * size
+        if data[start:start + KEY_SIZE] <= key:
+            low = middle + 1
+        else:
+            high = middle
+    return low - 1
+
+
+class RangeIndex(object):
+    """Match an address against the IP ranges of many targets.
+
+    Invalid ranges are skipped, invalid addresses match nothing.
+    """
+
+    def __init__(self, rules=()):
+        events = defaultdict(list)
+        for target, ranges in rules:
+            for text in ranges:
+                try:
+                    first, last = range_keys(text)
+                except ValueError:
+                    logger.warning('Skipped invalid IP range %r', text)
+                    continue
+                events[first].append((target, 1))
+                if last != LAST_KEY:
+                    events[_key(_number(last) + 1)].append((target, -1))
+        covering = defaultdict(int)
+        interned = {}
+        starts, targets = [], []
+        for key in sorted(events):
+            for target, change in events[key]:
+                covering[target] += change
+                if not covering[target]:
+                    del covering[target]
+            current = frozenset(covering)
+            current = interned.setdefault(current, current)
+            if not targets or targets[-1] is not current:
+                starts.append(key)
+                targets.append(current)
+        self.starts = ''.join(starts)
+        self.targets = tuple(targets)
+
+    def __nonzero__(self):
+        return bool(self.targets)
+
+    def match(self, address):
+        """Return the frozenset of targets with a range holding
+        ``address``."""
+        if not self.targets or not address:
+            return _EMPTY
+        try:
+            key = address_key(address)
+        except ValueError:
+            return _EMPTY
+        index = _search(self.starts, len(self.targets), KEY_SIZE, key)
+        return self.targets[index] if index >= 0 else _EMPTY
+
+
+class GeoDatabase(object):
+    """A country database file written by :func:`write_geo_database`,
+    memory mapped."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < GEO_HEADER.size:
+            raise ValueError('Not a geo database: %s' % path)
+        magic, version, self.count = GEO_HEADER.unpack_from(self.data)
+        if magic != GEO_MAGIC or version != GEO_FORMAT or (
+                len(self.data) != GEO_HEADER.size + self.count * GEO_RECORD):
+            raise ValueError('Not a geo database: %s' % path)
+
+    def __len__(self):
+        return self.count
+
+    def country(self, address):
+        """Return the country code of ``address``, or ``None``."""
+        try:
+            key = address_key(address)
+        except ValueError:
+            return None
+        index = _search(self.data, self.count, GEO_RECORD, key,
+                        GEO_HEADER.size)
+        if index < 0:
+            return None
+        start = GEO_HEADER.size + index * GEO_RECORD
+        if key > self.data[start + KEY_SIZE:start + 2 * KEY_SIZE]:
+            return None
+        return self.data[start + 2 * KEY_SIZE:start + GEO_RECORD]
+
+    def close(self):
+        self.data.close()
+
+
+def write_geo_database(path, rows):
+    """Atomically write a geo database to ``path`` from ``(first, last,
+    country)`` rows, where ``last`` may be empty when ``first`` is a CIDR
+    block and ``country`` is a two letter code.  Raises ``ValueError`` for
+    invalid or overlapping rows.  Returns the number of records."""
+    records = []
+    for first, last, country in rows:
+        country = country.strip().upper()
+        if len(country) != 2:
+            raise ValueError('Invalid country %r' % country)
+        if last:
+            start, end = range_keys(first)[0], range_keys(last)[1]
+        else:
+            start, end = range_keys(first)
+        if end < start:
+            raise ValueError('%s is after %s' % (first, last))
+        records.append((start, end, str(country)))
+    records.sort()
+    for previous, record in zip(records, records[1:]):
+        if record[0] <= previous[1]:
+            raise ValueError('Overlapping ranges for %s and %s' % (
+                previous[2], record[2]))
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(GEO_HEADER.pack(GEO_MAGIC, GEO_FORMAT, len(records)))
+            for record in records:
+                f.write(''.join(record))
+        os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except Exception:
+        os.unlink(temp)
+        raise
+    return len(records)
+
+
+def get_geo_database():
+    """Return the ``AFFECTED_GEO_DATABASE`` file of this process, or
+    ``None`` when it is not configured or cannot be read."""
+    return _geo_database.get()
+
+
+def _build_geo_database():
+    path = getattr(settings, 'AFFECTED_GEO_DATABASE', None)
+    if not path:
+        return None
+    try:
+        return GeoDatabase(path)
+    except (IOError, OSError, ValueError):
+        logger.exception('Could not open geo database %s', path)
+        return None
+
+_geo_database = Configured(_build_geo_database, 'AFFECTED_GEO')
+
+
+def reset_geo_database(**kwargs):
+    """Forget the geo database, so it is mapped again from settings."""
+    _geo_database.reset(**kwargs)
+
+setting_changed.connect(reset_geo_database, dispatch_uid='affect_networks')
+
+_trusted = ((), RangeIndex())
+
+
+def trusted_proxies():
+    """Return a :class:`RangeIndex` of ``AFFECTED_TRUSTED_PROXIES``."""
+    global _trusted
+    proxies = tuple(getattr(settings, 'AFFECTED_TRUSTED_PROXIES', ()))
+    if _trusted[0] != proxies:
+        _trusted = (proxies, RangeIndex([(True, proxies)]))
+    return _trusted[1]
+
+
+def client_address(meta):
+    """Return the client address of a request from its ``META``."""
+    address = meta.get('REMOTE_ADDR', '')
+    trusted = trusted_proxies()
+    if not trusted:
+        return address
+    forwarded = [value.strip() for value in
+                 meta.get('HTTP_X_FORWARDED_FOR', '').split(',')
+                 if value.strip()]
+    while forwarded and trusted.match(address):
+        address = forwarded.pop()
+    return address
@@ -0,0 +1,171 @@
+"""Profile a sample of requests through the middleware.
+
+With ``AFFECTED_PROFILE_RATE`` set to N, one in N requests runs the work of
+:class:`affect.middleware.AffectMiddleware` under cProfile, and the time
+:meth:`affect.rules.RuleSet.evaluate` spends deciding each criteria is
+recorded.  The statistics of sampled requests are added up in each
+process, along with those criteria timings, and written to
+``AFFECTED_PROFILE_FILE`` every ``AFFECTED_PROFILE_INTERVAL`` seconds in the
+format of :mod:`pstats`.  Staff can read both on the "Profile" page of the
+criteria admin.  Profiling is off unless a rate is set.
+"""
+from StringIO import StringIO
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+from .configured import Configured
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """Profile one in ``rate`` requests and add up their statistics,
+    writing them to ``path`` every ``interval`` seconds when given."""
+
+    def __init__(self, rate, path=None, interval=60, clock=time.time):
+        self.rate = rate
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.stats = None
+            self.requests = 0
+            self.criteria = defaultdict(lambda: [0, 0.0])
+            self.last_dump = self.clock()
+
+    def start(self):
+        """Return a profile for a sampled request, or ``None``."""
+        if random.random() * self.rate < 1:
+            return cProfile.Profile()
+
+    def add(self, profile, timings=None):
+        """Add the statistics of a finished request's ``profile``, and
+        ``timings``, a dictionary of criteria names to seconds spent deciding
+        them."""
+        profile.create_stats()
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.requests += 1
+            for name, seconds in (timings or {}).items():
+                totals = self.criteria[name]
+                totals[0] += 1
+                totals[1] += seconds
+            due = self.path and (
+                self.clock() - self.last_dump >= self.interval)
+            if due:
+                self.last_dump = self.clock()
+        if due:
+            self.dump()
+
+    def dump(self):
+        """Atomically replace ``path`` with the statistics so far, with
+        ``%(pid)s`` in it replaced by the process id."""
+        with self.lock:
+            if self.stats is None or not self.path:
+                return
+            target = self.path % {'pid': os.getpid()}
+            fd, path = tempfile.mkstemp(dir=os.path.dirname(target) or '.')
+            os.close(fd)
+            try:
+                self.stats.dump_stats(path)
+                os.rename(path, target)
+            except Exception:
+                os.unlink(path)
+                logger.exception('Could not write profile %s', target)
+
+    def report(self, limit=40, sort='cumulative'):
+        """Return the ``limit`` most expensive functions by ``sort`` as
+        text."""
+        stream = StringIO()
+        with self.lock:
+            if self.stats is not None:
+                self.stats.stream = stream
+                self.stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def criteria_report(self):
+        """Return ``(name, decisions, total seconds, average seconds)`` for
+        each timed criteria, most expensive first."""
+        with self.lock:
+            rows = [(name, count, total, total / count)
+                    for name, (count, total) in self.criteria.items()]
+        return sorted(rows, key=lambda row: -row[2])
+
+
+@contextmanager
+def profiled(request):
+    """Run the block under the profile of ``request`` when it is
+    sampled."""
+    profile = getattr(request, 'affected_profile', None)
+    if profile is None:
+        yield
+        return
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+
+
+def get_profiler():
+    """Return the profiler for this process, or ``None`` when profiling is
+    not configured."""
+    return _profiler.get()
+
+
+def _build_profiler():
+    rate = getattr(settings, 'AFFECTED_PROFILE_RATE', None)
+    if not rate:
+        return None
+    profiler = Profiler(
+        rate, path=getattr(settings, 'AFFECTED_PROFILE_FILE', None),
+        interval=getattr(settings, 'AFFECTED_PROFILE_INTERVAL', 60))
+    return profiler
+
+_profiler = Configured(_build_profiler, 'AFFECTED_PROFILE',
+                       close=Profiler.dump, at_exit=True)
+
+
+def reset_profiler(**kwargs):
+    """Write and forget the profiler, so it is rebuilt from settings."""
+    _profiler.reset(**kwargs)
+
+setting_changed.connect(reset_profiler, dispatch_uid='affect_profiling')
+
+
+def start_request(request):
+    """Sample ``request`` for profiling, the parts of its handling run in
+    :func:`profiled` blocks are then profiled."""
+    profiler = get_profiler()
+    if profiler is not None:
+        profile = profiler.start()
+        if profile is not None:
+            request.affected_profile = profile
+            request.affected_timings = {}
+
+
+def finish_request(request):
+    """Add the statistics of a sampled ``request`` to the profiler."""
+    profile = getattr(request, 'affected_profile', None)
+    profiler = get_profiler()
+    if profile is not None and profiler is not None:
+        del request.affected_profile
+        profiler.add(profile, request.affected_timings)
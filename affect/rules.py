@@ -0,0 +1,787 @@
+"""Request independent evaluation of criteria.
+
+A :class:`RuleSet` is every criteria loaded up front, along with its active
+flags, users, groups and the flag conflicts, using one query per table, and
+kept as compact immutable :class:`CriteriaRecord` and :class:`FlagRecord`
+tuples rather than model instances.  It evaluates :class:`RequestContext`
+records, which the middleware builds from each request and which can be
+built without a Django ``HttpRequest`` for offline assignment.
+"""
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from itertools import chain
+from urlparse import parse_qsl, urlparse
+import calendar
+import json
+import logging
+import random
+import threading
+import time
+
+from django.test.signals import setting_changed
+
+from .analysis import analyze
+from .broadcast import get_channel
+from .expressions import (
+    NEVER, Compiler, ExpressionError, find_cycle, parse, references,
+    without_references)
+from .matching import (
+    HostIndex, LanguageIndex, PathIndex, QueryIndex, query_pairs)
+from .models import CompiledRules, Criteria, Flag, datetime
+from .networks import RangeIndex, client_address, get_geo_database
+from .snapshot import SnapshotFile
+from .utils import (
+    cookie_name, detect_user_agent, nonentry_domains, rules_version,
+    settings, testing_cookie_name)
+
+DEVICES = {
+    'mobile': Criteria.MOBILE_DEVICE,
+    'desktop': Criteria.DESKTOP_DEVICE,
+    'simple': Criteria.SIMPLE_DEVICE,
+}
+
+COMPILED_FORMAT = 4
+
+logger = logging.getLogger(__name__)
+
+
+class RequestContext(object):
+    """The parts of a request that criteria are evaluated against.
+
+    ``is_staff``, ``is_superuser`` and ``group_ids`` may be left as ``None``
+    when only ``user_id`` is known, they are then treated as unset unless
+    filled in by :func:`affect.batch.resolve_users`. ``query`` is either a
+    querystring or a dictionary, where list values behave like
+    ``QueryDict.get`` and use the last value. ``accept_language`` is the raw
+    ``Accept-Language`` header. ``ip`` is the client address, see
+    :func:`affect.networks.client_address`. ``key`` is not evaluated,
+    it identifies the context to callers of batch evaluation.
+    """
+    __slots__ = ('user_id', 'group_ids', 'is_authenticated', 'is_staff',
+                 'is_superuser', 'referrer', 'host', 'path', 'query',
+                 'user_agent', 'accept', 'accept_language', 'ip', 'cookies',
+                 'key')
+
+    def __init__(self, user_id=None, group_ids=None, is_authenticated=None,
+                 is_staff=None, is_superuser=None, referrer='', host='',
+                 path='', query=None, user_agent='', accept='',
+                 accept_language='', ip='', cookies=None, key=None):
+        if is_authenticated is None:
+            is_authenticated = user_id is not None
+        if isinstance(query, basestring):
+            query = parse_qsl(query)
+        if query and hasattr(query, 'items'):
+            query = query.items()
+        self.user_id = user_id
+        self.group_ids = group_ids
+        self.is_authenticated = is_authenticated
+        self.is_staff = is_staff
+        self.is_superuser = is_superuser
+        self.referrer = referrer or ''
+        self.host = host or ''
+        self.path = path or ''
+        self.query = {}
+        for name, value in query or ():
+            if isinstance(value, (list, tuple)):
+                if not value:
+                    continue
+                value = value[-1]
+            self.query[name] = value
+        self.cookies = cookies or {}
+        self.user_agent = user_agent or ''
+        self.accept = accept or ''
+        self.accept_language = accept_language or ''
+        self.ip = ip or ''
+        self.key = key
+
+    @classmethod
+    def from_request(cls, request, groups=True):
+        """Build a context from a request, looking up the user's group ids
+        only when ``groups`` is true."""
+        user = getattr(request, 'user', None)
+        authenticated = user is not None and user.is_authenticated()
+        group_ids = None
+        if authenticated and groups:
+            group_ids = frozenset(user.groups.values_list('pk', flat=True))
+        return cls(
+            user_id=user.pk if authenticated else None, group_ids=group_ids,
+            is_authenticated=authenticated,
+            is_staff=getattr(user, 'is_staff', False),
+            is_superuser=getattr(user, 'is_superuser', False),
+            referrer=request.META.get('HTTP_REFERER', ''),
+            host=request.META.get('HTTP_HOST', ''), path=request.path,
+            query=request.GET, user_agent=request.META.get(
+                'HTTP_USER_AGENT', ''),
+            accept=request.META.get('HTTP_ACCEPT', ''),
+            accept_language=request.META.get('HTTP_ACCEPT_LANGUAGE', ''),
+            ip=client_address(request.META), cookies=request.COOKIES)
+
+
+_EMPTY = frozenset()
+
+
+def _split(value):
+    return frozenset(value.split(',')) if value else _EMPTY
+
+
+def _countries(value):
+    return frozenset(code.strip().upper() for code in value.split(',')
+                     if code.strip())
+
+
+def _parse(criteria):
+    if not criteria.expression:
+        return None
+    try:
+        return parse(criteria.expression)
+    except ExpressionError:
+        logger.warning('Invalid expression for criteria %s', criteria.name)
+        return NEVER
+
+
+class CriteriaRecord(namedtuple('CriteriaRecord', (
+        'id', 'name', 'flags', 'persistent', 'max_cookie_age', 'everyone',
+        'testing', 'percent', 'superusers', 'staff', 'authenticated',
+        'device_type', 'entry_urls', 'referrers', 'query_args', 'users',
+        'groups', 'cookie', 'testing_cookie', 'expression', 'ip_ranges',
+        'countries', 'languages'))):
+    """Immutable runtime form of a :class:`Criteria`.
+
+    Only the fields evaluation needs are kept, with comma separated lists,
+    ``query_args`` pattern pairs and related objects precomputed into
+    frozensets and tuples, the names of its cookies formatted and its
+    expression parsed.  Records hash and compare by ``id``.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, criteria, flags=_EMPTY, users=_EMPTY, groups=_EMPTY):
+        return cls(
+            criteria.pk, criteria.name, frozenset(flags), criteria.persistent,
+            criteria.max_cookie_age, criteria.everyone, criteria.testing,
+            criteria.percent, criteria.superusers, criteria.staff,
+            criteria.authenticated, criteria.device_type,
+            _split(criteria.entry_url), _split(criteria.referrer),
+            query_pairs(criteria.query_args), frozenset(users),
+            frozenset(groups), cookie_name(criteria.name),
+            testing_cookie_name(criteria.name), _parse(criteria),
+            _split(criteria.ip_ranges), _countries(criteria.countries),
+            _split(criteria.languages))
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class FlagRecord(namedtuple('FlagRecord', (
+        'id', 'name', 'priority', 'conflicts'))):
+    """Immutable runtime form of an active :class:`Flag`, ``conflicts``
+    holds the names of active flags it conflicts with that have an equal or
+    higher priority."""
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+Matched = namedtuple('Matched', (
+    'referrer', 'referrers', 'entry_urls', 'query_args', 'networks',
+    'country', 'languages', 'values'))
+
+
+def _timestamp(value):
+    """Seconds since the epoch of a naive local or an aware datetime."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def _scheduled(obj, now, transitions):
+    """Return whether ``now`` is within the schedule of ``obj``, adding its
+    start and end to ``transitions`` when they are later."""
+    start, end = _timestamp(obj.start), _timestamp(obj.end)
+    transitions.extend(t for t in (start, end) if t is not None and t > now)
+    return (start is None or start <= now) and (end is None or now < end)
+
+
+def _pairs(through, column):
+    pairs = defaultdict(set)
+    for criteria_id, value in through.objects.values_list(
+            'criteria_id', column):
+        pairs[criteria_id].add(value)
+    return pairs
+
+
+class RuleSet(object):
+    """Every criteria and active flag, ready for evaluation.
+
+    The ``referrer``, ``entry_url``, ``query_args`` and ``languages`` of all
+    criteria are compiled into one :class:`affect.matching.HostIndex`,
+    :class:`affect.matching.PathIndex`, :class:`affect.matching.QueryIndex`
+    and :class:`affect.matching.LanguageIndex`, along with the predicates of
+    their expressions, which are compiled into one graph by
+    :class:`affect.expressions.Compiler`.  Their ``ip_ranges`` are compiled
+    into one :class:`affect.networks.RangeIndex`.  Expressions referring to an
+    unknown criteria, or back to their own, are never true.
+
+    Criteria and flags outside of their ``start`` and ``end`` are left out
+    when loading, and ``expires`` is the time of the next start or end, in
+    seconds since the epoch, after which the rule set must be rebuilt.
+    ``built`` is the time the rule set was built, identifying its version.
+
+    :func:`affect.analysis.analyze` finds the criteria :meth:`evaluate`
+    needs to decide for each request, its result is kept as ``analysis``.
+    """
+
+    def __init__(self, criteria, flags, expires=None):
+        self.criteria = tuple(criteria)
+        self.flags = flags
+        self.expires = expires
+        self.built = time.time()
+        self.uses_groups = any(record.groups for record in self.criteria)
+        self.nonentry_domains = frozenset(nonentry_domains())
+        self.by_name = dict((record.name, record) for record in self.criteria)
+        self.expressions = self._compile()
+        leaves = self.compiler.leaves
+        self.referrers = HostIndex(chain(
+            ((record, record.referrers) for record in self.criteria),
+            ((node, [node.value]) for node in leaves['referrer'])))
+        self.entry_urls = PathIndex(chain(
+            ((record, record.entry_urls) for record in self.criteria),
+            ((node, [node.value]) for node in leaves['entry_url'])))
+        self.queries = QueryIndex(chain(
+            ((record, record.query_args) for record in self.criteria),
+            ((node, [node.value]) for node in leaves['query'])))
+        self.languages = LanguageIndex(chain(
+            ((record, record.languages) for record in self.criteria),
+            ((node, [node.value]) for node in leaves['language'])))
+        self.networks = RangeIndex(
+            (record, record.ip_ranges) for record in self.criteria)
+        self.uses_countries = any(
+            record.countries for record in self.criteria)
+        self.analysis = analyze(self.criteria, flags)
+
+    def _compile(self):
+        graph = {}
+        for record in self.criteria:
+            if record.expression is not None:
+                graph[record.name] = references(record.expression)
+        self.compiler = Compiler()
+        expressions = {}
+        for record in self.criteria:
+            if record.expression is None:
+                continue
+            tree = record.expression
+            if find_cycle(graph, record.name):
+                logger.warning('Expression of criteria %s refers back to '
+                               'itself', record.name)
+                tree = NEVER
+            elif not graph[record.name] <= set(self.by_name):
+                # Unknown and unscheduled criteria are never active.
+                tree = without_references(tree, self.by_name)
+            expressions[record] = self.compiler.compile(tree)
+        return expressions
+
+    @classmethod
+    def load(cls, now=None):
+        """Build a rule set from the database with one query per table, of
+        the criteria and flags scheduled at ``now``, by default the current
+        time."""
+        if now is None:
+            now = time.time()
+        transitions = []
+        flags = dict((f.pk, f) for f in Flag.objects.filter(active=True)
+                     if _scheduled(f, now, transitions))
+        criteria_flags = defaultdict(set)
+        for criteria_id, flag_id in (
+                Criteria.flags.through.objects.values_list(
+                    'criteria_id', 'flag_id')):
+            if flag_id in flags:
+                criteria_flags[criteria_id].add(flags[flag_id].name)
+        users = _pairs(Criteria.users.through, 'user_id')
+        groups = _pairs(Criteria.groups.through, 'group_id')
+
+        conflicts = defaultdict(set)
+        for from_id, to_id in Flag.conflicts.through.objects.values_list(
+                'from_flag_id', 'to_flag_id'):
+            if from_id in flags and to_id in flags and (
+                    flags[to_id].priority >= flags[from_id].priority):
+                conflicts[from_id].add(flags[to_id].name)
+
+        return cls(
+            [CriteriaRecord.from_model(
+                criteria, criteria_flags[criteria.pk], users[criteria.pk],
+                groups[criteria.pk])
+             for criteria in Criteria.objects.defer(
+                 'note', 'created', 'modified')
+             if _scheduled(criteria, now, transitions)],
+            dict((flag.name, FlagRecord(
+                flag.pk, flag.name, flag.priority,
+                frozenset(conflicts[flag.pk]))) for flag in flags.values()),
+            min(transitions) if transitions else None)
+
+    def expired(self, now=None):
+        """Return whether a start or end has passed since loading."""
+        return self.expires is not None and (
+            (time.time() if now is None else now) >= self.expires)
+
+    def match(self, context):
+        """Parse the referrer and look up the criteria matching the
+        referrer, entry path, querystring, address and languages of
+        ``context``, and the country of the address, once for all
+        criteria."""
+        referrer = urlparse(context.referrer).hostname
+        country = None
+        if self.uses_countries and context.ip:
+            geo = get_geo_database()
+            if geo is not None:
+                country = geo.country(context.ip)
+        return Matched(referrer, self.referrers.match(referrer),
+                       self.entry_urls.match(context.path),
+                       self.queries.match(context.query),
+                       self.networks.match(context.ip), country,
+                       self.languages.match(context.accept_language), {})
+
+    def is_entry(self, context, matched):
+        """Return whether the request of ``context`` entered the site."""
+        return (matched.referrer != context.host and
+                matched.referrer not in self.nonentry_domains)
+
+    def value(self, node, context, matched):
+        """Evaluate a compiled expression node, at most once for each
+        ``matched``."""
+        values = matched.values
+        if node in values:
+            return values[node]
+        kind = node.kind
+        if kind == 'and':
+            result = all(self.value(child, context, matched)
+                         for child in node.children)
+        elif kind == 'or':
+            result = any(self.value(child, context, matched)
+                         for child in node.children)
+        elif kind == 'not':
+            result = not self.value(node.children[0], context, matched)
+        elif kind == 'authenticated':
+            result = bool(context.is_authenticated)
+        elif kind == 'staff':
+            result = bool(context.is_staff)
+        elif kind == 'superuser':
+            result = bool(context.is_superuser)
+        elif kind in DEVICES:
+            if 'device' not in values:
+                values['device'] = detect_user_agent(
+                    context.user_agent, context.accept)
+            result = values['device'] == DEVICES[kind]
+        elif kind == 'referrer':
+            result = node in matched.referrers
+        elif kind == 'entry_url':
+            result = node in matched.entry_urls and self.is_entry(
+                context, matched)
+        elif kind == 'query':
+            result = node in matched.query_args
+        elif kind == 'language':
+            result = node in matched.languages
+        elif kind == 'user':
+            result = context.user_id == node.value
+        elif kind == 'group':
+            result = node.value in (context.group_ids or ())
+        else:
+            result = self.decide(
+                self.by_name[node.value], context, matched)[0]
+        values[node] = result
+        return result
+
+    def decide(self, record, context, matched=None):
+        """Evaluate one criteria, mirroring :func:`utils.meets_criteria`.
+
+        Returns ``(active, branch)``, where ``branch`` names the field that
+        decided the outcome, or is ``None`` when nothing matched.
+        ``matched`` is the result of :meth:`match`, when evaluating many
+        criteria for one context it should be computed once and passed in,
+        and then each criteria is decided once.
+        """
+        if matched is not None:
+            decision = matched.values.get(record)
+            if decision is None:
+                decision = matched.values[record] = self._decide(
+                    record, context, matched)
+            return decision
+        return self._decide(record, context, matched)
+
+    def _decide(self, record, context, matched):
+        if record.everyone:
+            return True, 'everyone'
+        elif record.everyone is False:
+            return False, 'everyone'
+
+        if record.testing:
+            tc = record.testing_cookie
+            if tc in context.query:
+                return context.query[tc] == '1', 'testing'
+            if tc in context.cookies:
+                return context.cookies[tc] == 'True', 'testing'
+
+        cookie = record.cookie
+        if record.persistent and context.cookies.get(cookie):
+            return context.cookies[cookie] == 'True', 'persistent'
+
+        if record.authenticated and context.is_authenticated:
+            return True, 'authenticated'
+        if record.staff and context.is_staff:
+            return True, 'staff'
+        if record.superusers and context.is_superuser:
+            return True, 'superusers'
+
+        if matched is None:
+            matched = self.match(context)
+        if record in matched.referrers:
+            return True, 'referrer'
+
+        if record in matched.entry_urls and self.is_entry(context, matched):
+            return True, 'entry_url'
+
+        if record in matched.query_args:
+            return True, 'query_args'
+
+        if record in matched.networks:
+            return True, 'ip_ranges'
+        if matched.country in record.countries:
+            return True, 'countries'
+        if record in matched.languages:
+            return True, 'languages'
+
+        if record.device_type and record.device_type == (
+                detect_user_agent(context.user_agent, context.accept)):
+            return True, 'device_type'
+
+        if context.user_id is not None and context.user_id in record.users:
+            return True, 'users'
+        if context.group_ids and not record.groups.isdisjoint(
+                context.group_ids):
+            return True, 'groups'
+
+        if record in self.expressions and self.value(
+                self.expressions[record], context, matched):
+            return True, 'expression'
+
+        if record.percent > 0:
+            if cookie in context.cookies:
+                return context.cookies[cookie] == 'True', 'percent'
+            return (Decimal(str(random.uniform(0, 100))) <= record.percent,
+                    'percent')
+        return False, None
+
+    def matches(self, record, context, matched=None):
+        """Return whether one criteria is active for ``context``."""
+        return self.decide(record, context, matched)[0]
+
+    def resolve_conflicts(self, flags):
+        """Drop flags that conflict with a kept flag of equal or higher
+        priority, deciding the highest priorities first."""
+        records = sorted((self.flags[name] for name in flags),
+                         key=lambda f: (-f.priority, f.name))
+        kept = set()
+        for flag in records:
+            if flag.conflicts.isdisjoint(kept):
+                kept.add(flag.name)
+        return frozenset(kept)
+
+    def evaluate(self, context, decisions=None, timings=None):
+        """Return the frozenset of flag names active for ``context``.
+
+        Criteria whose flags are already active are skipped, unless a
+        ``decisions`` dictionary is given, which is then filled with
+        ``(active, branch)`` for every criteria the analysis kept.  A
+        ``timings`` dictionary is filled with the seconds spent deciding
+        each criteria by name.
+        """
+        matched = self.match(context)
+        analysis = self.analysis
+        flags = set(analysis.always)
+        if decisions is not None:
+            decisions.update(analysis.constant)
+        for record in analysis.evaluated:
+            if decisions is None:
+                if not record.flags or record.flags <= flags:
+                    continue
+                active = self.decide(record, context, matched)[0]
+            elif timings is None:
+                decisions[record] = self.decide(record, context, matched)
+                active = decisions[record][0]
+            else:
+                start = time.time()
+                decisions[record] = self.decide(record, context, matched)
+                timings[record.name] = time.time() - start
+                active = decisions[record][0]
+            if active:
+                flags.update(record.flags)
+        return self.resolve_conflicts(flags)
+
+
+_SETS = ('flags', 'entry_urls', 'referrers', 'users', 'groups',
+         'ip_ranges', 'countries', 'languages')
+
+
+def _tuples(value):
+    """Turn the lists of a JSON decoded expression tree back into
+    tuples."""
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    return value
+
+
+def _dumps(rules):
+    """Serialize ``rules`` to JSON, as the records it is built from."""
+    criteria = []
+    for record in rules.criteria:
+        values = record._asdict()
+        for field in _SETS:
+            values[field] = sorted(values[field])
+        if values['percent'] is not None:
+            values['percent'] = str(values['percent'])
+        criteria.append(values)
+    return json.dumps({
+        'criteria': criteria,
+        'flags': [dict(record._asdict(), conflicts=sorted(record.conflicts))
+                  for record in rules.flags.values()],
+        'expires': rules.expires,
+        'built': rules.built,
+    })
+
+
+def _loads(data):
+    """Build the rule set serialized by :func:`_dumps`."""
+    data = json.loads(data)
+    criteria = []
+    for values in data['criteria']:
+        for field in _SETS:
+            values[field] = frozenset(values[field])
+        if values['percent'] is not None:
+            values['percent'] = Decimal(values['percent'])
+        values['query_args'] = _tuples(values['query_args'])
+        values['expression'] = _tuples(values['expression'])
+        criteria.append(CriteriaRecord(**values))
+    flags = dict((values['name'], FlagRecord(
+        values['id'], values['name'], values['priority'],
+        frozenset(values['conflicts']))) for values in data['flags'])
+    rules = RuleSet(criteria, flags, data['expires'])
+    rules.built = data['built']
+    return rules
+
+
+def store_compiled(version=None):
+    """Build the rule set and store it, as JSON, in the
+    :class:`~affect.models.CompiledRules` row of the rules ``version``, by
+    default the current :func:`~affect.utils.rules_version`.  Rows of
+    earlier versions are deleted.  Returns the rule set."""
+    if version is None:
+        version = rules_version()
+    rules = RuleSet.load()
+    data = _dumps(rules)
+    row, created = CompiledRules.objects.get_or_create(
+        version=version, defaults=dict(format=COMPILED_FORMAT, data=data))
+    if created:
+        CompiledRules.objects.filter(pk__lt=row.pk).delete()
+    else:
+        # Another process stored this version first, or it expired.
+        CompiledRules.objects.filter(pk=row.pk).update(
+            format=COMPILED_FORMAT, data=data, built=datetime.now())
+    return rules
+
+
+def load_compiled(version=None):
+    """Return the rule set stored by :func:`store_compiled` for the rules
+    ``version``, by default the current one, with one query, building and
+    storing it when missing, of another format or past its next start or
+    end."""
+    if version is None:
+        version = rules_version()
+    rules = None
+    data = CompiledRules.objects.filter(
+        version=version, format=COMPILED_FORMAT).values_list(
+            'data', flat=True)
+    if data:
+        try:
+            rules = _loads(data[0])
+        except Exception:
+            logger.exception('Could not read compiled rules')
+    if rules is None or rules.expired():
+        rules = store_compiled(version)
+    return rules
+
+
+def build_rules():
+    """Load the rule set from the ``CompiledRules`` row when
+    ``AFFECTED_COMPILED_RULES`` is set, otherwise from the criteria and
+    flag tables."""
+    if getattr(settings, 'AFFECTED_COMPILED_RULES', False):
+        return load_compiled()
+    return RuleSet.load()
+
+
+def load_rules(since=None, token=None):
+    """Return a rule set for this process.
+
+    With ``AFFECTED_SNAPSHOT_FILE`` it is read from that file, which is
+    rebuilt when missing, built before ``since`` or not for the change
+    ``token``, or read after its next start or end.  Otherwise it is built
+    with :func:`build_rules`.
+    """
+    path = getattr(settings, 'AFFECTED_SNAPSHOT_FILE', None)
+    if path:
+        snapshot_file = SnapshotFile(path, build_rules)
+        rules = snapshot_file.load(since, token)
+        if rules.expired():
+            rules = snapshot_file.load(rules.expires, token)
+        return rules
+    return build_rules()
+
+
+class Snapshot(object):
+    """A reference to the current rule set, swapped atomically.
+
+    Readers call :meth:`get` without locking and always see a complete rule
+    set.  Rule sets are built by ``load`` while holding a lock, so one
+    thread builds at a time.  Once a rule set is older than ``ttl`` seconds,
+    or its ``expires`` time has passed, it is rebuilt in a background
+    thread while readers keep using it.  Rule sets read with
+    :meth:`for_version` are instead rebuilt before they are returned, when
+    the version changed or they expired.
+    """
+
+    def __init__(self, load, ttl=None, clock=time.time):
+        self.load = load
+        self.ttl = ttl
+        self.clock = clock
+        self.current = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Return the current rule set, or ``None`` before one is built."""
+        current = self.current
+        if current is None:
+            return None
+        rules, expires, version = current
+        if expires is not None and self.clock() >= expires:
+            if self.lock.acquire(False):
+                thread = threading.Thread(
+                    target=self._refresh, args=(expires,),
+                    name='affect-snapshot')
+                thread.daemon = True
+                thread.start()
+        return rules
+
+    def swap(self, rules, version=None):
+        """Make ``rules``, built for ``version``, the current rule set."""
+        expires = getattr(rules, 'expires', None)
+        if self.ttl:
+            expires = min(self.clock() + self.ttl, expires or float('inf'))
+        self.current = (rules, expires, version)
+
+    def for_version(self, version):
+        """Return the current rule set when it was built for ``version``
+        and has not expired, otherwise build one with
+        ``load(token=version)`` first."""
+        current = self.current
+        if not self._fresh(current, version):
+            with self.lock:
+                current = self.current
+                if not self._fresh(current, version):
+                    self.swap(self.load(token=version), version)
+                    current = self.current
+        return current[0]
+
+    def _fresh(self, current, version):
+        return current is not None and current[2] == version and not (
+            current[1] is not None and self.clock() >= current[1])
+
+    def fill(self, **kwargs):
+        """Return the current rule set, building it with ``load(**kwargs)``
+        when there is none."""
+        with self.lock:
+            if self.current is None:
+                self.swap(self.load(**kwargs))
+            return self.current[0]
+
+    def refresh(self, **kwargs):
+        """Build a new rule set with ``load(**kwargs)`` and swap it in."""
+        with self.lock:
+            self.swap(self.load(**kwargs))
+
+    def _refresh(self, expired):
+        try:
+            self.swap(self.load(since=expired))
+        except Exception:
+            logger.exception('Could not refresh rules')
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.current = None
+
+
+snapshot = Snapshot(load_rules)
+
+
+def get_rules():
+    """Return the rule set to evaluate requests with.
+
+    The rule set is kept in :data:`snapshot` for the process.  With a
+    broadcast channel or ``AFFECTED_SNAPSHOT_TTL`` it is read without
+    locking, and replaced by :func:`reload_rules` when a change is
+    broadcast or rebuilt in the background when older than the TTL.
+    Otherwise the :func:`~affect.utils.rules_version` token is read from
+    the cache, and the rule set is rebuilt only when it changed.
+    """
+    channel = get_channel()
+    ttl = getattr(settings, 'AFFECTED_SNAPSHOT_TTL', None)
+    if channel is None and not ttl:
+        return snapshot.for_version(rules_version())
+    rules = snapshot.get()
+    if rules is not None:
+        return rules
+    snapshot.ttl = ttl
+    if channel is not None:
+        channel.subscribe(reload_rules)
+    return snapshot.fill(since=time.time() - getattr(
+        settings, 'AFFECTED_SNAPSHOT_MAX_AGE', 600))
+
+
+def reload_rules(token=None):
+    """Load a rule set built for the change ``token`` and swap it in for
+    this process."""
+    if token is None:
+        snapshot.refresh(since=time.time())
+    else:
+        snapshot.refresh(token=token)
+
+
+def reset_rules(**kwargs):
+    """Forget this process' rule set when the channel or snapshot is
+    reconfigured."""
+    if kwargs.get('setting', 'AFFECTED_BROADCAST').startswith((
+            'AFFECTED_BROADCAST', 'AFFECTED_SNAPSHOT')):
+        snapshot.clear()
+        snapshot.ttl = None
+
+setting_changed.connect(reset_rules, dispatch_uid='affect_rules')
@@ -0,0 +1,379 @@
+"""Estimate the impact of rule changes by replaying recorded traffic.
+
+    from affect.simulate import simulate
+
+    report = simulate(contexts, {'spring_sale': {'percent': 20}})
+    for impact in report.flags:
+        ...
+
+Contexts are turned into columns once, then each criteria is decided for
+all of them with NumPy operations on boolean arrays, one per predicate.
+Referrers, paths, querystrings, addresses, languages and user agents are
+matched once for each distinct value rather than once for each record.
+Percent criteria draw the same numbers for a criteria name under both rule
+sets, so a change of ``percent`` shows its effect rather than noise.
+Requires NumPy.
+"""
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from urlparse import urlparse
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.fields import FieldDoesNotExist
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .batch import DEFAULT_CHUNK_SIZE, chunked, resolve_users
+from .models import Criteria
+from .networks import get_geo_database
+from .rules import DEVICES, CriteriaRecord, RuleSet
+from .utils import detect_user_agent, nonentry_domains
+
+RELATED_FIELDS = ('flags', 'users', 'groups')
+
+FlagImpact = namedtuple('FlagImpact', (
+    'flag', 'current', 'proposed', 'gained', 'lost', 'current_conflicts',
+    'proposed_conflicts'))
+Report = namedtuple('Report', ('records', 'changed', 'flags'))
+
+
+def _distinct(values):
+    """Return the distinct ``values`` and the index of each value in
+    them."""
+    index = {}
+    inverse = numpy.fromiter(
+        (index.setdefault(value, len(index)) for value in values),
+        numpy.intp, len(values))
+    return sorted(index, key=index.get), inverse
+
+
+def _objects(values):
+    array = numpy.empty(len(values), object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def _sparse(mappings):
+    """Turn dictionaries into ``{key: (rows, values)}`` columns."""
+    columns = {}
+    for row, mapping in enumerate(mappings):
+        for key, value in mapping.items():
+            columns.setdefault(key, ([], []))
+            columns[key][0].append(row)
+            columns[key][1].append(value)
+    return dict((key, (numpy.array(rows, numpy.intp), _objects(values)))
+                for key, (rows, values) in columns.items())
+
+
+class Columns(object):
+    """Request contexts stored as one array per field."""
+
+    def __init__(self, contexts):
+        self.size = size = len(contexts)
+        self.authenticated = numpy.fromiter(
+            (bool(c.is_authenticated) for c in contexts), bool, size)
+        self.staff = numpy.fromiter(
+            (bool(c.is_staff) for c in contexts), bool, size)
+        self.superusers = numpy.fromiter(
+            (bool(c.is_superuser) for c in contexts), bool, size)
+        self.user_ids = numpy.fromiter(
+            (-1 if c.user_id is None else c.user_id for c in contexts),
+            numpy.int64, size)
+        group_rows, group_ids = [], []
+        for row, context in enumerate(contexts):
+            for group_id in context.group_ids or ():
+                group_rows.append(row)
+                group_ids.append(group_id)
+        self.group_rows = numpy.array(group_rows, numpy.intp)
+        self.group_ids = numpy.array(group_ids, numpy.int64)
+
+        hosts = [urlparse(c.referrer).hostname for c in contexts]
+        nonentry = frozenset(nonentry_domains())
+        self.referrers = _distinct(hosts)
+        self.entry = numpy.fromiter(
+            (host != c.host and host not in nonentry
+             for host, c in zip(hosts, contexts)), bool, size)
+        self.paths = _distinct([c.path for c in contexts])
+        self.queries = _distinct(
+            [tuple(sorted(c.query.items())) for c in contexts])
+        self.ips = _distinct([c.ip for c in contexts])
+        self.languages = _distinct([c.accept_language for c in contexts])
+        agents, inverse = _distinct(
+            [(c.user_agent, c.accept) for c in contexts])
+        self.devices = numpy.array(
+            [detect_user_agent(*agent) for agent in agents],
+            numpy.int64)[inverse]
+        self.query = _sparse(c.query for c in contexts)
+        self.cookies = _sparse(c.cookies for c in contexts)
+
+    def lookup(self, column, key, expected, truthy=False):
+        """Return the rows having ``key`` (with a true value if ``truthy``)
+        and the rows where its value is ``expected``."""
+        present = numpy.zeros(self.size, bool)
+        equal = numpy.zeros(self.size, bool)
+        if key in column:
+            rows, values = column[key]
+            if truthy:
+                keep = numpy.array([bool(v) for v in values], bool)
+                rows, values = rows[keep], values[keep]
+            present[rows] = True
+            equal[rows] = values == expected
+        return present, equal
+
+
+class Decider(object):
+    """Decide the criteria of a rule set for every row of ``columns``."""
+
+    def __init__(self, rules, columns, seed=0):
+        self.rules = rules
+        self.columns = columns
+        self.seed = seed
+        self.referrers = [
+            rules.referrers.match(host) for host in columns.referrers[0]]
+        self.paths = [rules.entry_urls.match(path)
+                      for path in columns.paths[0]]
+        self.queries = [rules.queries.match(dict(query))
+                        for query in columns.queries[0]]
+        self.networks = [rules.networks.match(ip) for ip in columns.ips[0]]
+        self.languages = [rules.languages.match(header)
+                          for header in columns.languages[0]]
+        geo = get_geo_database() if rules.uses_countries else None
+        self.countries = numpy.array(
+            [geo.country(ip) if geo is not None and ip else None
+             for ip in columns.ips[0]], object)[columns.ips[1]]
+        self.values = {}
+
+    def _matched(self, matches, inverse, record):
+        return numpy.fromiter(
+            (record in m for m in matches), bool, len(matches))[inverse]
+
+    def value(self, node):
+        """Evaluate a compiled expression node for every row, once."""
+        if node not in self.values:
+            self.values[node] = self._value(node)
+        return self.values[node]
+
+    def _value(self, node):
+        columns = self.columns
+        kind = node.kind
+        if kind == 'and':
+            result = numpy.ones(columns.size, bool)
+            for child in node.children:
+                result &= self.value(child)
+        elif kind == 'or':
+            result = numpy.zeros(columns.size, bool)
+            for child in node.children:
+                result |= self.value(child)
+        elif kind == 'not':
+            result = ~self.value(node.children[0])
+        elif kind == 'authenticated':
+            result = columns.authenticated
+        elif kind == 'staff':
+            result = columns.staff
+        elif kind == 'superuser':
+            result = columns.superusers
+        elif kind in DEVICES:
+            result = columns.devices == DEVICES[kind]
+        elif kind == 'referrer':
+            result = self._matched(self.referrers, columns.referrers[1], node)
+        elif kind == 'entry_url':
+            result = self._matched(
+                self.paths, columns.paths[1], node) & columns.entry
+        elif kind == 'query':
+            result = self._matched(self.queries, columns.queries[1], node)
+        elif kind == 'language':
+            result = self._matched(
+                self.languages, columns.languages[1], node)
+        elif kind == 'user':
+            result = columns.user_ids == node.value
+        elif kind == 'group':
+            result = numpy.zeros(columns.size, bool)
+            result[columns.group_rows[columns.group_ids == node.value]] = True
+        else:
+            result = self.decide(self.rules.by_name[node.value])
+        return result
+
+    def draws(self, name):
+        """Numbers between 0 and 100 drawn for each row, the same for a
+        criteria name whatever the rule set."""
+        state = numpy.random.RandomState(
+            (self.seed + zlib.crc32(name)) & 0xffffffff)
+        return state.uniform(0, 100, self.columns.size)
+
+    def decide(self, record):
+        """Return the rows ``record`` is active for, deciding each row with
+        the first matching branch in the order of
+        :meth:`affect.rules.RuleSet.decide`."""
+        columns = self.columns
+        if record.everyone is not None:
+            return numpy.repeat(bool(record.everyone), columns.size)
+        active = numpy.zeros(columns.size, bool)
+        decided = numpy.zeros(columns.size, bool)
+
+        def apply(hits, values=True):
+            hits = hits & ~decided
+            active[hits] = values if values is True else values[hits]
+            decided[hits] = True
+
+        if record.testing:
+            key = record.testing_cookie
+            apply(*columns.lookup(columns.query, key, '1'))
+            apply(*columns.lookup(columns.cookies, key, 'True'))
+        cookie = record.cookie
+        if record.persistent:
+            apply(*columns.lookup(columns.cookies, cookie, 'True', True))
+        if record.authenticated:
+            apply(columns.authenticated)
+        if record.staff:
+            apply(columns.staff)
+        if record.superusers:
+            apply(columns.superusers)
+        if record.referrers:
+            apply(self._matched(
+                self.referrers, columns.referrers[1], record))
+        if record.entry_urls:
+            apply(self._matched(self.paths, columns.paths[1], record) &
+                  columns.entry)
+        if record.query_args:
+            apply(self._matched(self.queries, columns.queries[1], record))
+        if record.ip_ranges:
+            apply(self._matched(self.networks, columns.ips[1], record))
+        if record.countries:
+            apply(numpy.in1d(self.countries, list(record.countries)))
+        if record.languages:
+            apply(self._matched(
+                self.languages, columns.languages[1], record))
+        if record.device_type:
+            apply(columns.devices == record.device_type)
+        if record.users:
+            apply(numpy.in1d(columns.user_ids, list(record.users)))
+        if record.groups:
+            hits = numpy.zeros(columns.size, bool)
+            hits[columns.group_rows[
+                numpy.in1d(columns.group_ids, list(record.groups))]] = True
+            apply(hits)
+        if record in self.rules.expressions:
+            apply(self.value(self.rules.expressions[record]))
+        if record.percent > 0:
+            apply(*columns.lookup(columns.cookies, cookie, 'True'))
+            apply(numpy.ones(columns.size, bool),
+                  self.draws(record.name) <= float(record.percent))
+        return active
+
+    def assign(self):
+        """Return ``(matched, kept)``, dictionaries of flag names to the
+        rows their criteria matched and the rows that keep them after
+        conflicts are resolved."""
+        matched = {}
+        for record in self.rules.criteria:
+            if not record.flags:
+                continue
+            active = self.decide(record)
+            for name in record.flags:
+                if name in matched:
+                    matched[name] = matched[name] | active
+                else:
+                    matched[name] = active
+        kept = {}
+        for flag in sorted(self.rules.flags.values(),
+                           key=lambda f: (-f.priority, f.name)):
+            if flag.name not in matched:
+                continue
+            rows = matched[flag.name]
+            for name in flag.conflicts:
+                if name in kept:
+                    rows = rows & ~kept[name]
+            kept[flag.name] = rows
+        return matched, kept
+
+
+def propose(rules, changes):
+    """Return a copy of ``rules`` with ``changes`` applied, without saving
+    anything.
+
+    ``changes`` maps criteria names to dictionaries of :class:`Criteria`
+    field values, where ``flags`` lists flag names and ``users`` and
+    ``groups`` list ids, or to ``None`` to remove the criteria.  Unknown
+    names add criteria.  Raises ``ValueError`` for unknown flags or fields
+    and invalid percents.
+    """
+    existing = dict((record.name, record) for record in rules.criteria)
+    models = dict((criteria.name, criteria)
+                  for criteria in Criteria.objects.filter(name__in=changes))
+    criteria = [r for r in rules.criteria if r.name not in changes]
+    new_id = 0
+    for name, fields in sorted(changes.items()):
+        if fields is None:
+            continue
+        record = existing.get(name)
+        model = models.get(name) or Criteria(name=name)
+        if model.pk is None:
+            new_id -= 1
+            model.pk = new_id
+        related = {}
+        for field in RELATED_FIELDS:
+            related[field] = fields.get(
+                field, getattr(record, field, ()) if record else ())
+        unknown = set(related['flags']) - set(rules.flags)
+        if unknown:
+            raise ValueError('Unknown or inactive flags for %s: %s' % (
+                name, ', '.join(sorted(unknown))))
+        for field, value in fields.items():
+            if field in RELATED_FIELDS:
+                continue
+            try:
+                Criteria._meta.get_field(field)
+            except FieldDoesNotExist:
+                raise ValueError('Unknown field for %s: %s' % (name, field))
+            if field == 'percent' and value is not None:
+                try:
+                    value = Decimal(str(value))
+                except InvalidOperation:
+                    raise ValueError('Invalid percent for %s: %r' % (
+                        name, value))
+            setattr(model, field, value)
+        criteria.append(CriteriaRecord.from_model(
+            model, related['flags'], related['users'], related['groups']))
+    return RuleSet(criteria, rules.flags)
+
+
+def simulate(contexts, changes, rules=None, seed=0,
+             chunk_size=DEFAULT_CHUNK_SIZE):
+    """Compare the flags ``contexts`` get from ``rules``, by default the
+    current rule set, and from ``rules`` with ``changes`` applied as in
+    :func:`propose`.
+
+    Returns a :class:`Report` of the number of records, how many of them
+    would get different flags, and a :class:`FlagImpact` for each flag
+    either rule set gives to some record.
+    """
+    if numpy is None:
+        raise ImproperlyConfigured('Simulating rule changes requires NumPy.')
+    if rules is None:
+        rules = RuleSet.load()
+    proposed = propose(rules, changes)
+    resolved = []
+    for chunk in chunked(contexts, chunk_size):
+        resolved.extend(resolve_users(chunk))
+    columns = Columns(resolved)
+
+    current_matched, current = Decider(rules, columns, seed).assign()
+    proposed_matched, proposed_kept = Decider(
+        proposed, columns, seed).assign()
+    none = numpy.zeros(columns.size, bool)
+    changed = none.copy()
+    impacts = []
+    for name in sorted(set(current_matched) | set(proposed_matched)):
+        before = current.get(name, none)
+        after = proposed_kept.get(name, none)
+        changed |= before != after
+        impacts.append(FlagImpact(
+            name, int(before.sum()), int(after.sum()),
+            int((after & ~before).sum()), int((before & ~after).sum()),
+            int((current_matched.get(name, none) & ~before).sum()),
+            int((proposed_matched.get(name, none) & ~after).sum())))
+    return Report(columns.size, int(changed.sum()), impacts)
@@ -0,0 +1,92 @@
+"""Share one built rule set between the processes of a host through a file.
+
+The file starts with a fixed header, holding the time the rule set was
+built and the rules version or broadcast change token it was built for,
+followed by the pickled rule set.  It is replaced with an atomic rename, so
+readers open whichever complete file is current without locking, and is
+rebuilt by one process at a time under an exclusive lock on
+``<path>.lock``.  The others wait for the lock and then read the new file
+instead of each querying the database.  Each process reads the file once
+per version and keeps the unpickled rule set in memory.
+"""
+from contextlib import contextmanager
+import cPickle as pickle
+import fcntl
+import logging
+import os
+import struct
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'AFRS'
+FORMAT = 1
+HEADER = struct.Struct('!4sB32sd')
+
+
+class SnapshotFile(object):
+    """A rule set file at ``path``, built by calling ``build``."""
+
+    def __init__(self, path, build):
+        self.path = path
+        self.build = build
+
+    def read(self, since=None, token=None):
+        """Return the rule set in the file, or ``None`` when it is missing,
+        unreadable, built before ``since`` or not for ``token``."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            if len(data) < HEADER.size:
+                return None
+            magic, version, built_for, built = HEADER.unpack_from(data)
+            if magic != MAGIC or version != FORMAT:
+                return None
+            if since is not None and built < since:
+                return None
+            if token is not None and built_for.rstrip('\0') != token[:32]:
+                return None
+            return pickle.loads(data[HEADER.size:])
+        except Exception:
+            logger.exception('Could not read rule snapshot %s', self.path)
+            return None
+
+    def write(self, rules, built, token=None):
+        """Atomically replace the file with ``rules``, built at the time
+        ``built`` for ``token``."""
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FORMAT, token or '', built))
+                pickle.dump(rules, f, pickle.HIGHEST_PROTOCOL)
+            os.chmod(path, 0644)
+            os.rename(path, self.path)
+        except Exception:
+            os.unlink(path)
+            raise
+
+    @contextmanager
+    def locked(self):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load(self, since=None, token=None):
+        """Return the rule set in the file, first rebuilding it when it is
+        missing, built before ``since`` or not for ``token``."""
+        rules = self.read(since, token)
+        if rules is None:
+            with self.locked():
+                rules = self.read(since, token)
+                if rules is None:
+                    built = time.time()
+                    rules = self.build()
+                    self.write(rules, built, token)
+        return rules
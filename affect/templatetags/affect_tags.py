@@ -0,0 +1,63 @@
+from django.template import (
+    Library, Node, TemplateSyntaxError, VariableDoesNotExist)
+
+from ..fragments import active_flags, cached_fragment, flag_names
+
+register = Library()
+
+
+class CacheAffectedNode(Node):
+    def __init__(self, nodelist, timeout, name, flags, vary_on):
+        self.nodelist = nodelist
+        self.timeout = timeout
+        self.name = name
+        self.flags = flags
+        self.vary_on = vary_on
+
+    def render(self, context):
+        try:
+            timeout = int(self.timeout.resolve(context))
+        except VariableDoesNotExist:
+            raise TemplateSyntaxError(
+                '"cache_affected" tag got an unknown variable: %r' % (
+                    self.timeout.var))
+        except (ValueError, TypeError):
+            raise TemplateSyntaxError(
+                '"cache_affected" tag got a non-integer timeout')
+        active = active_flags(context, flag_names(
+            [flag.resolve(context) for flag in self.flags]))
+        vary_on = [value.resolve(context) for value in self.vary_on]
+        return cached_fragment(self.name, timeout, active, vary_on,
+                               lambda: self.nodelist.render(context))
+
+
+@register.tag
+def cache_affected(parser, token):
+    """Cache a fragment once for each combination of the given flags.
+
+    Usage::
+
+        {% load affect_tags %}
+        {% cache_affected [timeout] [fragment_name] [flag] .. %}
+            .. markup depending on the flags ..
+        {% endcache_affected %}
+
+    Flags are names or lists of names.  Values after ``vary_on`` are added
+    to the key like the arguments of ``{% cache %}``::
+
+        {% cache_affected 600 header 'rev_b' vary_on LANGUAGE_CODE %}
+    """
+    nodelist = parser.parse(('endcache_affected',))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 4:
+        raise TemplateSyntaxError(
+            '%r tag requires a timeout, a fragment name and flags' % bits[0])
+    flags, vary_on = bits[3:], []
+    if 'vary_on' in flags:
+        index = flags.index('vary_on')
+        flags, vary_on = flags[:index], flags[index + 1:]
+    return CacheAffectedNode(
+        nodelist, parser.compile_filter(bits[1]), bits[2],
+        [parser.compile_filter(flag) for flag in flags],
+        [parser.compile_filter(value) for value in vary_on])
@@ -0,0 +1,108 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from affect.models import Criteria, Flag
+from affect.rules import RequestContext, RuleSet
+
+
+class AnalyzeTest(TestCase):
+    def setUp(self):
+        self.flag = Flag.objects.create(name='test_flag')
+
+    def criteria(self, name, flags=(), **fields):
+        crit = Criteria.objects.create(name=name, **fields)
+        crit.flags.add(*flags)
+        return crit
+
+    def test_everyone(self):
+        self.criteria('on', [self.flag], everyone=True)
+        self.criteria('off', [Flag.objects.create(name='off_flag')],
+                      everyone=False, persistent=True)
+        rules = RuleSet.load()
+        analysis = rules.analysis
+        self.assertEqual(analysis.evaluated, ())
+        self.assertEqual(analysis.always, frozenset(['test_flag']))
+        self.assertDictEqual(
+            dict((r.name, d) for r, d in analysis.constant.items()),
+            {'on': (True, 'everyone'), 'off': (False, 'everyone')})
+
+        decisions = {}
+        self.assertEqual(rules.evaluate(RequestContext(), decisions),
+                         frozenset(['test_flag']))
+        self.assertDictEqual(
+            dict((r.name, d) for r, d in decisions.items()),
+            {'on': (True, 'everyone'), 'off': (False, 'everyone')})
+
+    def test_dropped(self):
+        self.criteria('flagless', staff=True)
+        self.criteria('inactive', [Flag.objects.create(
+            name='inactive_flag', active=False)], staff=True)
+        self.criteria('referenced', percent=50)
+        self.criteria('user', [self.flag], expression='criteria:referenced')
+        analysis = RuleSet.load().analysis
+        self.assertListEqual(
+            sorted(r.name for r in analysis.evaluated),
+            ['referenced', 'user'])
+        self.assertListEqual(analysis.dropped, [
+            ('flagless', 'has no active flags'),
+            ('inactive', 'has no active flags')])
+
+    def test_flags_always_losing(self):
+        winner = Flag.objects.create(name='winner', priority=10)
+        loser = Flag.objects.create(name='loser', priority=1)
+        winner.conflicts.add(loser)
+        self.criteria('for_everyone', [winner], everyone=True)
+        self.criteria('losing', [loser], staff=True)
+        self.criteria('mixed', [loser, self.flag], staff=True)
+        rules = RuleSet.load()
+        analysis = rules.analysis
+        self.assertDictEqual(analysis.dead_flags, {'loser': 'winner'})
+        self.assertListEqual(
+            analysis.dropped, [('losing', 'its flags always lose to winner')])
+        self.assertListEqual(
+            [r.name for r in analysis.evaluated], ['mixed'])
+        self.assertEqual(
+            rules.evaluate(RequestContext(is_staff=True)),
+            frozenset(['winner', 'test_flag']))
+
+    def test_winner_that_may_lose_is_not_kept(self):
+        top = Flag.objects.create(name='top', priority=20)
+        winner = Flag.objects.create(name='winner', priority=10)
+        loser = Flag.objects.create(name='loser', priority=1)
+        winner.conflicts.add(loser, top)
+        self.criteria('for_everyone', [winner], everyone=True)
+        self.criteria('top', [top], staff=True)
+        self.criteria('losing', [loser], authenticated=True)
+        rules = RuleSet.load()
+        self.assertDictEqual(rules.analysis.dead_flags, {})
+        self.assertEqual(
+            rules.evaluate(RequestContext(
+                is_authenticated=True, is_staff=True)),
+            frozenset(['top', 'loser']))
+
+    def test_redundant(self):
+        self.criteria(
+            'test_crit', [self.flag], authenticated=True, staff=True,
+            referrer='*.example.com,www.example.com,news.*,news.ex.com,'
+            'other.com', entry_url='/blog/*,/blog/a,re:/blog/.*,/about')
+        self.assertListEqual(RuleSet.load().analysis.redundant, [
+            ('test_crit', 'entry_url /blog/a is covered by /blog/*'),
+            ('test_crit', 'referrer news.ex.com is covered by news.*'),
+            ('test_crit', 'referrer www.example.com is covered by '
+             '*.example.com'),
+            ('test_crit', 'staff never decides it, authenticated is tried '
+             'first')])
+
+
+class AnalysisAdminTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+
+    def test_analysis(self):
+        Criteria.objects.create(name='test_crit', staff=True)
+        response = self.client.get('/admin/affect/criteria/')
+        self.assertContains(response, '<a href="analysis/">Analysis</a>')
+        response = self.client.get('/admin/affect/criteria/analysis/')
+        self.assertContains(response, '1 criteria: 0 evaluated')
+        self.assertContains(response, 'test_crit has no active flags')
@@ -0,0 +1,207 @@
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+import mox
+
+from affect import assignments as assignments_module
+from affect.assignments import (
+    CacheStore, ModelStore, StickyAssignments, get_assignments)
+from affect.middleware import AffectMiddleware
+from affect.models import Assignment, Criteria, Flag
+from affect.rules import RuleSet
+from affect.tests.helpers import Clock
+
+
+class MemoryStore(object):
+    def __init__(self):
+        self.saved = []
+        self.assignments = {}
+
+    def load(self, user_id):
+        return self.assignments.get(user_id, {})
+
+    def save(self, assignments):
+        self.saved.append(dict(assignments))
+        self.assignments.update(assignments)
+
+
+class BrokenStore(object):
+    def load(self, user_id):
+        raise IOError
+
+    def save(self, assignments):
+        raise IOError
+
+
+class StickyAssignmentsTest(TestCase):
+    def setUp(self):
+        crit = Criteria.objects.create(name='split', percent=50)
+        Criteria.objects.create(name='beta', testing=True)
+        rules = RuleSet.load()
+        self.split, = [r for r in rules.criteria if r.name == 'split']
+        self.beta, = [r for r in rules.criteria if r.name == 'beta']
+        self.crit = crit
+        self.clock = Clock()
+        self.store = MemoryStore()
+        self.assignments = StickyAssignments(
+            self.store, batch_size=2, flush_interval=10, clock=self.clock,
+            background=False)
+
+    def test_unchanged_not_written(self):
+        self.assertIs(self.assignments.update(
+            1, {'dac_split': True}, {self.split: True}), True)
+        self.assertDictEqual(self.assignments.pending, {})
+        self.assertListEqual(self.store.saved, [])
+
+    def test_first_decision_written(self):
+        self.assertIs(self.assignments.update(
+            1, {'dac_split': False}, {self.split: False}, {self.beta: True}),
+            True)
+        self.assertListEqual(self.store.saved, [
+            {1: {'dac_split': False, 'dact_beta': True}}])
+        self.assertDictEqual(self.assignments.pending, {})
+
+    def test_pending_loaded(self):
+        self.assertDictEqual(self.assignments.load(1), {})
+        self.assignments.update(
+            1, {'dac_split': True, 'dact_beta': False},
+            {self.split: False}, {self.beta: True})
+        self.assertDictEqual(self.assignments.load(1), {
+            'dac_split': False, 'dact_beta': True})
+        self.assertListEqual(self.store.saved, [])
+
+    def test_flush_on_batch_size(self):
+        self.assignments.update(1, {'dac_split': False}, {self.split: True})
+        self.assertListEqual(self.store.saved, [])
+        self.assignments.update(2, {'dac_split': True}, {self.split: False})
+        self.assertListEqual(self.store.saved, [
+            {1: {'dac_split': True}, 2: {'dac_split': False}}])
+        self.assertDictEqual(self.assignments.pending, {})
+        self.assertDictEqual(self.assignments.load(2), {'dac_split': False})
+
+    def test_flush_on_interval(self):
+        self.assignments.update(1, {'dac_split': False}, {self.split: True})
+        self.clock.now += 10
+        self.assignments.update(2, {'dac_split': True}, {self.split: False})
+        self.assertListEqual(self.store.saved, [
+            {1: {'dac_split': True}, 2: {'dac_split': False}}])
+
+    def test_background_flush(self):
+        assignments = StickyAssignments(self.store, batch_size=1)
+        assignments.update(1, {'dac_split': False}, {self.split: True})
+        with assignments.flushing:
+            self.assertListEqual(self.store.saved, [{1: {'dac_split': True}}])
+
+    def test_store_errors(self):
+        assignments = StickyAssignments(
+            BrokenStore(), batch_size=1, background=False)
+        self.assertIs(assignments.load(1), None)
+        self.assertIs(assignments.update(1, {}, {self.split: True}), False)
+        assignments.update(1, {'dac_split': False}, {self.split: True})
+        self.assertDictEqual(assignments.pending, {})
+
+    def test_dropped_users_logged(self):
+        assignments = StickyAssignments(
+            BrokenStore(), batch_size=2, background=False)
+        mock = mox.Mox()
+        mock.StubOutWithMock(assignments_module.logger, 'exception')
+        assignments_module.logger.exception(
+            'Dropped assignments of users %s', '2, 7')
+        mock.ReplayAll()
+        try:
+            assignments.update(7, {'dac_split': False}, {self.split: True})
+            assignments.update(2, {'dac_split': False}, {self.split: True})
+            mock.VerifyAll()
+        finally:
+            mock.UnsetStubs()
+
+
+class CacheStoreTest(TestCase):
+    def setUp(self):
+        self.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache',
+            LOCATION='affect-assignments')
+        self.cache.clear()
+        self.store = CacheStore(cache=self.cache)
+
+    def test_save_and_load(self):
+        self.assertDictEqual(self.store.load(1), {})
+        self.store.save({1: {'dac_split': True}, 2: {'dac_split': False}})
+        self.assertDictEqual(self.store.load(1), {'dac_split': True})
+        self.assertEqual(
+            self.cache.get('affect_assignment:2'), {'dac_split': False})
+
+
+class ModelStoreTest(TestCase):
+    def test_save_and_load(self):
+        user = User.objects.create(username='test_user')
+        other = User.objects.create(username='other_user')
+        store = ModelStore()
+        self.assertDictEqual(store.load(user.pk), {})
+        store.save({user.pk: {'dac_split': True}})
+        with self.assertNumQueries(5):
+            store.save({user.pk: {'dac_split': False},
+                        other.pk: {'dact_beta': True}})
+        with self.assertNumQueries(1):
+            self.assertDictEqual(store.load(user.pk), {'dac_split': False})
+        self.assertDictEqual(
+            Assignment.objects.get(user=other).decisions, {'dact_beta': True})
+
+
+class AssignmentMiddlewareTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_user')
+        self.crit = Criteria.objects.create(
+            name='split', percent=50, superusers=False)
+        self.crit.flags.add(Flag.objects.create(name='split_flag'))
+        self.mw = AffectMiddleware()
+
+    def request(self, user, cookies=None):
+        request = RequestFactory().get('')
+        request.user = user
+        request.COOKIES.update(cookies or {})
+        self.mw.process_request(request)
+        return request, self.mw.process_response(request, HttpResponse())
+
+    def test_off_by_default(self):
+        self.assertIs(get_assignments(), None)
+
+    def test_consistent_across_devices(self):
+        with self.settings(
+                AFFECTED_ASSIGNMENT_STORE='affect.assignments.ModelStore',
+                AFFECTED_ASSIGNMENT_BATCH_SIZE=1):
+            first, response = self.request(self.user)
+            self.assertDictEqual(response.cookies, {})
+            decisions = Assignment.objects.get(user=self.user).decisions
+            self.assertEqual(decisions.keys(), ['dac_split'])
+            for _ in range(10):
+                request, response = self.request(self.user, {
+                    'dac_split': str(not decisions['dac_split'])})
+                self.assertEqual(request.affected_flags, first.affected_flags)
+                self.assertDictEqual(response.cookies, {})
+
+    def test_browser_decision_kept(self):
+        with self.settings(
+                AFFECTED_ASSIGNMENT_STORE='affect.assignments.ModelStore',
+                AFFECTED_ASSIGNMENT_BATCH_SIZE=1):
+            request, response = self.request(
+                self.user, {'dac_split': 'True'})
+            self.assertEqual(request.affected_flags, frozenset(['split_flag']))
+            self.assertDictEqual(
+                Assignment.objects.get(user=self.user).decisions,
+                {'dac_split': True})
+
+    def test_cookies_kept_when_store_fails(self):
+        with self.settings(
+                AFFECTED_ASSIGNMENT_STORE='affect.assignments.ModelStore'):
+            mock = mox.Mox()
+            mock.StubOutWithMock(ModelStore, 'save')
+            ModelStore.save(mox.IgnoreArg()).AndRaise(IOError)
+
+            mock.ReplayAll()
+            request, response = self.request(self.user)
+            mock.VerifyAll()
+            mock.UnsetStubs()
+            self.assertListEqual(response.cookies.keys(), ['dac_split'])
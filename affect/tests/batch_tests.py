@@ -0,0 +1,96 @@
+from django.contrib.auth.models import Group, User
+from django.test import TestCase
+
+from affect.batch import (
+    chunked, context_from_record, evaluate_batch, resolve_users)
+from affect.models import Criteria, Flag
+from affect.rules import RequestContext, RuleSet
+
+
+class ChunkedTest(TestCase):
+    def test_chunks(self):
+        self.assertListEqual(
+            list(chunked(xrange(5), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_empty(self):
+        self.assertListEqual(list(chunked([], 2)), [])
+
+
+class ContextFromRecordTest(TestCase):
+    def test_csv_strings(self):
+        context = context_from_record({
+            'id': 'a', 'user_id': '3', 'groups': '1,2', 'is_staff': 'true',
+            'is_superuser': '', 'cookies': '{"dac_test": "True"}',
+            'query': 'foo=bar', 'path': '/'})
+        self.assertEqual(context.key, 'a')
+        self.assertEqual(context.user_id, 3)
+        self.assertEqual(context.group_ids, frozenset([1, 2]))
+        self.assertIs(context.is_staff, True)
+        self.assertIs(context.is_superuser, None)
+        self.assertDictEqual(context.cookies, {'dac_test': 'True'})
+        self.assertDictEqual(context.query, {'foo': 'bar'})
+        self.assertEqual(context.path, '/')
+
+    def test_empty_values_unresolved(self):
+        context = context_from_record({'user_id': '', 'groups': ''})
+        self.assertIs(context.user_id, None)
+        self.assertIs(context.group_ids, None)
+        self.assertEqual(context.referrer, '')
+
+
+class ResolveUsersTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='test_group')
+        self.user = User.objects.create(username='test_user', is_staff=True)
+        self.user.groups.add(self.group)
+
+    def test_resolve(self):
+        known = RequestContext(
+            user_id=self.user.pk, group_ids=[], is_staff=False,
+            is_superuser=False)
+        missing = RequestContext(user_id=self.user.pk + 100)
+        context = RequestContext(user_id=self.user.pk)
+
+        with self.assertNumQueries(2):
+            resolve_users([known, missing, context, RequestContext()])
+
+        self.assertIs(context.is_staff, True)
+        self.assertIs(context.is_superuser, False)
+        self.assertEqual(context.group_ids, frozenset([self.group.pk]))
+        self.assertIs(known.is_staff, False)
+        self.assertListEqual(known.group_ids, [])
+        self.assertIs(missing.is_staff, False)
+        self.assertEqual(missing.group_ids, frozenset())
+
+    def test_nothing_to_resolve(self):
+        with self.assertNumQueries(0):
+            resolve_users([RequestContext()])
+
+
+class EvaluateBatchTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='test_group')
+        self.users = [User.objects.create(username='user%s' % i)
+                      for i in range(5)]
+        self.users[1].groups.add(self.group)
+        crit = Criteria.objects.create(name='test_crit')
+        crit.groups.add(self.group)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+        self.contexts = [RequestContext(user_id=u.pk) for u in self.users]
+
+    def test_evaluate(self):
+        results = list(evaluate_batch(iter(self.contexts), chunk_size=2))
+        self.assertListEqual([c for c, _ in results], self.contexts)
+        self.assertListEqual(
+            [flags for _, flags in results],
+            [frozenset(), frozenset(['test_flag']), frozenset(), frozenset(),
+             frozenset()])
+
+    def test_evaluate_in_processes(self):
+        rules = RuleSet.load()
+        results = list(evaluate_batch(
+            self.contexts, rules=rules, chunk_size=1, processes=2))
+        self.assertListEqual([c for c, _ in results], self.contexts)
+        self.assertListEqual(
+            [bool(flags) for _, flags in results],
+            [False, True, False, False, False])
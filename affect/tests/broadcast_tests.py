@@ -0,0 +1,194 @@
+from Queue import Queue
+from collections import defaultdict
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import TestCase
+import mox
+
+from affect import rules, utils
+from affect.broadcast import (
+    Channel, FileChannel, RedisChannel, get_channel, publish)
+from affect.models import Criteria, Flag
+from affect.rules import RuleSet, get_rules
+
+
+class LocalRedis(object):
+    """Stand-in for the publish and pubsub methods of a Redis client."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+
+    def publish(self, channel, message):
+        for queue in self.subscribers[channel]:
+            queue.put({'type': 'message', 'channel': channel,
+                       'data': message})
+        return len(self.subscribers[channel])
+
+    def pubsub(self):
+        return LocalPubSub(self)
+
+
+class LocalPubSub(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.queue = Queue()
+        self.channels = []
+
+    def subscribe(self, channel):
+        self.redis.subscribers[channel].append(self.queue)
+        self.channels.append(channel)
+        self.queue.put({'type': 'subscribe', 'channel': channel, 'data': 1})
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+    def close(self):
+        for channel in self.channels:
+            self.redis.subscribers[channel].remove(self.queue)
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out waiting')
+        time.sleep(0.01)
+
+
+class FileChannelTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.channel = FileChannel(
+            os.path.join(self.dir, 'rules'), interval=0.01)
+
+    def tearDown(self):
+        self.channel.close()
+        shutil.rmtree(self.dir)
+
+    def test_publish(self):
+        self.assertIs(self.channel.version(), None)
+        self.channel.publish()
+        version = self.channel.version()
+        self.channel.publish()
+        self.assertNotEqual(self.channel.version(), version)
+        self.assertListEqual(os.listdir(self.dir), ['rules'])
+
+    def test_subscribe(self):
+        changes = []
+        self.channel.subscribe(changes.append)
+        wait_for(lambda: self.channel.thread.is_alive())
+        time.sleep(0.05)
+        self.assertListEqual(changes, [])
+        self.channel.publish()
+        wait_for(lambda: changes)
+        self.assertListEqual(changes, [self.channel.version()])
+        self.channel.close()
+        self.channel.thread.join(1)
+        self.assertFalse(self.channel.thread.is_alive())
+
+
+class RedisChannelTest(TestCase):
+    def setUp(self):
+        self.redis = LocalRedis()
+        self.channel = RedisChannel(client=self.redis, channel='test')
+
+    def test_subscribe(self):
+        tokens = Queue()
+        self.channel.subscribe(tokens.put)
+        self.channel.subscribe(tokens.put)
+        self.assertEqual(len(self.channel.callbacks), 1)
+        wait_for(lambda: self.redis.subscribers['test'])
+        self.channel.publish()
+        self.assertEqual(len(tokens.get(timeout=5)), 32)
+        self.channel.close()
+        self.channel.publish()
+        self.channel.thread.join(1)
+        self.assertListEqual(self.redis.subscribers['test'], [])
+
+
+class ChannelTest(TestCase):
+    def test_retry_notifies(self):
+        class BrokenChannel(Channel):
+            retry_delay = 0.01
+
+            def listen(self):
+                raise IOError
+
+        channel = BrokenChannel()
+        tokens = Queue()
+        channel.subscribe(tokens.put)
+        self.assertIs(tokens.get(timeout=5), None)
+        channel.close()
+
+    def test_subscriber_error(self):
+        def fail(token):
+            raise ValueError
+        changes = []
+        channel = Channel()
+        channel.callbacks = [fail, changes.append]
+        channel.notify('token')
+        self.assertListEqual(changes, ['token'])
+
+
+class BroadcastTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'rules')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_not_configured(self):
+        self.assertIs(get_channel(), None)
+        publish()
+
+    def test_publish_error_logged(self):
+        with self.settings(AFFECTED_BROADCAST='affect.broadcast.FileChannel',
+                           AFFECTED_BROADCAST_FILE='/nonexistent/rules'):
+            publish()
+
+    def test_settings(self):
+        with self.settings(AFFECTED_BROADCAST='affect.broadcast.FileChannel',
+                           AFFECTED_BROADCAST_FILE=self.path):
+            channel = get_channel()
+            self.assertEqual(channel.path, self.path)
+            self.assertIs(get_channel(), channel)
+        self.assertTrue(channel.closed.is_set())
+        self.assertIs(get_channel(), None)
+
+    def test_rules_swapped_on_change(self):
+        first, second = RuleSet([], {}), RuleSet([], {})
+        mock = mox.Mox()
+        mock.StubOutWithMock(rules.snapshot, 'load')
+        rules.snapshot.load(since=mox.IsA(float)).AndReturn(first)
+        rules.snapshot.load(token=mox.IsA(str)).AndReturn(second)
+
+        mock.ReplayAll()
+        with self.settings(AFFECTED_BROADCAST='affect.broadcast.FileChannel',
+                           AFFECTED_BROADCAST_FILE=self.path,
+                           AFFECTED_BROADCAST_INTERVAL=0.01):
+            self.assertIs(get_rules(), first)
+            self.assertIs(get_rules(), first)
+            wait_for(lambda: get_channel().thread.is_alive())
+            time.sleep(0.05)
+            publish()
+            wait_for(lambda: get_rules() is second)
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+    def test_changes_published_once(self):
+        utils.flush_invalidations()
+        mock = mox.Mox()
+        mock.StubOutWithMock(utils, 'publish')
+        utils.publish()
+
+        mock.ReplayAll()
+        Criteria.objects.create(name='test_crit')
+        Flag.objects.create(name='test_flag')
+        utils.flush_invalidations()
+        mock.VerifyAll()
+        mock.UnsetStubs()
@@ -0,0 +1,73 @@
+from django.db import connections
+from django.test import TestCase
+import mox
+
+from affect.buffering import Buffered
+from affect.tests.helpers import Clock
+
+
+class ListBuffer(Buffered):
+    def __init__(self, **kwargs):
+        self.written_batches = []
+        super(ListBuffer, self).__init__(**kwargs)
+
+    def empty(self):
+        return []
+
+    def add(self, item):
+        with self.lock:
+            self.pending.append(item)
+            due = self.due(self.clock())
+        if due:
+            self.flush_soon()
+
+    def write(self, items):
+        if None in items:
+            raise IOError
+        self.written_batches.append(items)
+
+
+class BufferedTest(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.buffer = ListBuffer(batch_size=2, clock=self.clock)
+
+    def test_batch_size(self):
+        self.buffer.add(1)
+        self.assertListEqual(self.buffer.written_batches, [])
+        self.buffer.add(2)
+        self.assertListEqual(self.buffer.written_batches, [[1, 2]])
+        self.assertListEqual(self.buffer.pending, [])
+
+    def test_flush_interval(self):
+        self.buffer.add(1)
+        self.clock.now += 10
+        self.buffer.add(2)
+        self.assertListEqual(self.buffer.written_batches, [[1, 2]])
+
+    def test_dropped_on_errors(self):
+        self.buffer.add(None)
+        self.buffer.add(1)
+        self.assertListEqual(self.buffer.written_batches, [])
+        self.assertListEqual(self.buffer.pending, [])
+
+    def test_background(self):
+        buffer = ListBuffer(batch_size=1, background=True)
+        buffer.add(1)
+        with buffer.flushing:
+            self.assertListEqual(buffer.written_batches, [[1]])
+
+    def test_background_connections_closed(self):
+        mock = mox.Mox()
+        connection = mock.CreateMockAnything()
+        mock.StubOutWithMock(connections, 'all')
+        connections.all().AndReturn([connection])
+        connection.close()
+        mock.ReplayAll()
+        try:
+            buffer = ListBuffer(batch_size=1, background=True)
+            buffer.add(1)
+            with buffer.flushing:
+                mock.VerifyAll()
+        finally:
+            mock.UnsetStubs()
@@ -0,0 +1,242 @@
+from StringIO import StringIO
+import json
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import Group, User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils.unittest import skipIf
+
+from affect.models import Criteria, Flag
+from affect.networks import GeoDatabase
+from affect.simulate import numpy
+
+
+class AffectAssignCommandTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        group = Group.objects.create(name='test_group')
+        self.user = User.objects.create(username='test_user')
+        self.user.groups.add(group)
+        crit = Criteria.objects.create(name='test_crit', referrer='ex.com')
+        crit.groups.add(group)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name, content=None):
+        path = os.path.join(self.dir, name)
+        if content is not None:
+            with open(path, 'wb') as f:
+                f.write(content)
+        return path
+
+    def test_jsonl_to_stdout(self):
+        path = self.path('in.jsonl', '\n'.join([
+            json.dumps({'id': 'a', 'user_id': self.user.pk}),
+            '',
+            json.dumps({'id': 'b', 'referrer': 'http://ex.com/'}),
+            json.dumps({'id': 'c'})]))
+        out, err = StringIO(), StringIO()
+        call_command('affect_assign', path, stdout=out, stderr=err)
+
+        self.assertListEqual(
+            [json.loads(line) for line in out.getvalue().splitlines()], [
+                {'id': 'a', 'user_id': self.user.pk, 'flags': ['test_flag']},
+                {'id': 'b', 'user_id': None, 'flags': ['test_flag']},
+                {'id': 'c', 'user_id': None, 'flags': []}])
+        self.assertIn('Assigned 3 records', err.getvalue())
+
+    def test_csv_to_csv_file(self):
+        path = self.path('in.csv', 'user_id,groups\n%s,\n%s,1\n' % (
+            self.user.pk, self.user.pk + 1))
+        output = self.path('out.csv')
+        call_command('affect_assign', path, output=output, chunk_size=1,
+                     progress=1, stderr=StringIO(), verbosity=0)
+
+        with open(output) as f:
+            self.assertListEqual(f.read().splitlines(), [
+                'id,user_id,flags', ',%s,test_flag' % self.user.pk,
+                ',%s,test_flag' % (self.user.pk + 1)])
+
+    def test_workers(self):
+        path = self.path('in.txt', json.dumps({'user_id': self.user.pk}))
+        out = StringIO()
+        call_command('affect_assign', path, workers=2, output_format='csv',
+                     stdout=out, verbosity=0)
+        self.assertListEqual(out.getvalue().splitlines(), [
+            'id,user_id,flags', ',%s,test_flag' % self.user.pk])
+
+    def test_too_many_files(self):
+        self.assertRaises(
+            CommandError, call_command, 'affect_assign', 'a', 'b')
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class AffectSimulateCommandTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        crit = Criteria.objects.create(name='test_crit', referrer='ex.com')
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_report(self):
+        records = self.path('in.csv', 'id,referrer\na,http://ex.com/\n'
+                            'b,http://www.ex.com/\nc,\n')
+        changes = self.path('changes.json', json.dumps(
+            {'test_crit': {'referrer': '*.ex.com'}}))
+        out = StringIO()
+        call_command('affect_simulate', records, changes=changes, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '3 records, 1 would get different flags')
+        self.assertListEqual(lines[2].split(), [
+            'test_flag', '1', '2', '+1', '1', '0', '0/0'])
+
+    def test_bad_changes(self):
+        records = self.path('in.jsonl', '{}\n')
+        changes = self.path('changes.json', json.dumps(
+            {'test_crit': {'flags': ['missing']}}))
+        self.assertRaises(
+            CommandError, call_command, 'affect_simulate', records,
+            changes=changes)
+        self.assertRaises(
+            CommandError, call_command, 'affect_simulate', records)
+        for fields in ({'bogus': 1}, {'percent': 'ten'}):
+            changes = self.path('changes.json', json.dumps(
+                {'test_crit': fields}))
+            self.assertRaises(
+                CommandError, call_command, 'affect_simulate', records,
+                changes=changes)
+
+
+class AffectStressCommandTest(TestCase):
+    def setUp(self):
+        crit = Criteria.objects.create(
+            name='test_crit', referrer='ex.com', percent=50)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+
+    def test_report(self):
+        out = StringIO()
+        call_command('affect_stress', threads='1,2', seconds=0.05,
+                     contexts=10, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '1 criteria, 10 contexts')
+        self.assertListEqual([line.split()[0] for line in lines[2:]],
+                             ['1', '2'])
+        self.assertListEqual([line.split()[-1] for line in lines[2:]],
+                             ['0', '0'])
+
+    def test_bad_threads(self):
+        self.assertRaises(
+            CommandError, call_command, 'affect_stress', threads='a')
+
+
+class AffectTransferCommandsTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        crit = Criteria.objects.create(name='test_crit', staff=True)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_export_import(self):
+        path = os.path.join(self.dir, 'rules.json')
+        call_command('affect_export', path)
+        with open(path) as f:
+            rules = json.load(f)
+        self.assertListEqual(
+            [row['name'] for row in rules['criteria']], ['test_crit'])
+
+        rules['criteria'][0]['staff'] = False
+        rules['criteria'].append({'name': 'new_crit'})
+        with open(path, 'wb') as f:
+            json.dump(rules, f)
+        out = StringIO()
+        call_command('affect_import', path, dry_run=True, stdout=out)
+        self.assertListEqual(out.getvalue().splitlines(), [
+            '+ criteria new_crit', '~ criteria test_crit',
+            '1 created, 1 updated, 0 deleted (dry run, nothing saved)'])
+        self.assertIs(Criteria.objects.get(name='test_crit').staff, True)
+
+        out = StringIO()
+        call_command('affect_import', path, stdout=out)
+        self.assertIs(Criteria.objects.get(name='test_crit').staff, False)
+        self.assertEqual(Criteria.objects.count(), 2)
+
+    def test_export_stdout(self):
+        out = StringIO()
+        call_command('affect_export', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['version'], 1)
+
+    def test_errors(self):
+        path = os.path.join(self.dir, 'rules.json')
+        with open(path, 'wb') as f:
+            f.write('{"criteria": [{"name": "a", "flags": ["missing"]}]}')
+        self.assertRaises(CommandError, call_command, 'affect_import', path)
+        self.assertRaises(CommandError, call_command, 'affect_import')
+
+
+class AffectAnalyzeCommandTest(TestCase):
+    def test_report(self):
+        flag = Flag.objects.create(name='test_flag')
+        Criteria.objects.create(name='on', everyone=True).flags.add(flag)
+        Criteria.objects.create(name='flagless', staff=True)
+        Criteria.objects.create(
+            name='shadowed', referrer='*.ex.com,www.ex.com').flags.add(flag)
+        out = StringIO()
+        call_command('affect_analyze', stdout=out)
+        self.assertListEqual(out.getvalue().splitlines(), [
+            '3 criteria: 1 evaluated for each request, 1 decided up front, '
+            '1 dropped',
+            'Flags for everyone: test_flag',
+            'Dropped criteria:',
+            '  flagless has no active flags',
+            'Redundant:',
+            '  shadowed: referrer www.ex.com is covered by *.ex.com'])
+
+
+class AffectGeoDatabaseCommandTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        path = os.path.join(self.dir, 'geo.csv')
+        output = os.path.join(self.dir, 'geo.db')
+        with open(path, 'wb') as f:
+            f.write('# network,country\n192.0.2.0/24,GB\n\n'
+                    '198.51.100.0,198.51.100.99,US\n')
+        err = StringIO()
+        call_command('affect_geo_database', path, output, stderr=err)
+        self.assertIn('Wrote 2 ranges', err.getvalue())
+        geo = GeoDatabase(output)
+        self.assertEqual(geo.country('192.0.2.1'), 'GB')
+        self.assertEqual(geo.country('198.51.100.99'), 'US')
+        self.assertEqual(geo.country('198.51.100.100'), None)
+
+    def test_errors(self):
+        path = os.path.join(self.dir, 'geo.csv')
+        output = os.path.join(self.dir, 'geo.db')
+        for content in ('192.0.2.0/24\n', 'ex.com,GB\n',
+                        '10.0.0.0/8,US\n10.1.0.0/16,GB\n'):
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.assertRaises(CommandError, call_command,
+                              'affect_geo_database', path, output)
+        self.assertFalse(os.path.exists(output))
+        self.assertRaises(CommandError, call_command, 'affect_geo_database')
@@ -0,0 +1,37 @@
+from django.test import TestCase
+
+from affect.configured import Configured
+
+
+class ConfiguredTest(TestCase):
+    def setUp(self):
+        self.built = []
+        self.closed = []
+        self.configured = Configured(
+            self.build, 'AFFECTED_TEST', close=self.closed.append)
+
+    def build(self):
+        self.built.append(object())
+        return self.built[-1]
+
+    def test_built_once(self):
+        value = self.configured.get()
+        self.assertIs(self.configured.get(), value)
+        self.assertListEqual(self.built, [value])
+
+    def test_reset(self):
+        value = self.configured.get()
+        self.configured.reset(setting='AFFECTED_OTHER')
+        self.assertIs(self.configured.get(), value)
+        self.configured.reset(setting='AFFECTED_TEST_SIZE')
+        self.assertListEqual(self.closed, [value])
+        self.assertIsNot(self.configured.get(), value)
+        self.configured.reset()
+        self.assertEqual(len(self.closed), 2)
+
+    def test_not_configured(self):
+        configured = Configured(lambda: None, 'AFFECTED_TEST',
+                                close=self.closed.append)
+        self.assertIs(configured.get(), None)
+        configured.reset()
+        self.assertListEqual(self.closed, [])
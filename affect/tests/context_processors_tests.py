@@ -0,0 +1,29 @@
+from django.template import Context, RequestContext, Template
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from affect.context_processors import affected_flags
+
+
+class AffectedFlagsTest(TestCase):
+    def test_flags(self):
+        request = RequestFactory().get('')
+        request.affected_flags = frozenset(['test_flag'])
+        self.assertDictEqual(
+            affected_flags(request),
+            {'affected_flags': frozenset(['test_flag'])})
+
+    def test_middleware_not_run(self):
+        request = RequestFactory().get('')
+        self.assertDictEqual(
+            affected_flags(request), {'affected_flags': frozenset()})
+
+    def test_template(self):
+        request = RequestFactory().get('')
+        request.affected_flags = frozenset(['test_flag'])
+        template = Template(
+            "{% if 'test_flag' in affected_flags %}on{% endif %}"
+            "{% if 'other_flag' in affected_flags %}off{% endif %}")
+        context = RequestContext(request, processors=[affected_flags])
+        self.assertEqual(template.render(context), 'on')
+        self.assertEqual(template.render(Context()), '')
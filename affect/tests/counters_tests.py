@@ -0,0 +1,182 @@
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import get_cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from affect.admin import HitRateAdmin
+from affect.counters import (
+    CacheStore, HitCounter, ModelStore, count_criteria, count_request,
+    get_counter)
+from affect.models import Criteria, HitCount
+from affect.tests.helpers import Clock
+from affect.utils import meets_criteria
+
+
+class MemoryStore(object):
+    def __init__(self):
+        self.merged = []
+
+    def merge(self, counts):
+        self.merged.append(dict(counts))
+
+    def read(self, keys):
+        counts = dict.fromkeys(keys, 0)
+        for merged in self.merged:
+            for key, n in merged.items():
+                if key in counts:
+                    counts[key] += n
+        return counts
+
+
+class HitCounterTest(TestCase):
+    def setUp(self):
+        self.clock = Clock(7200.0)
+        self.store = MemoryStore()
+        self.counter = HitCounter(
+            self.store, bucket_size=3600, flush_interval=60, clock=self.clock)
+
+    def test_counts_in_memory(self):
+        self.counter.incr('requests', 'flag:a')
+        self.counter.incr('requests')
+        self.assertListEqual(self.store.merged, [])
+        self.assertDictEqual(
+            dict(self.counter.pending),
+            {(7200, 'requests'): 2, (7200, 'flag:a'): 1})
+
+    def test_flush_on_interval(self):
+        self.counter.incr('requests')
+        self.clock.now += 3600
+        self.counter.incr('requests')
+        self.assertListEqual(self.store.merged, [
+            {(7200, 'requests'): 1, (10800, 'requests'): 1}])
+        self.assertDictEqual(dict(self.counter.pending), {})
+
+    def test_read(self):
+        self.counter.incr('requests')
+        self.counter.flush()
+        self.clock.now += 3600
+        self.counter.incr('requests', 'requests')
+        self.counter.flush()
+        self.assertListEqual(self.counter.buckets(2), [10800, 7200])
+        self.assertDictEqual(
+            self.counter.read(['requests', 'flag:a'], 2),
+            {'requests': [2, 1], 'flag:a': [0, 0]})
+
+    def test_store_error_dropped(self):
+        self.store.merge = None
+        self.counter.incr('requests')
+        self.counter.flush()
+        self.assertDictEqual(dict(self.counter.pending), {})
+
+
+class CacheStoreTest(TestCase):
+    def setUp(self):
+        self.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache',
+            LOCATION='affect-counters')
+        self.cache.clear()
+        self.store = CacheStore(cache=self.cache)
+
+    def test_merge_and_read(self):
+        self.store.merge({(0, 'requests'): 2, (0, 'flag:a'): 1})
+        self.store.merge({(0, 'requests'): 3})
+        self.assertEqual(self.cache.get('affect_hits:0:requests'), 5)
+        self.assertDictEqual(
+            self.store.read([(0, 'requests'), (0, 'flag:a'), (1, 'flag:a')]),
+            {(0, 'requests'): 5, (0, 'flag:a'): 1, (1, 'flag:a'): 0})
+
+    def test_incr_many(self):
+        calls = []
+        self.cache.incr_many = calls.append
+        self.store.merge({(0, 'requests'): 2})
+        self.assertListEqual(calls, [{'affect_hits:0:requests': 2}])
+
+
+class ModelStoreTest(TestCase):
+    def test_merge_and_read(self):
+        store = ModelStore()
+        store.merge({(0, 'requests'): 2, (0, 'flag:a'): 1})
+        store.merge({(0, 'requests'): 3})
+        self.assertEqual(HitCount.objects.get(key='requests').count, 5)
+        self.assertDictEqual(
+            store.read([(0, 'requests'), (0, 'flag:a'), (1, 'flag:a')]),
+            {(0, 'requests'): 5, (0, 'flag:a'): 1, (1, 'flag:a'): 0})
+
+    def test_read_many(self):
+        store = ModelStore()
+        store.merge({(0, 'flag:2000'): 3})
+        keys = [(bucket, 'flag:%d' % i)
+                for bucket in range(2) for i in range(2001)]
+        with self.assertNumQueries(5):
+            counts = store.read(keys)
+        self.assertEqual(counts[(0, 'flag:2000')], 3)
+        self.assertEqual(sum(counts.values()), 3)
+
+
+class CountingTest(TestCase):
+    store = 'affect.counters.ModelStore'
+
+    def test_off_by_default(self):
+        self.assertIs(get_counter(), None)
+        self.assertIs(count_criteria('test_crit', 'staff', False), False)
+        count_request(['test_flag'])
+
+    def test_count_criteria(self):
+        with self.settings(AFFECTED_COUNTER_STORE=self.store):
+            self.assertIs(count_criteria('test_crit', 'staff'), True)
+            self.assertIs(count_criteria('test_crit', 'testing', False), False)
+            counter = get_counter()
+            self.assertDictEqual(dict(counter.pending), {
+                (counter.bucket(), 'criteria:test_crit:staff'): 1})
+
+    def test_meets_criteria_branch(self):
+        Criteria.objects.create(name='test_crit', referrer='example.com')
+        request = RequestFactory().get('', HTTP_REFERER='http://example.com/')
+        request.user = AnonymousUser()
+        with self.settings(AFFECTED_COUNTER_STORE=self.store):
+            self.assertIs(meets_criteria(request, 'test_crit'), True)
+            counter = get_counter()
+            self.assertListEqual(
+                [key for _, key in counter.pending],
+                ['criteria:test_crit:referrer'])
+
+    def test_count_request(self):
+        with self.settings(AFFECTED_COUNTER_STORE=self.store):
+            count_request(['a'])
+            count_request([])
+        self.assertDictEqual(
+            dict(HitCount.objects.values_list('key', 'count')),
+            {'requests': 2, 'flag:a': 1})
+
+
+class HitRateAdminTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        Criteria.objects.create(name='test_crit')
+
+    def test_change_list_link(self):
+        response = self.client.get('/admin/affect/criteria/')
+        self.assertContains(response, '<a href="hits/">Hit rates</a>')
+
+    def test_counting_off(self):
+        response = self.client.get('/admin/affect/criteria/hits/')
+        self.assertContains(response, 'AFFECTED_COUNTER_STORE')
+
+    def test_rates(self):
+        with self.settings(
+                AFFECTED_COUNTER_STORE='affect.counters.ModelStore'):
+            counter = get_counter()
+            counter.incr('requests', 'requests', 'requests', 'requests')
+            counter.incr('criteria:test_crit:staff')
+            counter.flush()
+            response = self.client.get('/admin/affect/criteria/hits/')
+            self.assertContains(response, 'staff: 1')
+            self.assertContains(response, '1 (25.0%)')
+            response = self.client.get('/admin/affect/flag/hits/')
+            self.assertEqual(response.status_code, 200)
+
+    def test_no_hit_keys_by_default(self):
+        self.assertListEqual(
+            HitRateAdmin(Criteria, admin.site).hit_keys('test_crit'), [])
@@ -0,0 +1,92 @@
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from affect.current import (
+    HEADER, FlagAssignment, activated, add_header, get_current, is_affected,
+    release, restore, set_current)
+from affect.middleware import AffectMiddleware
+from affect.models import Criteria, Flag
+
+
+class FlagAssignmentTest(TestCase):
+    def tearDown(self):
+        set_current(None)
+
+    def test_dumps(self):
+        assignment = FlagAssignment(['b', 'a'], 1400000000.25)
+        self.assertEqual(assignment.dumps(), '1400000000.25:a,b')
+        self.assertEqual(FlagAssignment.loads(assignment.dumps()), assignment)
+        self.assertEqual(FlagAssignment.loads(':'), FlagAssignment([]))
+        self.assertRaises(ValueError, FlagAssignment.loads, 'a,b')
+        self.assertRaises(ValueError, FlagAssignment.loads, 'x:a')
+
+    def test_current(self):
+        self.assertIs(get_current(), None)
+        self.assertIs(is_affected('a'), False)
+        with activated(FlagAssignment(['a'])):
+            self.assertIs(is_affected('a'), True)
+            self.assertIs(is_affected('b'), False)
+        self.assertIs(get_current(), None)
+
+
+class Request(object):
+    def __init__(self, **headers):
+        self.__dict__.update(headers)
+
+
+class Task(object):
+    def __init__(self, request):
+        self.request = request
+
+
+class CeleryHandlersTest(TestCase):
+    def tearDown(self):
+        set_current(None)
+
+    def test_add_header(self):
+        headers = {}
+        add_header(headers=headers)
+        self.assertDictEqual(headers, {})
+        with activated(FlagAssignment(['a'], 1.5)):
+            add_header(headers=headers)
+        self.assertDictEqual(headers, {HEADER: '1.5:a'})
+
+    def test_restore_and_release(self):
+        for request in [Request(affect_flags='1.5:a'),
+                        Request(headers={'affect_flags': '1.5:a'})]:
+            restore(task=Task(request))
+            self.assertEqual(get_current(), FlagAssignment(['a'], 1.5))
+            release()
+            self.assertIs(get_current(), None)
+
+    def test_eager_task_keeps_request_flags(self):
+        with activated(FlagAssignment(['a'])):
+            restore(task=Task(Request(headers=None)))
+            self.assertIs(is_affected('a'), True)
+            restore(task=Task(Request(affect_flags=':b')))
+            self.assertIs(is_affected('b'), True)
+            release()
+            release()
+            self.assertIs(is_affected('a'), True)
+
+    def test_malformed_header(self):
+        with activated(FlagAssignment(['a'])):
+            restore(task=Task(Request(affect_flags='bad')))
+            self.assertIs(get_current(), None)
+            release()
+
+
+class MiddlewareTest(TestCase):
+    def test_current_during_request(self):
+        crit = Criteria.objects.create(name='test_crit', everyone=True)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        mw = AffectMiddleware()
+        mw.process_request(request)
+        self.assertIs(is_affected('test_flag'), True)
+        self.assertIsInstance(get_current().version, float)
+        mw.process_response(request, HttpResponse())
+        self.assertIs(get_current(), None)
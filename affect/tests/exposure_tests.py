@@ -0,0 +1,163 @@
+from Queue import Queue
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+import mox
+
+from affect import exposure
+from affect.exposure import (
+    ExposureRecorder, LoggingSink, ModelSink, QueueSink, get_recorder,
+    record_request)
+from affect.middleware import AffectMiddleware
+from affect.models import Exposure
+from affect.tests.helpers import Clock
+from affect.utils import flag_is_affected
+
+
+class ExposureRecorderTest(TestCase):
+    def setUp(self):
+        self.batches = []
+        self.clock = Clock()
+        self.recorder = ExposureRecorder(
+            self.batches.append, batch_size=3, flush_interval=10,
+            clock=self.clock)
+
+    def test_flush_on_batch_size(self):
+        self.recorder.record(['a', 'b'], ['a'], 1)
+        self.assertListEqual(self.batches, [])
+        self.recorder.record(['c'], [])
+
+        batch, = self.batches
+        self.assertListEqual(
+            [(e.flag, e.active, e.user_id, e.sample_rate) for e in batch],
+            [('a', True, 1, 1.0), ('b', False, 1, 1.0),
+             ('c', False, None, 1.0)])
+        self.assertListEqual(self.recorder.pending, [])
+
+    def test_flush_on_interval(self):
+        self.recorder.record(['a'], [])
+        self.clock.now += 10
+        self.recorder.record(['b'], [])
+        self.assertEqual(len(self.batches[0]), 2)
+
+    def test_flush_empty(self):
+        self.recorder.flush()
+        self.assertListEqual(self.batches, [])
+
+    def test_sink_error_dropped(self):
+        def sink(events):
+            raise ValueError
+        recorder = ExposureRecorder(sink, batch_size=1)
+        recorder.record(['a'], [])
+        self.assertListEqual(recorder.pending, [])
+
+    def test_sample_rate(self):
+        mock = mox.Mox()
+        mock.StubOutWithMock(exposure.random, 'random')
+        exposure.random.random().AndReturn(0.2)
+        exposure.random.random().AndReturn(0.7)
+        self.recorder.sample_rate = 0.5
+
+        mock.ReplayAll()
+        self.recorder.record(['a', 'b'], [])
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+        self.assertListEqual(
+            [(e.flag, e.sample_rate) for e in self.recorder.pending],
+            [('a', 0.5)])
+
+    def test_sample_under_load(self):
+        self.recorder.max_per_second = 2
+        self.recorder.batch_size = 100
+        self.recorder.record(['a', 'b', 'c', 'd'], [])
+        self.assertEqual(len(self.recorder.pending), 4)
+        self.clock.now += 1
+        self.assertEqual(self.recorder.rate(self.clock.now), 0.5)
+        self.clock.now += 1
+        self.assertEqual(self.recorder.rate(self.clock.now), 1.0)
+
+
+class SinkTest(TestCase):
+    def setUp(self):
+        recorder = ExposureRecorder(lambda events: None)
+        recorder.record(['a', 'b'], ['b'], 7)
+        self.events = recorder.pending
+
+    def test_model_sink(self):
+        with self.assertNumQueries(1):
+            ModelSink()(self.events)
+        self.assertListEqual(
+            list(Exposure.objects.order_by('flag').values_list(
+                'flag', 'active', 'user_id')),
+            [('a', False, 7), ('b', True, 7)])
+
+    def test_logging_sink(self):
+        sink = LoggingSink()
+        mock = mox.Mox()
+        mock.StubOutWithMock(sink.logger, 'info')
+        for event in self.events:
+            sink.logger.info('%s %s %s %s %s', mox.IgnoreArg(), event.flag,
+                             int(event.active), 7, 1.0)
+
+        mock.ReplayAll()
+        sink(self.events)
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+    def test_queue_sink(self):
+        queue = Queue()
+        QueueSink(queue)(self.events)
+        self.assertListEqual(queue.get_nowait(), self.events)
+
+
+class RecordRequestTest(TestCase):
+    def test_not_configured(self):
+        self.assertIs(get_recorder(), None)
+
+    def test_settings(self):
+        with self.settings(AFFECTED_EXPOSURE_SINK='affect.exposure.QueueSink',
+                           AFFECTED_EXPOSURE_BATCH_SIZE=5):
+            recorder = get_recorder()
+            self.assertIsInstance(recorder.sink, QueueSink)
+            self.assertEqual(recorder.batch_size, 5)
+            self.assertIs(get_recorder(), recorder)
+        self.assertIs(get_recorder(), None)
+
+    def test_only_checked_flags(self):
+        queue = Queue()
+        user = User.objects.create(username='test_user')
+        with self.settings(AFFECTED_EXPOSURE_SINK='affect.exposure.QueueSink',
+                           AFFECTED_EXPOSURE_BATCH_SIZE=1):
+            get_recorder().sink.queue = queue
+            request = RequestFactory().get('')
+            request.user = user
+            request.affected_flags = ['a', 'b']
+            request.affected_checked = set()
+            flag_is_affected(request, 'a')
+            flag_is_affected(request, 'a')
+            flag_is_affected(request, 'c')
+            record_request(request)
+
+        events = queue.get_nowait()
+        self.assertListEqual(
+            sorted((e.flag, e.active, e.user_id) for e in events),
+            [('a', True, user.pk), ('c', False, user.pk)])
+        self.assertTrue(queue.empty())
+
+    def test_middleware(self):
+        with self.settings(AFFECTED_EXPOSURE_SINK='affect.exposure.ModelSink',
+                           AFFECTED_EXPOSURE_BATCH_SIZE=1):
+            request = RequestFactory().get('')
+            request.user = AnonymousUser()
+            mw = AffectMiddleware()
+            mw.process_request(request)
+            flag_is_affected(request, 'test_flag')
+            mw.process_response(request, HttpResponse())
+
+        exposure, = Exposure.objects.all()
+        self.assertEqual(exposure.flag, 'test_flag')
+        self.assertIs(exposure.active, False)
+        self.assertIs(exposure.user_id, None)
@@ -0,0 +1,90 @@
+import pickle
+
+from django.test import TestCase
+
+from affect.expressions import (
+    NEVER, Compiler, ExpressionError, find_cycle, parse, references,
+    without_references)
+
+
+class ParseTest(TestCase):
+    def test_predicates(self):
+        self.assertEqual(parse('Staff'), ('staff', None))
+        self.assertEqual(parse('referrer:*.Google.com'),
+                         ('referrer', '*.google.com'))
+        self.assertEqual(parse('entry_url:/blog/*'), ('entry_url', '/blog/*'))
+        self.assertEqual(parse('language:pt-BR'), ('language', 'pt-br'))
+        self.assertEqual(parse('query:utm_*=spring-*'),
+                         ('query', ('utm_*', 'spring-*')))
+        self.assertEqual(parse('query:gclid'), ('query', ('gclid', '*')))
+        self.assertEqual(parse('user:42'), ('user', 42))
+        self.assertEqual(parse('criteria:sale'), ('criteria', 'sale'))
+
+    def test_precedence(self):
+        self.assertEqual(
+            parse('mobile and not staff or user:1'),
+            ('or', ('and', ('mobile', None), ('not', ('staff', None))),
+             ('user', 1)))
+        self.assertEqual(
+            parse('mobile and (staff or user:1)'),
+            ('and', ('mobile', None), ('or', ('staff', None), ('user', 1))))
+
+    def test_canonical(self):
+        self.assertEqual(parse('staff and (mobile and user:1)'),
+                         parse('(user:1 AND mobile) and staff'))
+        self.assertEqual(parse('not not staff'), ('staff', None))
+
+    def test_invalid(self):
+        for text in ['', 'staff and', '(staff', 'staff)', 'user:x', 'foo',
+                     'referrer', 'staff staff', 'not']:
+            self.assertRaises(ExpressionError, parse, text)
+
+
+class ReferencesTest(TestCase):
+    def test_references(self):
+        self.assertEqual(
+            references(parse('criteria:a or not (staff and criteria:b)')),
+            set(['a', 'b']))
+        self.assertEqual(references(NEVER), set())
+
+    def test_without_references(self):
+        tree = parse('not criteria:a and (staff or criteria:b)')
+        result = without_references(tree, set(['b']))
+        self.assertEqual(references(result), set(['b']))
+        self.assertEqual(result[0], 'and')
+        self.assertIn(('not', NEVER), result)
+        self.assertEqual(without_references(tree, set(['a', 'b'])), tree)
+
+    def test_find_cycle(self):
+        graph = {'a': set(['b']), 'b': set(['c', 'd']), 'c': set(),
+                 'd': set(['a'])}
+        self.assertListEqual(find_cycle(graph, 'a'), ['a', 'b', 'd', 'a'])
+        self.assertIs(find_cycle(graph, 'c'), None)
+        self.assertListEqual(find_cycle({'a': set(['a'])}, 'a'), ['a', 'a'])
+
+
+class CompilerTest(TestCase):
+    def test_shared(self):
+        compiler = Compiler()
+        first = compiler.compile(parse('mobile and (staff or user:1)'))
+        second = compiler.compile(parse('(user:1 or staff) and not mobile'))
+        self.assertIs(first.children[0], second.children[0])
+        self.assertIs(first.children[1], second.children[1].children[0])
+        self.assertEqual(len(compiler.leaves['mobile']), 1)
+
+    def test_cheapest_first(self):
+        node = Compiler().compile(parse(
+            'criteria:sale and (mobile or user:1) and staff'))
+        self.assertListEqual([child.kind for child in node.children],
+                             ['staff', 'or', 'criteria'])
+        self.assertListEqual(
+            [child.kind for child in node.children[1].children],
+            ['user', 'mobile'])
+        self.assertEqual(node.cost, 27)
+
+    def test_pickle(self):
+        node = Compiler().compile(parse('not staff or staff'))
+        copy = pickle.loads(pickle.dumps(node, -1))
+        negated, staff = copy.children
+        self.assertEqual(staff.kind, 'staff')
+        self.assertIs(negated.children[0], staff)
@@ -0,0 +1,138 @@
+from itertools import count
+from unittest import skipIf
+
+from django.core.cache import get_cache
+from django.template import Context, Template, TemplateSyntaxError
+from django.test import TestCase
+from django.test.client import RequestFactory
+import mox
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+from affect import fragments
+from affect.fragments import fragment_key
+
+
+class FragmentTestCase(TestCase):
+    def setUp(self):
+        self.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache',
+            LOCATION='affect-fragments')
+        self.cache.clear()
+        self.mock = mox.Mox()
+        self.mock.stubs.Set(fragments, 'cache', self.cache)
+        self.counter = count()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def request(self, *flags):
+        request = RequestFactory().get('')
+        request.affected_flags = frozenset(flags)
+        request.affected_checked = set()
+        return request
+
+
+class FragmentKeyTest(TestCase):
+    def test_key(self):
+        self.assertEqual(fragment_key('box', ['a', 'b']),
+                         fragment_key('box', ['b', 'a']))
+        self.assertNotEqual(fragment_key('box', ['a']),
+                            fragment_key('box', ['b']))
+        self.assertNotEqual(fragment_key('box', ['a']),
+                            fragment_key('box', [], ['a']))
+        self.assertNotEqual(fragment_key('box', []),
+                            fragment_key('other', []))
+        self.assertTrue(fragment_key('box', []).startswith(
+            'affect_fragment:box:'))
+
+
+class CachedFragmentTest(FragmentTestCase):
+    def test_default_timeout(self):
+        self.mock.StubOutWithMock(self.cache, 'set')
+        self.cache.set(fragment_key('box', []), 'x', 300)
+        self.cache.set(fragment_key('box', ['a']), 'y', 60)
+
+        self.mock.ReplayAll()
+        self.cache.default_timeout = 300
+        fragments.cached_fragment('box', None, [], (), lambda: 'x')
+        fragments.cached_fragment('box', 60, ['a'], (), lambda: 'y')
+        self.mock.VerifyAll()
+
+
+class CacheAffectedTagTest(FragmentTestCase):
+    def render(self, template, **context):
+        context['counter'] = self.counter
+        return Template('{% load affect_tags %}' + template).render(
+            Context(context))
+
+    def test_cached_per_flag_combination(self):
+        template = ("{% cache_affected 600 box 'a' flags %}"
+                    "{{ counter.next }}{% endcache_affected %}")
+        first = self.request('a')
+        self.assertEqual(
+            self.render(template, request=first, flags=['b']), '0')
+        self.assertSetEqual(first.affected_checked, set(['a', 'b']))
+        self.assertEqual(self.render(
+            template, request=self.request('a', 'c'), flags=['b']), '0')
+        self.assertEqual(self.render(
+            template, request=self.request('b'), flags=['b']), '1')
+        self.assertEqual(self.render(
+            template, request=self.request(), flags=['b']), '2')
+        self.assertEqual(self.render(
+            template, request=self.request('a'), flags=[]), '0')
+
+    def test_context_processor_flags(self):
+        template = ("{% cache_affected 600 box 'a' %}{{ counter.next }}"
+                    "{% endcache_affected %}")
+        self.assertEqual(self.render(template, affected_flags=['a']), '0')
+        self.assertEqual(self.render(template, affected_flags=['a']), '0')
+        self.assertEqual(self.render(template), '1')
+
+    def test_vary_on(self):
+        template = ("{% cache_affected 600 box 'a' vary_on lang %}"
+                    "{{ counter.next }}{% endcache_affected %}")
+        self.assertEqual(self.render(template, lang='en'), '0')
+        self.assertEqual(self.render(template, lang='en'), '0')
+        self.assertEqual(self.render(template, lang='fr'), '1')
+
+    def test_syntax(self):
+        self.assertRaises(
+            TemplateSyntaxError, self.render,
+            '{% cache_affected 600 box %}{% endcache_affected %}')
+        self.assertRaises(
+            TemplateSyntaxError, self.render,
+            "{% cache_affected ten box 'a' %}{% endcache_affected %}")
+
+
+@skipIf(jinja2 is None, 'Jinja2 is not installed')
+class CacheAffectedExtensionTest(FragmentTestCase):
+    def render(self, template, **context):
+        env = jinja2.Environment(
+            autoescape=True,
+            extensions=['affect.jinja.CacheAffectedExtension'])
+        context['counter'] = self.counter
+        return env.from_string(template).render(**context)
+
+    def test_cached_per_flag_combination(self):
+        template = ("{% cache_affected 'box', ['a', 'b'], 600 %}"
+                    "<b>{{ counter.next() }}</b>{% endcache_affected %}")
+        first = self.request('a')
+        self.assertEqual(self.render(template, request=first), '<b>0</b>')
+        self.assertSetEqual(first.affected_checked, set(['a', 'b']))
+        self.assertEqual(
+            self.render(template, request=self.request('a', 'c')), '<b>0</b>')
+        self.assertEqual(
+            self.render(template, request=self.request('b')), '<b>1</b>')
+
+    def test_vary_on(self):
+        template = ("{% cache_affected 'box', 'a', 600, [lang] %}"
+                    "{{ counter.next() }}{% endcache_affected %}")
+        self.assertEqual(
+            self.render(template, affected_flags=['a'], lang='en'), '0')
+        self.assertEqual(
+            self.render(template, affected_flags=['a'], lang='en'), '0')
+        self.assertEqual(
+            self.render(template, affected_flags=['a'], lang='fr'), '1')
@@ -0,0 +1,8 @@
+class Clock(object):
+    """A clock for tests, returning ``now`` until it is changed."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,245 @@
+import pickle
+
+from django.http import QueryDict
+from django.test import TestCase
+import mox
+
+from affect import matching
+from affect.matching import (
+    HostIndex, LRUCache, LanguageIndex, PathIndex, QueryIndex,
+    compile_pattern, get_language_cache, parse_accept_language, query_pairs)
+
+
+class CompilePatternTest(TestCase):
+    def test_exact(self):
+        self.assertIs(compile_pattern('utm_source'), None)
+
+    def test_glob(self):
+        pattern = compile_pattern('utm_*.?')
+        self.assertTrue(pattern.search('utm_source.a'))
+        self.assertFalse(pattern.search('utm_source.ab'))
+        self.assertFalse(pattern.search('xutm_.a'))
+
+    def test_regex(self):
+        pattern = compile_pattern('re:cpc-[0-9]+')
+        self.assertTrue(pattern.search('spring-cpc-12'))
+        self.assertFalse(pattern.search('cpc-'))
+
+    def test_invalid_regex(self):
+        self.assertFalse(compile_pattern('re:(').search('('))
+
+
+class QueryPairsTest(TestCase):
+    def test_pairs(self):
+        self.assertEqual(
+            query_pairs({'foo': ['bar', 1, 'baz'], 'a': 'b', 'bad': {}}),
+            (('a', 'b'), ('foo', 'bar'), ('foo', 'baz')))
+        self.assertEqual(query_pairs(None), ())
+
+
+class QueryIndexTest(TestCase):
+    def setUp(self):
+        self.index = QueryIndex([
+            ('exact', [('foo', 'bar')]),
+            ('any', [('foo', '*')]),
+            ('list', [('foo', 'bar'), ('foo', 'baz')]),
+            ('prefix', [('utm_*', 'spring-*')]),
+            ('regex', [('utm_medium', 're:^cpc-[0-9]+$')]),
+            ('keys', [('re:^ref', '*')]),
+        ])
+
+    def test_exact_and_any(self):
+        self.assertSetEqual(
+            self.index.match({'foo': 'bar'}), set(['exact', 'any', 'list']))
+        self.assertSetEqual(
+            self.index.match({'foo': 'baz'}), set(['any', 'list']))
+        self.assertSetEqual(self.index.match({'foo': 'boz'}), set(['any']))
+
+    def test_empty_value(self):
+        self.assertSetEqual(self.index.match({'foo': '', 'ref': ''}), set())
+
+    def test_patterns(self):
+        self.assertSetEqual(
+            self.index.match({'utm_medium': 'cpc-12', 'referral': 'x'}),
+            set(['regex', 'keys']))
+        self.assertSetEqual(
+            self.index.match({'utm_medium': 'spring-a'}), set(['prefix']))
+        self.assertSetEqual(
+            self.index.match({'utm_medium': 'cpc-a', 'xref': '1'}), set())
+
+    def test_group_references(self):
+        index = QueryIndex([
+            ('group', [('re:^(r)ef', '*'), ('id', 're:^(x)y$')]),
+            ('key', [(r're:^(a)\1$', '*')]),
+            ('value', [('id', r're:^(\d)\1$')]),
+            ('named', [('id', 're:^(?P<c>[a-z])(?P=c)$')]),
+        ])
+        self.assertSetEqual(index.match({'aa': '1'}), set(['key']))
+        self.assertSetEqual(index.match({'id': '11'}), set(['value']))
+        self.assertSetEqual(index.match({'id': 'zz'}), set(['named']))
+        self.assertSetEqual(index.match({'id': '12', 'ab': '1'}), set())
+
+    def test_query_dict(self):
+        self.assertSetEqual(
+            self.index.match(QueryDict('foo=boz&foo=bar')),
+            set(['exact', 'any', 'list']))
+
+    def test_empty_index(self):
+        index = QueryIndex()
+        self.assertFalse(index)
+        self.assertSetEqual(index.match({'foo': 'bar'}), set())
+
+    def test_pickle(self):
+        index = pickle.loads(pickle.dumps(self.index, -1))
+        self.assertSetEqual(
+            index.match({'utm_source': 'spring-a'}), set(['prefix']))
+
+
+class PathIndexTest(TestCase):
+    def setUp(self):
+        self.index = PathIndex([
+            ('exact', ['/test.html', '/other.html']),
+            ('root', ['/*']),
+            ('blog', ['/blog/*']),
+            ('post', ['/blog/posts/*']),
+            ('glob', ['/promo-*.html']),
+            ('regex', ['re:^/p/[0-9]+$']),
+            ('name', ['name:admin:index']),
+        ])
+
+    def test_exact(self):
+        self.assertSetEqual(
+            self.index.match('/test.html'), set(['exact', 'root']))
+
+    def test_prefixes(self):
+        self.assertSetEqual(
+            self.index.match('/blog/posts/1'), set(['root', 'blog', 'post']))
+        self.assertSetEqual(self.index.match('/blog/'), set(['root', 'blog']))
+        self.assertSetEqual(self.index.match('/blog'), set(['root']))
+        self.assertSetEqual(self.index.match('/blogs/'), set(['root']))
+
+    def test_patterns(self):
+        self.assertSetEqual(
+            self.index.match('/promo-spring.html'), set(['root', 'glob']))
+        self.assertSetEqual(self.index.match('/p/12'), set(['root', 'regex']))
+        self.assertSetEqual(self.index.match('/p/12/'), set(['root']))
+
+    def test_url_name(self):
+        self.assertSetEqual(self.index.match('/admin/'), set(['root', 'name']))
+
+    def test_empty(self):
+        self.assertSetEqual(self.index.match(''), set())
+        self.assertFalse(PathIndex())
+        self.assertSetEqual(PathIndex().match('/admin/'), set())
+
+
+class HostIndexTest(TestCase):
+    def setUp(self):
+        self.index = HostIndex([
+            ('exact', ['example.com', ' www.example.com']),
+            ('google', ['*.google.com']),
+            ('uk', ['*.co.uk']),
+            ('news', ['news.*']),
+            ('blank', ['']),
+        ])
+
+    def test_exact(self):
+        self.assertSetEqual(self.index.match('example.com'), set(['exact']))
+        self.assertSetEqual(
+            self.index.match('www.example.com'), set(['exact']))
+        self.assertSetEqual(self.index.match('app.example.com'), set())
+        self.assertSetEqual(self.index.match('com'), set())
+
+    def test_domains(self):
+        self.assertSetEqual(self.index.match('google.com'), set(['google']))
+        self.assertSetEqual(
+            self.index.match('mail.eu.google.com'), set(['google']))
+        self.assertSetEqual(self.index.match('notgoogle.com'), set())
+
+    def test_leading_labels(self):
+        self.assertSetEqual(
+            self.index.match('news.google.com'), set(['google', 'news']))
+        self.assertSetEqual(
+            self.index.match('news.bbc.co.uk'), set(['uk', 'news']))
+        self.assertSetEqual(self.index.match('news'), set())
+
+    def test_empty(self):
+        self.assertSetEqual(self.index.match(None), set())
+        self.assertFalse(HostIndex([('blank', [''])]))
+
+
+class LRUCacheTest(TestCase):
+    def test_least_recently_used_dropped(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        cache.set('a', 4)
+        cache.set('d', 5)
+        self.assertEqual(cache.get('a'), 4)
+        self.assertIs(cache.get('c'), None)
+
+
+class ParseAcceptLanguageTest(TestCase):
+    def setUp(self):
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def test_order(self):
+        self.assertEqual(
+            parse_accept_language('fr-CH, fr;q=0.9, en;q=0.8, de;q=0.95'),
+            ('fr-ch', 'de', 'fr', 'en'))
+
+    def test_skipped(self):
+        self.assertEqual(
+            parse_accept_language('*, en;q=0, x_y, de;q=a, pt-BR;q=0.5, '
+                                  'pt-br'),
+            ('pt-br',))
+        self.assertEqual(parse_accept_language(''), ())
+        self.assertEqual(parse_accept_language(None), ())
+
+    def test_cached(self):
+        self.mock.StubOutWithMock(matching, '_parse_accept_language')
+        matching._parse_accept_language('es, en;q=0.5').AndReturn(
+            ('es', 'en'))
+
+        self.mock.ReplayAll()
+        with self.settings(AFFECTED_LANGUAGE_CACHE_SIZE=10):
+            self.assertEqual(get_language_cache().size, 10)
+            self.assertEqual(
+                parse_accept_language('es, en;q=0.5'), ('es', 'en'))
+            self.assertEqual(
+                parse_accept_language('es, en;q=0.5'), ('es', 'en'))
+        self.mock.VerifyAll()
+        self.assertEqual(get_language_cache().size, 1000)
+
+
+class LanguageIndexTest(TestCase):
+    def setUp(self):
+        self.index = LanguageIndex([
+            ('french', ['fr']), ('canadian', ['fr-CA', ' en-ca']),
+            ('portuguese', ['pt', 'pt-br']), ('blank', [''])])
+
+    def test_prefixes(self):
+        self.assertSetEqual(self.index.match('fr'), set(['french']))
+        self.assertSetEqual(
+            self.index.match('fr-CA'), set(['french', 'canadian']))
+        self.assertSetEqual(self.index.match('en-CA'), set(['canadian']))
+        self.assertSetEqual(self.index.match('pt-BR'), set(['portuguese']))
+        self.assertSetEqual(self.index.match('en, fra'), set())
+
+    def test_accepted_languages(self):
+        self.assertSetEqual(
+            self.index.match('de, fr;q=0.3, pt;q=0'), set(['french']))
+
+    def test_empty(self):
+        self.assertSetEqual(self.index.match(''), set())
+        self.assertFalse(LanguageIndex([('blank', [''])]))
+        self.assertSetEqual(LanguageIndex().match('fr'), set())
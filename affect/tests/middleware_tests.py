@@ -1,12 +1,20 @@
+from django.contrib.auth.models import AnonymousUser, Group, User
 from django.core.cache import cache
 from django.http import HttpResponse
 from django.test import TestCase
 from django.test.client import RequestFactory
 import mox
+import uuid
 
-from affect import middleware
+from affect import middleware, rules as rules_module
 from affect.middleware import AffectMiddleware
 from affect.models import Criteria, Flag
+from affect.rules import CriteriaRecord, RuleSet
+
+
+def names(decisions):
+    return dict((criteria.name, active)
+                for criteria, active in decisions.items())
 
 
 class AffectMiddlewareRequestTest(TestCase):
@@ -17,51 +25,44 @@ class AffectMiddlewareRequestTest(TestCase):
         self.flag2 = Flag.objects.create(name='other_flag', active=True)
         self.criteria.flags.add(self.flag1, self.flag2)
         self.request = RequestFactory().get('')
-        self.request.affected_persist = {}
+        self.request.user = AnonymousUser()
         self.mw = AffectMiddleware()
         self.mock = mox.Mox()
-        self.mock.StubOutWithMock(middleware, 'meets_criteria')
-        self.mock.StubOutWithMock(cache, 'get')
-        self.mock.StubOutWithMock(cache, 'add')
 
     def tearDown(self):
         self.mock.UnsetStubs()
 
-    def test_criteria_active_nothing_cached(self):
-        self.mock.StubOutWithMock(middleware, 'cache_criteria')
-        cache.get('criteria:all')
-        cache.add('criteria:all', mox.SameElementsAs(Criteria.objects.all()))
-        middleware.meets_criteria(self.request, self.criteria).AndReturn(True)
-        cache.get('criteria:test_crit:flags')
-        middleware.cache_criteria(instance=self.criteria)
-        cache.get(u'flag_conflicts:test_flag').InAnyOrder()
-        cache.add(
-            u'flag_conflicts:test_flag', mox.SameElementsAs([])).InAnyOrder()
-        cache.get(u'flag_conflicts:other_flag').InAnyOrder()
-        cache.add(
-            u'flag_conflicts:other_flag', mox.SameElementsAs([])).InAnyOrder()
+    def process(self, request=None):
+        request = request or self.request
+        request.user = AnonymousUser()
+        self.mock.StubOutWithMock(cache, 'get')
+        cache.get('criteria:rules:version').AndReturn(uuid.uuid4().hex)
 
         self.mock.ReplayAll()
-        self.mw.process_request(self.request)
+        self.mw.process_request(request)
         self.mock.VerifyAll()
+        return request
+
+    def test_criteria_active_nothing_cached(self):
+        self.criteria.everyone = True
+        self.criteria.save()
+        self.process()
 
         self.assertDictEqual(self.request.affected_persist, {})
-        self.assertItemsEqual(self.request.affected_flags,
-                              [self.flag1.name, self.flag2.name])
+        self.assertEqual(self.request.affected_flags,
+                         frozenset([self.flag1.name, self.flag2.name]))
 
     def test_criteria_active_everything_cached(self):
-        self.mock.StubOutWithMock(middleware, 'cache_criteria')
-        cache.get('criteria:all').AndReturn(Criteria.objects.all())
-        middleware.meets_criteria(self.request, self.criteria).AndReturn(True)
-        cache.get('criteria:test_crit:flags').AndReturn(
-            self.criteria.flags.all())
-        cache.get(u'flag_conflicts:test_flag').InAnyOrder().AndReturn(
-            Flag.objects.none())
-        cache.get(u'flag_conflicts:other_flag').InAnyOrder().AndReturn(
-            Flag.objects.none())
+        self.criteria.everyone = True
+        self.criteria.save()
+        rules = RuleSet.load()
+        rules_module.snapshot.swap(rules, 'v1')
+        self.mock.StubOutWithMock(cache, 'get')
+        cache.get('criteria:rules:version').AndReturn('v1')
 
         self.mock.ReplayAll()
-        self.mw.process_request(self.request)
+        with self.assertNumQueries(0):
+            self.mw.process_request(self.request)
         self.mock.VerifyAll()
 
         self.assertDictEqual(self.request.affected_persist, {})
@@ -69,62 +70,72 @@ class AffectMiddlewareRequestTest(TestCase):
                               [self.flag1.name, self.flag2.name])
 
     def test_criteria_not_active(self):
-        middleware.meets_criteria(self.request, self.criteria).AndReturn(False)
-        cache.get('criteria:all')
-        cache.add('criteria:all', mox.IgnoreArg())
-
-        self.mock.ReplayAll()
-        self.mw.process_request(self.request)
-        self.mock.VerifyAll()
+        self.process()
 
         self.assertDictEqual(self.request.affected_persist, {})
-        self.assertListEqual(self.request.affected_flags, [])
+        self.assertEqual(self.request.affected_flags, frozenset())
 
     def test_persistent(self):
         self.criteria.persistent = True
+        self.criteria.everyone = True
         self.criteria.save()
-        middleware.meets_criteria(self.request, self.criteria).AndReturn(True)
-        cache.get('criteria:all')
-        cache.add('criteria:all', mox.IgnoreArg())
-        cache.get('criteria:test_crit:flags')
-        cache.add('criteria:test_crit', mox.IgnoreArg())
-        cache.add('criteria:test_crit:flags', mox.IgnoreArg())
-        cache.add('criteria:test_crit:users', mox.IgnoreArg())
-        cache.add('criteria:test_crit:groups', mox.IgnoreArg())
-        cache.get('flag_conflicts:other_flag').InAnyOrder()
-        cache.get('flag_conflicts:test_flag').InAnyOrder()
-        cache.add('flag_conflicts:test_flag', mox.IgnoreArg()).InAnyOrder()
-        cache.add('flag_conflicts:other_flag', mox.IgnoreArg()).InAnyOrder()
+        self.process()
 
-        self.mock.ReplayAll()
-        self.mw.process_request(self.request)
-        self.mock.VerifyAll()
+        self.assertDictEqual(
+            names(self.request.affected_persist), {'test_crit': True})
+        self.assertItemsEqual(
+            self.request.affected_flags, [self.flag1.name, self.flag2.name])
+
+    def test_persistent_records(self):
+        self.criteria.persistent = True
+        self.criteria.save()
+        self.process()
+
+        criteria, = self.request.affected_persist
+        self.assertIsInstance(criteria, CriteriaRecord)
+        self.assertEqual(criteria.name, 'test_crit')
+        self.assertEqual(criteria.max_cookie_age, 0)
+        self.assertIs(self.request.affected_persist[criteria], False)
+
+    def test_percent_persisted(self):
+        self.criteria.percent = 50
+        self.criteria.save()
+        self.request.COOKIES['dac_test_crit'] = 'True'
+        self.process()
 
         self.assertDictEqual(
-            self.request.affected_persist, {self.criteria: True})
+            names(self.request.affected_persist), {'test_crit': True})
+        self.assertItemsEqual(
+            self.request.affected_flags, [self.flag1.name, self.flag2.name])
+
+    def test_testing(self):
+        self.criteria.testing = True
+        self.criteria.save()
+        request = self.process(RequestFactory().get('', {'dact_test_crit': 1}))
+
+        self.assertDictEqual(
+            names(request.affected_tests), {'test_crit': True})
+        self.assertItemsEqual(
+            request.affected_flags, [self.flag1.name, self.flag2.name])
+
+    def test_user_groups(self):
+        user = User.objects.create(username='test_user')
+        group = Group.objects.create(name='test_group')
+        user.groups.add(group)
+        self.criteria.groups.add(group)
+        self.request.user = user
+        self.mw.process_request(self.request)
+
         self.assertItemsEqual(
             self.request.affected_flags, [self.flag1.name, self.flag2.name])
 
     def test_flag_conflicts(self):
-        middleware.meets_criteria(self.request, self.criteria).AndReturn(True)
+        self.criteria.everyone = True
+        self.criteria.save()
         self.flag2.conflicts.add(self.flag1)
         self.flag2.priority = 100
         self.flag2.save()
-        cache.get('criteria:all')
-        cache.add('criteria:all', mox.IgnoreArg())
-        cache.get('criteria:test_crit:flags')
-        cache.add('criteria:test_crit', mox.IgnoreArg())
-        cache.add('criteria:test_crit:flags', mox.IgnoreArg())
-        cache.add('criteria:test_crit:users', mox.IgnoreArg())
-        cache.add('criteria:test_crit:groups', mox.IgnoreArg())
-        cache.get('flag_conflicts:other_flag').InAnyOrder()
-        cache.get('flag_conflicts:test_flag').InAnyOrder()
-        cache.add('flag_conflicts:test_flag', mox.IgnoreArg()).InAnyOrder()
-        cache.add('flag_conflicts:other_flag', mox.IgnoreArg()).InAnyOrder()
-
-        self.mock.ReplayAll()
-        self.mw.process_request(self.request)
-        self.mock.VerifyAll()
+        self.process()
 
         self.assertDictEqual(
             self.request.affected_persist, {})
@@ -132,30 +143,27 @@ class AffectMiddlewareRequestTest(TestCase):
             self.request.affected_flags, [self.flag2.name])
 
     def test_flag_conflict_not_in_criteria(self):
-        middleware.meets_criteria(self.request, self.criteria).AndReturn(True)
+        self.criteria.everyone = True
+        self.criteria.save()
         flag3 = Flag.objects.create(name='that_flag', priority=100)
         flag3.conflicts.add(self.flag1, self.flag2)
-        cache.get('criteria:all')
-        cache.add('criteria:all', mox.IgnoreArg())
-        cache.get('criteria:test_crit:flags')
-        cache.add('criteria:test_crit', mox.IgnoreArg())
-        cache.add('criteria:test_crit:flags', mox.IgnoreArg())
-        cache.add('criteria:test_crit:users', mox.IgnoreArg())
-        cache.add('criteria:test_crit:groups', mox.IgnoreArg())
-        cache.get('flag_conflicts:other_flag').InAnyOrder()
-        cache.get('flag_conflicts:test_flag').InAnyOrder()
-        cache.add('flag_conflicts:test_flag', mox.IgnoreArg()).InAnyOrder()
-        cache.add('flag_conflicts:other_flag', mox.IgnoreArg()).InAnyOrder()
-
-        self.mock.ReplayAll()
-        self.mw.process_request(self.request)
-        self.mock.VerifyAll()
+        self.process()
 
         self.assertDictEqual(
             self.request.affected_persist, {})
         self.assertItemsEqual(
             self.request.affected_flags, [self.flag1.name, self.flag2.name])
 
+    def test_counts_deciding_branch(self):
+        self.criteria.everyone = True
+        self.criteria.save()
+        self.mock.StubOutWithMock(middleware, 'count_criteria')
+        self.mock.StubOutWithMock(middleware, 'count_request')
+        middleware.count_criteria('test_crit', 'everyone', True)
+        middleware.count_request(
+            mox.SameElementsAs([self.flag1.name, self.flag2.name]))
+        self.process()
+
 
 class AffectMiddlewareResponseTest(TestCase):
     def setUp(self):
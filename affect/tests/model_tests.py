@@ -1,7 +1,10 @@
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 import mox
 
-from affect.models import Criteria, Flag, datetime
+from affect.models import Criteria, Exposure, Flag, datetime
 
 
 class CriteriaModelTest(TestCase):
@@ -23,6 +26,56 @@ class CriteriaModelTest(TestCase):
         crit = Criteria.objects.get(id=crit.id)
         self.assertEqual(crit.modified, datetime.datetime(2012, 1, 1))
 
+    def test_scheduled(self):
+        now = datetime.now()
+        crit = Criteria(name='test_crit')
+        self.assertIs(crit.scheduled(), True)
+        crit.start = now
+        self.assertIs(crit.scheduled(now - timedelta(seconds=1)), False)
+        self.assertIs(crit.scheduled(now), True)
+        crit.end = now + timedelta(hours=1)
+        self.assertIs(crit.scheduled(now + timedelta(minutes=59)), True)
+        self.assertIs(crit.scheduled(crit.end), False)
+
+    def test_clean_schedule(self):
+        now = datetime.now()
+        crit = Criteria(name='test_crit', start=now, end=now)
+        self.assertRaises(ValidationError, crit.clean)
+        crit.end = now + timedelta(days=1)
+        crit.clean()
+
+    def test_clean_expression(self):
+        crit = Criteria.objects.create(name='test_crit')
+        crit.expression = 'staff and'
+        self.assertRaises(ValidationError, crit.clean)
+        crit.expression = 'staff and criteria:missing'
+        self.assertRaises(ValidationError, crit.clean)
+        other = Criteria.objects.create(
+            name='other', expression='criteria:test_crit or mobile')
+        crit.expression = 'staff and criteria:other'
+        self.assertRaises(ValidationError, crit.clean)
+        other.expression = 'mobile'
+        other.save()
+        crit.clean()
+        crit.expression = 'criteria:test_crit'
+        self.assertRaises(ValidationError, crit.clean)
+
+    def test_clean_networks(self):
+        crit = Criteria(name='test_crit', ip_ranges='10.0.0.0/8, 2001:db8::1',
+                        countries='gb, US')
+        crit.clean()
+        crit.ip_ranges = '10.0.0.0/8,10.0.0.0/40'
+        self.assertRaises(ValidationError, crit.clean)
+        crit.ip_ranges = ''
+        crit.countries = 'GBR'
+        self.assertRaises(ValidationError, crit.clean)
+
+    def test_clean_languages(self):
+        crit = Criteria(name='test_crit', languages='fr, pt-BR,')
+        crit.clean()
+        crit.languages = 'fr,en_US'
+        self.assertRaises(ValidationError, crit.clean)
+
 
 class FlagModelTest(TestCase):
     def test_unicode(self):
@@ -42,3 +95,9 @@ class FlagModelTest(TestCase):
 
         flag = Flag.objects.get(id=flag.id)
         self.assertEqual(flag.modified, datetime.datetime(2012, 1, 1))
+
+
+class ExposureModelTest(TestCase):
+    def test_unicode(self):
+        exposure = Exposure.objects.create(flag='test_flag')
+        self.assertEqual(unicode(exposure), 'test_flag')
@@ -0,0 +1,159 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from affect import networks
+from affect.networks import (
+    GeoDatabase, RangeIndex, address_key, client_address, get_geo_database,
+    range_keys, write_geo_database)
+
+
+class AddressTest(TestCase):
+    def test_ipv4_mapped(self):
+        self.assertEqual(address_key('192.0.2.1'),
+                         address_key('::ffff:192.0.2.1'))
+        self.assertEqual(len(address_key('192.0.2.1')), 16)
+
+    def test_order(self):
+        self.assertLess(address_key('10.0.0.9'), address_key('10.0.0.10'))
+        self.assertLess(address_key('255.255.255.255'), address_key('2001::'))
+
+    def test_invalid(self):
+        for address in ('', 'ex.com', '10.0.0', '10.0.0.256', '::g', None):
+            self.assertRaises(ValueError, address_key, address)
+
+    def test_range_keys(self):
+        self.assertEqual(range_keys('10.1.2.3/16'),
+                         (address_key('10.1.0.0'),
+                          address_key('10.1.255.255')))
+        self.assertEqual(range_keys(' 10.1.2.3 '),
+                         (address_key('10.1.2.3'), address_key('10.1.2.3')))
+        last = address_key('2001:db8:ffff:ffff:ffff:ffff:ffff:ffff')
+        self.assertEqual(range_keys('2001:db8::1/32'),
+                         (address_key('2001:db8::'), last))
+        self.assertEqual(range_keys('0.0.0.0/0')[1],
+                         address_key('255.255.255.255'))
+
+    def test_range_keys_invalid(self):
+        for text in ('10.0.0.0/33', '10.0.0.0/-1', '10.0.0.0/a', '::/129',
+                     'ex.com/8'):
+            self.assertRaises(ValueError, range_keys, text)
+
+
+class RangeIndexTest(TestCase):
+    def test_match(self):
+        index = RangeIndex([
+            ('office', ['192.0.2.0/24', '2001:db8::/32']),
+            ('partner', ['192.0.2.128/25', '198.51.100.7']),
+            ('invalid', ['ex.com'])])
+        self.assertEqual(index.match('192.0.2.1'), frozenset(['office']))
+        self.assertEqual(index.match('192.0.2.200'),
+                         frozenset(['office', 'partner']))
+        self.assertEqual(index.match('192.0.3.0'), frozenset())
+        self.assertEqual(index.match('198.51.100.7'), frozenset(['partner']))
+        self.assertEqual(index.match('198.51.100.8'), frozenset())
+        self.assertEqual(index.match('2001:db8:1::5'), frozenset(['office']))
+        self.assertEqual(index.match('10.0.0.1'), frozenset())
+        self.assertEqual(index.match('not an address'), frozenset())
+        self.assertEqual(index.match(''), frozenset())
+
+    def test_merged_intervals(self):
+        index = RangeIndex([('a', ['10.0.0.0/25', '10.0.0.128/25']),
+                            ('b', ['10.0.0.0/24'])])
+        self.assertEqual(len(index.targets), 2)
+        self.assertEqual(len(index.starts), 2 * networks.KEY_SIZE)
+        self.assertEqual(index.match('10.0.0.200'), frozenset(['a', 'b']))
+
+    def test_whole_space(self):
+        index = RangeIndex([('all', ['::/0'])])
+        self.assertEqual(index.match('ffff::1'), frozenset(['all']))
+        self.assertEqual(index.match('0.0.0.0'), frozenset(['all']))
+
+    def test_empty(self):
+        self.assertFalse(RangeIndex())
+        self.assertFalse(RangeIndex([('a', ['invalid'])]))
+        self.assertTrue(RangeIndex([('a', ['10.0.0.1'])]))
+
+    def test_pickle(self):
+        index = pickle.loads(pickle.dumps(
+            RangeIndex([('a', ['10.0.0.0/8'])]), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(index.match('10.1.1.1'), frozenset(['a']))
+
+
+class GeoDatabaseTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'geo.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_country(self):
+        self.assertEqual(write_geo_database(self.path, [
+            ('198.51.100.0/24', '', 'gb'),
+            ('192.0.2.0', '192.0.2.127', 'US'),
+            ('2001:db8::/32', None, 'DE')]), 3)
+        geo = GeoDatabase(self.path)
+        self.assertEqual(len(geo), 3)
+        self.assertEqual(geo.country('192.0.2.0'), 'US')
+        self.assertEqual(geo.country('192.0.2.127'), 'US')
+        self.assertEqual(geo.country('192.0.2.128'), None)
+        self.assertEqual(geo.country('198.51.100.9'), 'GB')
+        self.assertEqual(geo.country('2001:db8::9'), 'DE')
+        self.assertEqual(geo.country('1.1.1.1'), None)
+        self.assertEqual(geo.country('ffff::'), None)
+        self.assertEqual(geo.country('invalid'), None)
+        geo.close()
+
+    def test_empty(self):
+        write_geo_database(self.path, [])
+        self.assertEqual(GeoDatabase(self.path).country('10.0.0.1'), None)
+
+    def test_invalid_rows(self):
+        for rows in ([('10.0.0.0/8', '', 'USA')],
+                     [('10.0.0.9', '10.0.0.1', 'US')],
+                     [('10.0.0.0/8', '', 'US'), ('10.1.0.0/16', '', 'GB')],
+                     [('ex.com', '', 'US')]):
+            self.assertRaises(ValueError, write_geo_database, self.path, rows)
+        self.assertListEqual(os.listdir(self.dir), [])
+
+    def test_not_a_database(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a geo database')
+        self.assertRaises(ValueError, GeoDatabase, self.path)
+
+    def test_setting(self):
+        write_geo_database(self.path, [('10.0.0.0/8', '', 'US')])
+        with self.settings(AFFECTED_GEO_DATABASE=self.path):
+            geo = get_geo_database()
+            self.assertEqual(geo.country('10.0.0.1'), 'US')
+            self.assertIs(get_geo_database(), geo)
+        self.assertIs(get_geo_database(), None)
+        with self.settings(AFFECTED_GEO_DATABASE=self.path + '.missing'):
+            self.assertIs(get_geo_database(), None)
+
+
+class ClientAddressTest(TestCase):
+    def test_no_trusted_proxies(self):
+        self.assertEqual(client_address({
+            'REMOTE_ADDR': '10.0.0.1',
+            'HTTP_X_FORWARDED_FOR': '192.0.2.1'}), '10.0.0.1')
+        self.assertEqual(client_address({}), '')
+
+    def test_trusted_proxies(self):
+        with self.settings(AFFECTED_TRUSTED_PROXIES=['10.0.0.0/8']):
+            self.assertEqual(client_address({
+                'REMOTE_ADDR': '10.0.0.1',
+                'HTTP_X_FORWARDED_FOR': '6.6.6.6, 192.0.2.1, 10.0.0.2'}),
+                '192.0.2.1')
+            self.assertEqual(client_address({
+                'REMOTE_ADDR': '192.0.2.5',
+                'HTTP_X_FORWARDED_FOR': '6.6.6.6'}), '192.0.2.5')
+            self.assertEqual(client_address({
+                'REMOTE_ADDR': '10.0.0.1',
+                'HTTP_X_FORWARDED_FOR': '10.0.0.3, 10.0.0.2'}), '10.0.0.3')
+            self.assertEqual(client_address({
+                'REMOTE_ADDR': '10.0.0.1'}), '10.0.0.1')
@@ -0,0 +1,139 @@
+import cProfile
+import os
+import pstats
+import shutil
+import tempfile
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+import mox
+
+from affect import profiling
+from affect.middleware import AffectMiddleware
+from affect.models import Criteria, Flag
+from affect.profiling import Profiler, get_profiler
+from affect.tests.helpers import Clock
+
+
+class ProfilerTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'affect.prof')
+        self.clock = Clock()
+        self.profiler = Profiler(
+            10, path=self.path, interval=60, clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def profile(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        sorted(range(100))
+        profile.disable()
+        return profile
+
+    def test_sampling(self):
+        mock = mox.Mox()
+        mock.StubOutWithMock(profiling.random, 'random')
+        profiling.random.random().AndReturn(0.05)
+        profiling.random.random().AndReturn(0.1)
+
+        mock.ReplayAll()
+        self.assertIsNot(self.profiler.start(), None)
+        self.assertIs(self.profiler.start(), None)
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+    def test_add(self):
+        self.profiler.add(self.profile(), {'a': 0.002, 'b': 0.001})
+        self.profiler.add(self.profile(), {'a': 0.004})
+        self.assertEqual(self.profiler.requests, 2)
+        self.assertIn('sorted', self.profiler.report())
+        self.assertListEqual(
+            [(name, count) for name, count, _, _ in
+             self.profiler.criteria_report()], [('a', 2), ('b', 1)])
+        self.assertAlmostEqual(self.profiler.criteria_report()[0][3], 0.003)
+        self.assertFalse(os.path.exists(self.path))
+
+        self.clock.now += 60
+        self.profiler.add(self.profile())
+        self.assertEqual(pstats.Stats(self.path).total_calls,
+                         self.profiler.stats.total_calls)
+        self.assertListEqual(os.listdir(self.dir), ['affect.prof'])
+
+    def test_dump_per_process(self):
+        self.profiler.path = os.path.join(self.dir, 'affect-%(pid)s.prof')
+        self.profiler.add(self.profile())
+        self.profiler.dump()
+        self.assertListEqual(
+            os.listdir(self.dir), ['affect-%d.prof' % os.getpid()])
+
+    def test_clear(self):
+        self.profiler.add(self.profile(), {'a': 0.002})
+        self.profiler.clear()
+        self.assertEqual(self.profiler.requests, 0)
+        self.assertEqual(self.profiler.report(), '')
+        self.assertListEqual(self.profiler.criteria_report(), [])
+
+
+class ProfiledRequestTest(TestCase):
+    def setUp(self):
+        crit = Criteria.objects.create(name='test_crit', staff=True)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def test_off(self):
+        self.assertIs(get_profiler(), None)
+        mw = AffectMiddleware()
+        mw.process_request(self.request)
+        mw.process_response(self.request, HttpResponse())
+        self.assertFalse(hasattr(self.request, 'affected_profile'))
+
+    def test_middleware(self):
+        with self.settings(AFFECTED_PROFILE_RATE=1):
+            mw = AffectMiddleware()
+            mw.process_request(self.request)
+            mw.process_response(self.request, HttpResponse())
+
+            profiler = get_profiler()
+            self.assertEqual(profiler.requests, 1)
+            self.assertIn('evaluate', profiler.report())
+            self.assertListEqual(
+                [row[:2] for row in profiler.criteria_report()],
+                [('test_crit', 1)])
+            self.assertFalse(hasattr(self.request, 'affected_profile'))
+
+
+class ProfileAdminTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+
+    def test_change_list_link(self):
+        response = self.client.get('/admin/affect/criteria/')
+        self.assertContains(response, '<a href="profile/">Profile</a>')
+        self.assertContains(response, '<a href="hits/">Hit rates</a>')
+
+    def test_profiling_off(self):
+        response = self.client.get('/admin/affect/criteria/profile/')
+        self.assertContains(response, 'AFFECTED_PROFILE_RATE')
+
+    def test_profile(self):
+        with self.settings(AFFECTED_PROFILE_RATE=1):
+            profiler = get_profiler()
+            profile = profiler.start()
+            profile.enable()
+            sorted(range(10))
+            profile.disable()
+            profiler.add(profile, {'test_crit': 0.0025})
+            response = self.client.get('/admin/affect/criteria/profile/')
+            self.assertContains(response, '1 requests profiled')
+            self.assertContains(response, '<td>test_crit</td><td>1</td>')
+            self.assertContains(response, '2.50')
+
+            response = self.client.post('/admin/affect/criteria/profile/')
+            self.assertContains(response, '0 requests profiled')
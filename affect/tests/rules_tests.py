@@ -0,0 +1,724 @@
+from datetime import timedelta
+import json
+import pickle
+import time
+
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+import mox
+
+from affect import rules as rules_module, utils
+from affect.models import CompiledRules, Criteria, Flag, datetime
+from affect.rules import (
+    CriteriaRecord, FlagRecord, RequestContext, RuleSet, Snapshot, get_rules,
+    load_compiled, random, store_compiled)
+from affect.tests.helpers import Clock
+
+
+class RequestContextTest(TestCase):
+    def test_defaults(self):
+        context = RequestContext()
+        self.assertIs(context.is_authenticated, False)
+        self.assertDictEqual(context.query, {})
+        self.assertDictEqual(context.cookies, {})
+
+    def test_user_id_is_authenticated(self):
+        self.assertIs(RequestContext(user_id=1).is_authenticated, True)
+
+    def test_querystring(self):
+        context = RequestContext(query='foo=bar&foo=baz&a=b')
+        self.assertDictEqual(context.query, {'foo': 'baz', 'a': 'b'})
+
+    def test_query_dict_lists(self):
+        context = RequestContext(query={'foo': ['bar', 'baz'], 'a': []})
+        self.assertDictEqual(context.query, {'foo': 'baz'})
+
+    def test_from_request(self):
+        user = User.objects.create(username='test_user', is_staff=True)
+        group = Group.objects.create(name='test_group')
+        user.groups.add(group)
+        request = RequestFactory().get(
+            '/path/', {'foo': ['bar', 'baz']}, HTTP_REFERER='http://ex.com/',
+            HTTP_USER_AGENT='agent', HTTP_ACCEPT_LANGUAGE='fr-CA',
+            REMOTE_ADDR='192.0.2.1')
+        request.COOKIES['dac_test'] = 'True'
+        request.user = user
+
+        context = RequestContext.from_request(request)
+        self.assertEqual(context.user_id, user.pk)
+        self.assertIs(context.is_staff, True)
+        self.assertIs(context.is_superuser, False)
+        self.assertEqual(context.group_ids, frozenset([group.pk]))
+        self.assertEqual(context.path, '/path/')
+        self.assertDictEqual(context.query, {'foo': 'baz'})
+        self.assertEqual(context.referrer, 'http://ex.com/')
+        self.assertEqual(context.user_agent, 'agent')
+        self.assertEqual(context.accept_language, 'fr-CA')
+        self.assertEqual(context.ip, '192.0.2.1')
+        self.assertDictEqual(context.cookies, {'dac_test': 'True'})
+
+        with self.assertNumQueries(0):
+            context = RequestContext.from_request(request, groups=False)
+        self.assertIs(context.group_ids, None)
+
+    def test_from_anonymous_request(self):
+        request = RequestFactory().get('')
+        request.user = AnonymousUser()
+        context = RequestContext.from_request(request)
+        self.assertIs(context.user_id, None)
+        self.assertIs(context.is_authenticated, False)
+        self.assertIs(context.is_staff, False)
+        self.assertIs(context.group_ids, None)
+
+
+class GetRulesTest(TestCase):
+    def setUp(self):
+        rules_module.snapshot.clear()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+        rules_module.snapshot.clear()
+
+    def test_kept_for_version(self):
+        self.mock.StubOutWithMock(cache, 'get')
+        cache.get('criteria:rules:version').MultipleTimes().AndReturn('v1')
+
+        self.mock.ReplayAll()
+        rules = get_rules()
+        with self.assertNumQueries(0):
+            self.assertIs(get_rules(), rules)
+        self.mock.VerifyAll()
+
+    def test_rebuilt_on_new_version(self):
+        self.mock.StubOutWithMock(cache, 'get')
+        cache.get('criteria:rules:version').AndReturn('v1')
+        cache.get('criteria:rules:version').AndReturn('v2')
+
+        self.mock.ReplayAll()
+        rules = get_rules()
+        Criteria.objects.create(name='new_crit')
+        self.assertEqual(
+            [r.name for r in get_rules().criteria], ['new_crit'])
+        self.mock.VerifyAll()
+        self.assertEqual(rules.criteria, ())
+
+    def test_version_added(self):
+        self.mock.StubOutWithMock(cache, 'get')
+        self.mock.StubOutWithMock(cache, 'add')
+        cache.get('criteria:rules:version')
+        cache.add('criteria:rules:version', mox.IsA(str), 30 * 24 * 3600)
+        cache.get('criteria:rules:version').AndReturn('v1')
+        cache.get('criteria:rules:version').AndReturn('v1')
+
+        self.mock.ReplayAll()
+        self.assertIs(get_rules(), get_rules())
+        self.mock.VerifyAll()
+
+    def test_version_changed_on_flush(self):
+        self.mock.StubOutWithMock(cache, 'set')
+        cache.set('criteria:rules:version', mox.IsA(str), 30 * 24 * 3600)
+
+        self.mock.ReplayAll()
+        utils.invalidate()
+        utils.flush_invalidations()
+        self.mock.VerifyAll()
+
+    def test_rebuilt_at_transition(self):
+        Criteria.objects.create(
+            name='later', start=datetime.now() + timedelta(seconds=90))
+        self.mock.StubOutWithMock(cache, 'get')
+        cache.get('criteria:rules:version').MultipleTimes().AndReturn('v1')
+        self.mock.StubOutWithMock(rules_module.snapshot, 'clock')
+        rules_module.snapshot.clock().MultipleTimes().AndReturn(time.time())
+
+        self.mock.ReplayAll()
+        rules = get_rules()
+        self.assertIs(get_rules(), rules)
+        self.mock.ResetAll()
+        rules_module.snapshot.clock().MultipleTimes().AndReturn(
+            rules.expires + 1)
+        cache.get('criteria:rules:version').MultipleTimes().AndReturn('v1')
+
+        self.mock.ReplayAll()
+        self.assertIsNot(get_rules(), rules)
+        self.mock.VerifyAll()
+
+
+class CompiledRulesTest(TestCase):
+    def setUp(self):
+        crit = Criteria.objects.create(name='test_crit', staff=True)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+
+    def test_load_stored(self):
+        store_compiled('v1')
+        with self.assertNumQueries(1):
+            rules = load_compiled('v1')
+        self.assertEqual([r.name for r in rules.criteria], ['test_crit'])
+        self.assertListEqual(list(rules.flags), ['test_flag'])
+
+    def test_stored_as_json(self):
+        Criteria.objects.create(
+            name='other', percent='12.5', query_args={'a': ['re:^b', 'c']},
+            referrer='*.example.com', expression='staff and not query:x=1')
+        Flag.objects.get().conflicts.add(Flag.objects.create(name='other'))
+        stored = store_compiled('v1')
+        data = json.loads(CompiledRules.objects.get().data)
+        self.assertEqual(len(data['criteria']), 2)
+        rules = load_compiled('v1')
+        self.assertEqual(rules.criteria, stored.criteria)
+        for loaded, record in zip(rules.criteria, stored.criteria):
+            self.assertTupleEqual(tuple(loaded), tuple(record))
+        self.assertDictEqual(rules.flags, stored.flags)
+        self.assertTupleEqual(
+            tuple(rules.flags['test_flag']),
+            tuple(stored.flags['test_flag']))
+        self.assertEqual(rules.built, stored.built)
+
+    def test_load_missing(self):
+        rules = load_compiled('v1')
+        self.assertEqual([r.name for r in rules.criteria], ['test_crit'])
+        self.assertEqual(CompiledRules.objects.get().version, 'v1')
+
+    def test_other_version_ignored(self):
+        store_compiled('v1')
+        Criteria.objects.create(name='new_crit')
+        rules = load_compiled('v2')
+        self.assertEqual(sorted(r.name for r in rules.criteria),
+                         ['new_crit', 'test_crit'])
+        self.assertEqual(CompiledRules.objects.get().version, 'v2')
+        with self.assertNumQueries(1):
+            load_compiled('v2')
+
+    def test_stored_once_per_version(self):
+        store_compiled('v1')
+        Criteria.objects.create(name='new_crit')
+        store_compiled('v1')
+        row = CompiledRules.objects.get()
+        self.assertEqual(row.version, 'v1')
+        self.assertEqual(
+            sorted(r.name for r in load_compiled('v1').criteria),
+            ['new_crit', 'test_crit'])
+
+    def test_older_version_kept_out(self):
+        store_compiled('v2')
+        CompiledRules.objects.create(
+            version='v1', format=rules_module.COMPILED_FORMAT, data='{}')
+        Criteria.objects.create(name='new_crit')
+        with self.assertNumQueries(1):
+            rules = load_compiled('v2')
+        self.assertEqual([r.name for r in rules.criteria], ['test_crit'])
+
+    def test_other_format_rebuilt(self):
+        store_compiled('v1')
+        CompiledRules.objects.update(format=0, data='')
+        self.assertEqual(
+            [r.name for r in load_compiled('v1').criteria], ['test_crit'])
+        self.assertEqual(CompiledRules.objects.get().format,
+                         rules_module.COMPILED_FORMAT)
+
+    def test_unreadable_rebuilt(self):
+        store_compiled('v1')
+        CompiledRules.objects.update(data='bad')
+        self.assertEqual(
+            [r.name for r in load_compiled('v1').criteria], ['test_crit'])
+
+    def test_expired_rebuilt(self):
+        Criteria.objects.create(
+            name='later', start=datetime.now() + timedelta(seconds=90))
+        store_compiled('v1')
+        expires = load_compiled('v1').expires
+        mock = mox.Mox()
+        mock.StubOutWithMock(rules_module.time, 'time')
+        rules_module.time.time().MultipleTimes().AndReturn(expires + 1)
+
+        mock.ReplayAll()
+        rules = load_compiled('v1')
+        mock.VerifyAll()
+        mock.UnsetStubs()
+        self.assertEqual(
+            sorted(r.name for r in rules.criteria), ['later', 'test_crit'])
+
+    def test_current_version(self):
+        mock = mox.Mox()
+        mock.StubOutWithMock(rules_module, 'rules_version')
+        rules_module.rules_version().AndReturn('v1')
+        rules_module.rules_version().AndReturn('v1')
+
+        mock.ReplayAll()
+        store_compiled()
+        with self.assertNumQueries(1):
+            load_compiled()
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.loads = []
+        self.clock = Clock()
+        self.snapshot = Snapshot(self.load, ttl=10, clock=self.clock)
+
+    def load(self, **kwargs):
+        self.loads.append(kwargs)
+        return len(self.loads)
+
+    def test_fill_once(self):
+        self.assertIs(self.snapshot.get(), None)
+        self.assertEqual(self.snapshot.fill(since=1), 1)
+        self.assertEqual(self.snapshot.fill(since=2), 1)
+        self.assertEqual(self.snapshot.get(), 1)
+        self.assertListEqual(self.loads, [{'since': 1}])
+
+    def test_refresh(self):
+        self.snapshot.swap('old')
+        self.snapshot.refresh(token='a')
+        self.assertEqual(self.snapshot.get(), 1)
+        self.snapshot.clear()
+        self.assertIs(self.snapshot.get(), None)
+
+    def test_expired_refreshed_in_background(self):
+        self.snapshot.swap('old')
+        self.clock.now += 10
+        self.assertEqual(self.snapshot.get(), 'old')
+        for _ in range(500):
+            if self.snapshot.get() != 'old':
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.snapshot.get(), 1)
+        self.assertListEqual(self.loads, [{'since': 1010.0}])
+        self.assertEqual(self.snapshot.current[1], 1020.0)
+
+    def test_expires_at_transition(self):
+        self.snapshot.ttl = None
+        self.snapshot.swap(RuleSet([], {}, expires=1005.0))
+        self.assertEqual(self.snapshot.current[1], 1005.0)
+        self.snapshot.ttl = 10
+        self.snapshot.swap(RuleSet([], {}, expires=1050.0))
+        self.assertEqual(self.snapshot.current[1], 1010.0)
+
+    def test_ttl_setting(self):
+        rules = RuleSet([], {})
+        mock = mox.Mox()
+        mock.StubOutWithMock(rules_module, 'build_rules')
+        rules_module.build_rules().AndReturn(rules)
+
+        mock.ReplayAll()
+        with self.settings(AFFECTED_SNAPSHOT_TTL=60):
+            self.assertIs(get_rules(), rules)
+            self.assertIs(get_rules(), rules)
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+
+class RuleSetLoadTest(TestCase):
+    def setUp(self):
+        self.crit = Criteria.objects.create(
+            name='test_crit', referrer='example.com,www.example.com')
+        self.flag = Flag.objects.create(name='test_flag', priority=10)
+        self.inactive = Flag.objects.create(name='off_flag', active=False)
+        self.crit.flags.add(self.flag, self.inactive)
+        self.user = User.objects.create(username='test_user')
+        self.group = Group.objects.create(name='test_group')
+        self.crit.users.add(self.user)
+        self.crit.groups.add(self.group)
+
+    def test_load(self):
+        with self.assertNumQueries(6):
+            rules = RuleSet.load()
+        record, = rules.criteria
+        self.assertIsInstance(record, CriteriaRecord)
+        self.assertEqual(record.id, self.crit.pk)
+        self.assertEqual(record.name, 'test_crit')
+        self.assertEqual(record.flags, frozenset(['test_flag']))
+        self.assertEqual(record.users, frozenset([self.user.pk]))
+        self.assertEqual(record.groups, frozenset([self.group.pk]))
+        self.assertEqual(
+            record.referrers, frozenset(['example.com', 'www.example.com']))
+        self.assertEqual(record.entry_urls, frozenset())
+        self.assertDictEqual(rules.flags, {
+            'test_flag': FlagRecord(self.flag.pk, 'test_flag', 10, frozenset())
+        })
+        self.assertIs(rules.uses_groups, True)
+
+    def test_schedule(self):
+        now = datetime.now()
+        self.crit.start = now + timedelta(hours=1)
+        self.crit.save()
+        Criteria.objects.create(name='ended', end=now)
+        Criteria.objects.create(
+            name='running', start=now - timedelta(hours=1),
+            end=now + timedelta(hours=2))
+        self.flag.end = now + timedelta(minutes=30)
+        self.flag.save()
+        Flag.objects.create(name='later_flag', start=now + timedelta(
+            minutes=10), end=now + timedelta(minutes=20))
+
+        rules = RuleSet.load()
+        self.assertListEqual(
+            [record.name for record in rules.criteria], ['running'])
+        self.assertListEqual(rules.flags.keys(), ['test_flag'])
+        self.assertAlmostEqual(
+            rules.expires, time.time() + 600, delta=5)
+        self.assertIs(rules.expired(), False)
+        self.assertIs(rules.expired(rules.expires), True)
+
+        rules = RuleSet.load(now=rules.expires + 1)
+        self.assertListEqual(sorted(rules.flags), [
+            'later_flag', 'test_flag'])
+        self.assertAlmostEqual(
+            rules.expires, time.time() + 1200, delta=5)
+
+    def test_unscheduled(self):
+        self.assertIs(RuleSet.load().expires, None)
+        self.assertIs(RuleSet.load().expired(), False)
+
+    def test_conflicts_by_priority(self):
+        higher = Flag.objects.create(name='higher_flag', priority=20)
+        self.flag.conflicts.add(higher)
+        rules = RuleSet.load()
+        self.assertEqual(
+            rules.flags['test_flag'].conflicts, frozenset(['higher_flag']))
+        self.assertEqual(rules.flags['higher_flag'].conflicts, frozenset())
+
+    def test_pickle(self):
+        rules = pickle.loads(pickle.dumps(RuleSet.load(), -1))
+        record, = rules.criteria
+        self.assertEqual(record.referrers, frozenset(
+            ['example.com', 'www.example.com']))
+        self.assertEqual(rules.flags['test_flag'].priority, 10)
+
+
+class CriteriaRecordTest(TestCase):
+    def setUp(self):
+        self.crit = Criteria.objects.create(
+            name='test_crit', query_args={
+                'foo': ['bar', 1], 'any': '*', 'one': 'two', 'bad': {}})
+
+    def test_query_args(self):
+        record = CriteriaRecord.from_model(self.crit)
+        self.assertEqual(record.query_args, (
+            ('any', '*'), ('foo', 'bar'), ('one', 'two')))
+
+    def test_immutable(self):
+        record = CriteriaRecord.from_model(self.crit)
+        self.assertRaises(AttributeError, setattr, record, 'name', 'other')
+        self.assertRaises(AttributeError, setattr, record, 'other', 1)
+
+    def test_identity(self):
+        record = CriteriaRecord.from_model(self.crit)
+        self.crit.name = 'renamed'
+        renamed = CriteriaRecord.from_model(self.crit)
+        self.assertEqual(record, renamed)
+        self.assertEqual(hash(record), hash(renamed))
+        self.assertNotEqual(record, self.crit.pk)
+        self.assertEqual(str(record), 'test_crit')
+
+
+class RuleSetEvaluateTest(TestCase):
+    def setUp(self):
+        self.crit = Criteria.objects.create(name='test_crit')
+        self.flag = Flag.objects.create(name='test_flag')
+        self.crit.flags.add(self.flag)
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
+    def assertFlags(self, context, flags):
+        self.assertEqual(RuleSet.load().evaluate(context), frozenset(flags))
+
+    def test_meets_nothing(self):
+        self.assertFlags(RequestContext(), [])
+
+    def test_everyone(self):
+        self.crit.everyone = True
+        self.crit.save()
+        self.assertFlags(RequestContext(), ['test_flag'])
+
+    def test_nobody_overrides(self):
+        self.crit.everyone = False
+        self.crit.staff = True
+        self.crit.save()
+        self.assertFlags(RequestContext(is_staff=True), [])
+
+    def test_testing_query(self):
+        self.crit.testing = True
+        self.crit.save()
+        self.assertFlags(
+            RequestContext(query={'dact_test_crit': '1'}), ['test_flag'])
+        self.assertFlags(
+            RequestContext(query={'dact_test_crit': '0'},
+                           cookies={'dact_test_crit': 'True'}), [])
+
+    def test_persistent_cookie(self):
+        self.crit.persistent = True
+        self.crit.authenticated = True
+        self.crit.save()
+        self.assertFlags(
+            RequestContext(user_id=1, cookies={'dac_test_crit': 'False'}), [])
+
+    def test_authenticated(self):
+        self.crit.authenticated = True
+        self.crit.save()
+        self.assertFlags(RequestContext(user_id=1), ['test_flag'])
+        self.assertFlags(RequestContext(), [])
+
+    def test_referrer(self):
+        self.crit.referrer = 'example.com'
+        self.crit.save()
+        self.assertFlags(
+            RequestContext(referrer='http://example.com/blah'), ['test_flag'])
+
+    def test_referrer_domains(self):
+        self.crit.referrer = '*.google.com,news.*'
+        self.crit.save()
+        for referrer, flags in [('http://www.google.com/q', ['test_flag']),
+                                ('http://news.example.com/', ['test_flag']),
+                                ('http://example.com/', []),
+                                ('', [])]:
+            self.assertFlags(RequestContext(referrer=referrer), flags)
+
+    def test_entry_url(self):
+        self.crit.entry_url = '/test.html,/other.html'
+        self.crit.save()
+        self.assertFlags(
+            RequestContext(path='/test.html', host='testserver.com',
+                           referrer='http://example.com/blah'), ['test_flag'])
+        self.assertFlags(
+            RequestContext(path='/test.html', host='example.com',
+                           referrer='http://example.com/blah'), [])
+
+    def test_entry_url_patterns(self):
+        self.crit.entry_url = '/blog/*,name:admin:index,/promo-??.html'
+        self.crit.save()
+        for path, flags in [('/blog/post/1', ['test_flag']),
+                            ('/blog', []),
+                            ('/admin/', ['test_flag']),
+                            ('/promo-12.html', ['test_flag']),
+                            ('/promo-123.html', [])]:
+            self.assertFlags(RequestContext(path=path), flags)
+
+    def test_entry_url_nonentry_domain(self):
+        self.crit.entry_url = '/test.html'
+        self.crit.save()
+        with self.settings(AFFECTED_NONENTRY_DOMAINS=['example.com']):
+            self.assertFlags(
+                RequestContext(path='/test.html', host='testserver.com',
+                               referrer='http://example.com/blah'), [])
+
+    def test_query_args(self):
+        self.crit.query_args = {'foo': ['bar', 'baz'], 'any': '*'}
+        self.crit.save()
+        self.assertFlags(RequestContext(query='foo=baz'), ['test_flag'])
+        self.assertFlags(RequestContext(query='any=1'), ['test_flag'])
+        self.assertFlags(RequestContext(query='foo=boz'), [])
+
+    def test_query_args_patterns(self):
+        self.crit.query_args = {'utm_*': ['re:^cpc-[0-9]+$', 'spring-*']}
+        self.crit.save()
+        self.assertFlags(RequestContext(query='utm_medium=cpc-12'),
+                         ['test_flag'])
+        self.assertFlags(RequestContext(query='utm_source=spring-mail'),
+                         ['test_flag'])
+        self.assertFlags(RequestContext(query='utm_source=cpc-a'), [])
+        self.assertFlags(RequestContext(query='source=spring-mail'), [])
+
+    def test_ip_ranges(self):
+        self.crit.ip_ranges = '192.0.2.0/24,2001:db8::/32,invalid'
+        self.crit.save()
+        self.assertFlags(RequestContext(ip='192.0.2.200'), ['test_flag'])
+        self.assertFlags(RequestContext(ip='2001:db8::1'), ['test_flag'])
+        self.assertFlags(RequestContext(ip='192.0.3.1'), [])
+        self.assertFlags(RequestContext(), [])
+
+    def test_countries(self):
+        self.crit.countries = 'gb,IE'
+        self.crit.save()
+        geo = self.mock.CreateMockAnything()
+        self.mock.StubOutWithMock(rules_module, 'get_geo_database')
+        rules_module.get_geo_database().AndReturn(geo)
+        geo.country('192.0.2.1').AndReturn('GB')
+        rules_module.get_geo_database().AndReturn(geo)
+        geo.country('192.0.2.2').AndReturn(None)
+        rules_module.get_geo_database().AndReturn(None)
+
+        self.mock.ReplayAll()
+        self.assertFlags(RequestContext(ip='192.0.2.1'), ['test_flag'])
+        self.assertFlags(RequestContext(ip='192.0.2.2'), [])
+        self.assertFlags(RequestContext(ip='192.0.2.3'), [])
+        self.assertFlags(RequestContext(), [])
+        self.mock.VerifyAll()
+
+    def test_languages(self):
+        self.crit.languages = 'fr,pt-BR'
+        self.crit.save()
+        rules = RuleSet.load()
+        self.assertEqual(
+            rules.evaluate(RequestContext(accept_language='fr-CA,en;q=0.5'),
+                           {}), frozenset(['test_flag']))
+        self.assertFlags(RequestContext(accept_language='en, pt-br;q=0.1'),
+                         ['test_flag'])
+        self.assertFlags(RequestContext(accept_language='pt, en'), [])
+        self.assertFlags(RequestContext(accept_language='fr;q=0'), [])
+        self.assertFlags(RequestContext(), [])
+
+    def test_expression_language(self):
+        self.crit.superusers = False
+        self.crit.expression = 'language:de and not language:de-AT'
+        self.crit.save()
+        self.assertFlags(RequestContext(accept_language='de-DE'),
+                         ['test_flag'])
+        self.assertFlags(RequestContext(accept_language='de-at, de'), [])
+        self.assertFlags(RequestContext(accept_language='en'), [])
+
+    def test_device_type(self):
+        self.crit.device_type = Criteria.MOBILE_DEVICE
+        self.crit.save()
+        self.assertFlags(
+            RequestContext(user_agent='Mozilla/5.0 (iPhone)'), ['test_flag'])
+
+    def test_users_and_groups(self):
+        user = User.objects.create(username='test_user')
+        group = Group.objects.create(name='test_group')
+        self.crit.users.add(user)
+        self.assertFlags(RequestContext(user_id=user.pk), ['test_flag'])
+        self.crit.users.clear()
+        self.crit.groups.add(group)
+        self.assertFlags(
+            RequestContext(user_id=user.pk, group_ids=[group.pk]),
+            ['test_flag'])
+
+    def test_decisions(self):
+        self.crit.referrer = 'example.com'
+        self.crit.save()
+        other = Criteria.objects.create(name='other_crit', everyone=False)
+        other.flags.add(self.flag)
+        decisions = {}
+        rules = RuleSet.load()
+        self.assertEqual(
+            rules.evaluate(RequestContext(referrer='http://example.com/'),
+                           decisions),
+            frozenset(['test_flag']))
+        self.assertDictEqual(
+            dict((c.name, d) for c, d in decisions.items()),
+            {'test_crit': (True, 'referrer'),
+             'other_crit': (False, 'everyone')})
+
+    def test_percent(self):
+        self.crit.percent = 50
+        self.crit.save()
+        self.mock.StubOutWithMock(random, 'uniform')
+        random.uniform(0, 100).AndReturn(20)
+        random.uniform(0, 100).AndReturn(99)
+
+        self.mock.ReplayAll()
+        self.assertFlags(RequestContext(), ['test_flag'])
+        self.assertFlags(RequestContext(), [])
+        self.assertFlags(
+            RequestContext(cookies={'dac_test_crit': 'True'}), ['test_flag'])
+        self.mock.VerifyAll()
+
+    def test_expression(self):
+        self.crit.superusers = False
+        self.crit.expression = (
+            'mobile and referrer:*.google.com and not staff')
+        self.crit.save()
+        iphone = 'Mozilla/5.0 (iPhone)'
+        google = 'http://www.google.com/search'
+        self.assertFlags(RequestContext(
+            user_agent=iphone, referrer=google), ['test_flag'])
+        self.assertFlags(RequestContext(
+            user_agent=iphone, referrer=google, is_staff=True), [])
+        self.assertFlags(RequestContext(referrer=google), [])
+        self.assertFlags(RequestContext(user_agent=iphone), [])
+
+    def test_expression_predicates(self):
+        self.crit.superusers = False
+        self.crit.expression = (
+            '(entry_url:/blog/* or query:utm_*=spring-*) and (user:1 or '
+            'group:2) and authenticated and desktop')
+        self.crit.save()
+        self.assertFlags(RequestContext(
+            user_id=1, path='/blog/post', referrer='http://a.com/',
+            host='b.com'), ['test_flag'])
+        self.assertFlags(RequestContext(
+            user_id=3, group_ids=[2], query='utm_source=spring-mail'),
+            ['test_flag'])
+        self.assertFlags(RequestContext(
+            user_id=1, path='/blog/post', referrer='http://b.com/',
+            host='b.com'), [])
+        self.assertFlags(RequestContext(
+            user_id=3, group_ids=[1], query='utm_source=spring-mail'), [])
+
+    def test_expression_shared(self):
+        self.crit.expression = 'mobile and staff'
+        self.crit.save()
+        Criteria.objects.create(name='other', expression='staff and mobile')
+        other = Criteria.objects.create(
+            name='third', expression='mobile and not criteria:other')
+        other.flags.add(Flag.objects.create(name='other_flag'))
+        rules = RuleSet.load()
+        self.assertIs(
+            rules.expressions[rules.by_name['test_crit']],
+            rules.expressions[rules.by_name['other']])
+
+        self.mock.StubOutWithMock(rules_module, 'detect_user_agent')
+        rules_module.detect_user_agent('Mozilla/5.0 (iPhone)', '').AndReturn(
+            Criteria.MOBILE_DEVICE)
+        self.mock.ReplayAll()
+        self.assertEqual(rules.evaluate(RequestContext(
+            user_agent='Mozilla/5.0 (iPhone)', is_staff=True,
+            is_superuser=False)), frozenset(['test_flag']))
+        self.mock.VerifyAll()
+
+    def test_expression_refers_to_criteria(self):
+        self.crit.expression = 'criteria:split'
+        self.crit.save()
+        Criteria.objects.create(name='split', percent=50)
+        rules = RuleSet.load()
+        for _ in range(20):
+            decisions = {}
+            rules.evaluate(RequestContext(), decisions)
+            active = decisions[rules.by_name['split']][0]
+            self.assertEqual(
+                decisions[rules.by_name['test_crit']],
+                (True, 'expression') if active else (False, None))
+
+    def test_expression_cycle_never(self):
+        self.crit.expression = 'staff and criteria:other'
+        self.crit.save()
+        Criteria.objects.create(name='other', expression='criteria:test_crit')
+        Criteria.objects.create(name='bad', expression='staff and')
+        rules = RuleSet.load()
+        context = RequestContext(is_staff=True)
+        for record in rules.criteria:
+            self.assertEqual(rules.decide(record, context), (False, None))
+
+    def test_expression_unknown_criteria_inactive(self):
+        self.crit.expression = 'staff and not criteria:missing'
+        self.crit.save()
+        Criteria.objects.create(
+            name='later', start=datetime.now() + timedelta(days=1))
+        Criteria.objects.create(
+            name='other', expression='criteria:later or staff')
+        rules = RuleSet.load()
+        context = RequestContext(is_staff=True)
+        for record in rules.criteria:
+            self.assertEqual(
+                rules.decide(record, context), (True, 'expression'))
+        context = RequestContext(is_staff=False)
+        for record in rules.criteria:
+            self.assertEqual(rules.decide(record, context), (False, None))
+
+    def test_conflicts(self):
+        self.crit.everyone = True
+        self.crit.save()
+        higher = Flag.objects.create(name='higher_flag', priority=100)
+        lower = Flag.objects.create(name='lower_flag', priority=-1)
+        self.crit.flags.add(higher, lower)
+        self.flag.conflicts.add(higher)
+        lower.conflicts.add(self.flag)
+        self.assertFlags(RequestContext(), ['higher_flag', 'lower_flag'])
@@ -0,0 +1,163 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import Group, User
+from django.test import TestCase
+from django.utils.unittest import skipIf
+
+from affect.models import Criteria, Flag
+from affect.rules import RequestContext, RuleSet
+from affect.simulate import Columns, Decider, numpy, propose, simulate
+
+
+class ProposeTest(TestCase):
+    def setUp(self):
+        self.crit = Criteria.objects.create(name='test_crit', percent=10)
+        self.flag = Flag.objects.create(name='test_flag')
+        self.crit.flags.add(self.flag)
+        Criteria.objects.create(name='removed_crit')
+        self.rules = RuleSet.load()
+
+    def test_changes(self):
+        group = Group.objects.create(name='test_group')
+        proposed = propose(self.rules, {
+            'test_crit': {'percent': 20.5, 'referrer': '*.example.com'},
+            'removed_crit': None,
+            'new_crit': {'staff': True, 'flags': ['test_flag'],
+                         'groups': [group.pk]}})
+        records = dict((r.name, r) for r in proposed.criteria)
+        self.assertListEqual(sorted(records), ['new_crit', 'test_crit'])
+        self.assertEqual(records['test_crit'].percent, Decimal('20.5'))
+        self.assertEqual(records['test_crit'].flags, frozenset(['test_flag']))
+        self.assertEqual(
+            records['test_crit'].referrers, frozenset(['*.example.com']))
+        self.assertIs(records['new_crit'].staff, True)
+        self.assertEqual(records['new_crit'].groups, frozenset([group.pk]))
+        self.assertLess(records['new_crit'].id, 0)
+        self.assertIsNot(proposed.referrers.match('www.example.com'), None)
+        self.assertEqual(
+            Criteria.objects.get(name='test_crit').percent, Decimal('10'))
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, propose, self.rules,
+                          {'test_crit': {'bogus': 1}})
+
+    def test_invalid_percent(self):
+        self.assertRaises(ValueError, propose, self.rules,
+                          {'test_crit': {'percent': 'ten'}})
+
+    def test_unknown_flag(self):
+        self.assertRaises(ValueError, propose, self.rules,
+                          {'test_crit': {'flags': ['missing_flag']}})
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class DeciderTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_user')
+        self.group = Group.objects.create(name='test_group')
+        self.user.groups.add(self.group)
+        self.contexts = [
+            RequestContext(),
+            RequestContext(user_id=self.user.pk, is_staff=True,
+                           group_ids=[self.group.pk]),
+            RequestContext(is_superuser=True),
+            RequestContext(referrer='http://www.example.com/',
+                           host='site.com', path='/blog/post'),
+            RequestContext(referrer='http://site.com/', host='site.com',
+                           path='/blog/post'),
+            RequestContext(query='utm_source=spring-mail&dact_tester=0'),
+            RequestContext(query='dact_tester=1', cookies={
+                'dac_sticky': 'False', 'dac_tester': 'True'}),
+            RequestContext(cookies={'dac_sticky': 'True', 'dact_tester': '0'}),
+            RequestContext(user_agent='Mozilla/5.0 (iPhone)'),
+            RequestContext(ip='192.0.2.7'),
+            RequestContext(ip='2001:db8::1', is_staff=True),
+            RequestContext(accept_language='fr-CA, en;q=0.5'),
+            RequestContext(accept_language='de-AT', is_staff=True),
+        ]
+        for name, fields in [
+                ('tester', {'testing': True, 'staff': True}),
+                ('sticky', {'persistent': True, 'authenticated': True}),
+                ('super', {}),
+                ('referred', {'referrer': '*.example.com'}),
+                ('entry', {'entry_url': '/blog/*'}),
+                ('campaign', {'query_args': {'utm_*': 'spring-*'}}),
+                ('mobile', {'device_type': Criteria.MOBILE_DEVICE}),
+                ('office', {'ip_ranges': '192.0.2.0/24,2001:db8::/32'}),
+                ('french', {'languages': 'fr,de-at'}),
+                ('german', {'superusers': False, 'expression': (
+                    'language:de and not staff')}),
+                ('off', {'everyone': False, 'staff': True}),
+                ('combined', {'superusers': False, 'expression': (
+                    '(mobile or referrer:*.example.com or query:dact_*=1) '
+                    'and not (staff or user:%d) and not criteria:entry' % (
+                        self.user.pk))}),
+                ('grouped', {'superusers': False, 'expression': (
+                    'group:%d or entry_url:/blog/* and authenticated' % (
+                        self.group.pk))})]:
+            crit = Criteria.objects.create(name=name, **fields)
+            crit.flags.add(Flag.objects.create(name=name + '_flag'))
+        crit = Criteria.objects.create(name='members', superusers=False)
+        crit.users.add(self.user)
+        crit.groups.add(self.group)
+        crit.flags.add(Flag.objects.create(name='members_flag'))
+
+    def test_matches_rule_set(self):
+        rules = RuleSet.load()
+        decider = Decider(rules, Columns(self.contexts))
+        for record in rules.criteria:
+            self.assertListEqual(
+                list(decider.decide(record)),
+                [rules.matches(record, context) for context in self.contexts],
+                record.name)
+
+    def test_percent_draws_nested(self):
+        crit = Criteria.objects.create(name='split', percent=20)
+        crit.flags.add(Flag.objects.create(name='split_flag'))
+        rules = RuleSet.load()
+        record, = [r for r in rules.criteria if r.name == 'split']
+        contexts = [RequestContext() for _ in range(1000)]
+        contexts[0].cookies = {'dac_split': 'False'}
+        decider = Decider(rules, Columns(contexts))
+        lower = decider.decide(record)
+        higher = decider.decide(record._replace(percent=Decimal(50)))
+        self.assertFalse(lower[0] or higher[0])
+        self.assertTrue(150 < lower.sum() < 250)
+        self.assertTrue((higher >= lower).all())
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class SimulateTest(TestCase):
+    def setUp(self):
+        self.crit = Criteria.objects.create(
+            name='test_crit', referrer='example.com')
+        self.flag = Flag.objects.create(name='test_flag', priority=10)
+        self.crit.flags.add(self.flag)
+        self.staff = Criteria.objects.create(name='staff_crit', staff=True)
+        self.other = Flag.objects.create(name='other_flag', priority=20)
+        self.staff.flags.add(self.other)
+        self.flag.conflicts.add(self.other)
+        self.user = User.objects.create(username='test_user', is_staff=True)
+
+    def test_report(self):
+        contexts = [
+            RequestContext(referrer='http://example.com/'),
+            RequestContext(referrer='http://www.example.com/'),
+            RequestContext(user_id=self.user.pk,
+                           referrer='http://example.com/'),
+            RequestContext()]
+        report = simulate(
+            contexts, {'test_crit': {'referrer': '*.example.com'}})
+        self.assertEqual(report.records, 4)
+        self.assertEqual(report.changed, 1)
+        impacts = dict((impact.flag, impact) for impact in report.flags)
+        self.assertTupleEqual(
+            tuple(impacts['test_flag']), ('test_flag', 1, 2, 1, 0, 1, 1))
+        self.assertTupleEqual(
+            tuple(impacts['other_flag']), ('other_flag', 1, 1, 0, 0, 0, 0))
+
+    def test_empty(self):
+        report = simulate([], {})
+        self.assertEqual(report.records, 0)
+        self.assertListEqual(
+            [tuple(impact)[1:] for impact in report.flags], [(0,) * 6] * 2)
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.cache import cache
+from django.test import TestCase
+import mox
+
+from affect import rules as rules_module
+from affect.models import Criteria
+from affect.rules import RuleSet, get_rules, load_rules
+from affect.snapshot import SnapshotFile
+
+
+class SnapshotFileTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'rules.snapshot')
+        self.builds = []
+        self.snapshot = SnapshotFile(self.path, self.build)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def build(self):
+        self.builds.append(1)
+        return {'build': len(self.builds)}
+
+    def test_missing(self):
+        self.assertIs(self.snapshot.read(), None)
+
+    def test_write_and_read(self):
+        self.snapshot.write({'a': 1}, 100.0, 'token')
+        self.assertDictEqual(self.snapshot.read(), {'a': 1})
+        self.assertDictEqual(self.snapshot.read(since=100.0), {'a': 1})
+        self.assertIs(self.snapshot.read(since=101.0), None)
+        self.assertDictEqual(self.snapshot.read(token='token'), {'a': 1})
+        self.assertIs(self.snapshot.read(token='other'), None)
+        self.assertListEqual(
+            sorted(os.listdir(self.dir)), ['rules.snapshot'])
+
+    def test_unreadable(self):
+        for data in ['', 'AFRS', 'x' * 100]:
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertIs(self.snapshot.read(), None)
+
+    def test_load_builds_once(self):
+        self.assertDictEqual(self.snapshot.load(), {'build': 1})
+        self.assertDictEqual(self.snapshot.load(), {'build': 1})
+        self.assertDictEqual(self.snapshot.load(token='a'), {'build': 2})
+        self.assertDictEqual(self.snapshot.load(token='a'), {'build': 2})
+        self.assertListEqual(self.builds, [1, 1])
+
+    def test_load_stale(self):
+        self.snapshot.write({'build': 0}, 100.0)
+        self.assertDictEqual(self.snapshot.load(since=50.0), {'build': 0})
+        self.assertDictEqual(self.snapshot.load(since=150.0), {'build': 1})
+
+
+class LoadRulesTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'rules.snapshot')
+        Criteria.objects.create(name='test_crit')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_snapshot_file(self):
+        with self.settings(AFFECTED_SNAPSHOT_FILE=self.path):
+            rules = load_rules()
+            self.assertIsInstance(rules, RuleSet)
+            with self.assertNumQueries(0):
+                rules = load_rules()
+            self.assertListEqual(
+                [c.name for c in rules.criteria], ['test_crit'])
+            with self.assertNumQueries(6):
+                load_rules(token='changed')
+
+    def test_snapshot_file_expired(self):
+        snapshot = SnapshotFile(self.path, None)
+        snapshot.write(RuleSet([], {}, expires=time.time() - 60),
+                       time.time() - 120)
+        with self.settings(AFFECTED_SNAPSHOT_FILE=self.path):
+            with self.assertNumQueries(6):
+                rules = load_rules()
+        self.assertListEqual(
+            [c.name for c in rules.criteria], ['test_crit'])
+        self.assertIs(snapshot.read().expires, None)
+
+    def test_rebuilt_for_new_version(self):
+        rules_module.snapshot.clear()
+        mock = mox.Mox()
+        mock.StubOutWithMock(cache, 'get')
+        cache.get('criteria:rules:version').AndReturn('v1')
+        cache.get('criteria:rules:version').AndReturn('v1')
+        cache.get('criteria:rules:version').AndReturn('v2')
+
+        mock.ReplayAll()
+        with self.settings(AFFECTED_SNAPSHOT_FILE=self.path):
+            rules = get_rules()
+            with self.assertNumQueries(0):
+                self.assertIs(get_rules(), rules)
+            Criteria.objects.create(name='new_crit')
+            self.assertListEqual(
+                sorted(c.name for c in get_rules().criteria),
+                ['new_crit', 'test_crit'])
+        mock.VerifyAll()
+        mock.UnsetStubs()
+        self.assertListEqual(
+            sorted(c.name for c in SnapshotFile(self.path, None).read(
+                token='v2').criteria), ['new_crit', 'test_crit'])
@@ -0,0 +1,225 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import Group, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from django.utils.unittest import skipIf
+import mox
+
+from affect import utils
+from affect.models import Criteria, Flag
+from affect.transfer import (
+    ImportResult, dumps, export_rules, import_rules, loads, yaml)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.flag = Flag.objects.create(name='test_flag', priority=2)
+        other = Flag.objects.create(name='other_flag')
+        self.flag.conflicts.add(other)
+        self.crit = Criteria.objects.create(
+            name='test_crit', percent=Decimal('12.5'),
+            query_args={'utm_source': 'test'}, expression='staff')
+        self.crit.flags.add(self.flag)
+        self.crit.users.add(User.objects.create(username='test_user'))
+        self.crit.groups.add(Group.objects.create(name='test_group'))
+        Criteria.objects.create(name='other_crit')
+
+    def test_export(self):
+        rules = export_rules()
+        self.assertListEqual(
+            [row['name'] for row in rules['flags']],
+            ['other_flag', 'test_flag'])
+        self.assertListEqual(rules['flags'][0]['conflicts'], ['test_flag'])
+        self.assertListEqual(
+            [row['name'] for row in rules['criteria']],
+            ['other_crit', 'test_crit'])
+        row = rules['criteria'][1]
+        self.assertEqual(row['percent'], '12.5')
+        self.assertDictEqual(row['query_args'], {'utm_source': 'test'})
+        self.assertListEqual(row['flags'], ['test_flag'])
+        self.assertListEqual(row['users'], ['test_user'])
+        self.assertListEqual(row['groups'], ['test_group'])
+        self.assertNotIn('modified', row)
+        self.assertDictEqual(loads(dumps(rules)), rules)
+
+    def test_export_criteria_with_flags(self):
+        rules = export_rules(criteria=[self.crit])
+        self.assertListEqual(
+            [row['name'] for row in rules['criteria']], ['test_crit'])
+        self.assertListEqual(
+            [row['name'] for row in rules['flags']], ['test_flag'])
+
+    @skipIf(yaml is None, 'PyYAML is not installed')
+    def test_yaml(self):
+        rules = export_rules()
+        self.assertDictEqual(loads(dumps(rules, 'yaml'), 'yaml'), rules)
+
+    @skipIf(yaml is not None, 'PyYAML is installed')
+    def test_yaml_missing(self):
+        self.assertRaises(ValueError, dumps, {}, 'yaml')
+
+
+class ImportTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_user')
+        crit = Criteria.objects.create(name='test_crit', staff=True)
+        crit.flags.add(Flag.objects.create(name='test_flag'))
+        Flag.objects.create(name='old_flag')
+        self.rules = export_rules()
+
+    def test_round_trip_unchanged(self):
+        self.assertEqual(import_rules(self.rules), ImportResult([], [], []))
+
+    def test_changes(self):
+        self.rules['criteria'][0]['percent'] = '50'
+        self.rules['criteria'][0]['users'] = ['test_user']
+        self.rules['flags'] = [row for row in self.rules['flags']
+                               if row['name'] != 'old_flag']
+        self.rules['flags'].append({'name': 'new_flag',
+                                    'conflicts': ['test_flag']})
+        self.rules['criteria'].append({
+            'name': 'new_crit', 'expression': 'criteria:test_crit',
+            'flags': ['new_flag']})
+
+        result = import_rules(self.rules, delete=True)
+        self.assertListEqual(
+            result.created, [('criteria', 'new_crit'), ('flag', 'new_flag')])
+        self.assertListEqual(
+            result.updated, [('criteria', 'test_crit'), ('flag', 'test_flag')])
+        self.assertListEqual(result.deleted, [('flag', 'old_flag')])
+
+        crit = Criteria.objects.get(name='test_crit')
+        self.assertEqual(crit.percent, Decimal('50'))
+        self.assertIs(crit.staff, True)
+        self.assertListEqual(list(crit.users.all()), [self.user])
+        new_flag = Flag.objects.get(name='new_flag')
+        self.assertListEqual(
+            [f.name for f in new_flag.conflicts.all()], ['test_flag'])
+        self.assertListEqual(
+            [f.name for f in Flag.objects.get(
+                name='test_flag').conflicts.all()], ['new_flag'])
+        self.assertListEqual(
+            [f.name for f in Criteria.objects.get(
+                name='new_crit').flags.all()], ['new_flag'])
+        self.assertEqual(import_rules(self.rules), ImportResult([], [], []))
+
+    def test_kept_without_delete(self):
+        self.rules['flags'] = []
+        self.rules['criteria'] = []
+        self.assertEqual(import_rules(self.rules), ImportResult([], [], []))
+        self.assertEqual(Flag.objects.count(), 2)
+
+    def test_dry_run(self):
+        self.rules['criteria'][0]['staff'] = False
+        self.rules['criteria'].append({'name': 'new_crit'})
+        result = import_rules(self.rules, dry_run=True)
+        self.assertListEqual(result.created, [('criteria', 'new_crit')])
+        self.assertListEqual(result.updated, [('criteria', 'test_crit')])
+        self.assertIs(Criteria.objects.get(name='test_crit').staff, True)
+        self.assertFalse(Criteria.objects.filter(name='new_crit').exists())
+
+    def test_dry_run_not_published(self):
+        self.rules['flags'] = []
+        self.rules['criteria'] = []
+        utils.flush_invalidations()
+        mock = mox.Mox()
+        mock.StubOutWithMock(utils, 'publish')
+        mock.StubOutWithMock(utils.cache, 'set')
+
+        mock.ReplayAll()
+        result = import_rules(self.rules, delete=True, dry_run=True)
+        utils.flush_invalidations()
+        mock.VerifyAll()
+        mock.UnsetStubs()
+        self.assertEqual(len(result.deleted), 3)
+        self.assertEqual(Flag.objects.count(), 2)
+
+    def test_invalid(self):
+        for change in [
+                {'version': 2},
+                {'criteria': [{'name': 'a'}, {'name': 'a'}]},
+                {'criteria': [{'name': 'a', 'percent': 'lots'}]},
+                {'criteria': [{'name': 'a', 'precent': 10}]},
+                {'criteria': [{'name': 'a', 'ip_ranges': '10.0.0.0/99'}]},
+                {'criteria': [{'name': 'a', 'countries': 'USA'}]},
+                {'criteria': [{'name': 'a', 'languages': 'not a tag'}]},
+                {'criteria': [{'name': 'a', 'device_type': 99}]},
+                {'criteria': [{'name': 'not a slug'}]},
+                {'flags': [{'name': 'a', 'start': '2013-02-01T00:00:00',
+                            'end': '2013-01-01T00:00:00'}]},
+                {'flags': [{'name': 'a', 'flags': ['test_flag']}]},
+                {'criteria': [{'name': 'a', 'expression': 'staff and'}]},
+                {'criteria': [{'name': 'a', 'expression': 'criteria:b'}]},
+                {'criteria': [{'name': 'a', 'expression': 'criteria:b'},
+                              {'name': 'b', 'expression': 'criteria:a'}]},
+                {'criteria': [{'name': 'a', 'users': ['nobody']}]},
+                {'criteria': [{'name': 'a', 'flags': ['nothing']}]},
+                {'flags': [{'name': 'a', 'conflicts': ['nothing']}]}]:
+            rules = dict(self.rules, **change)
+            self.assertRaises(ValueError, import_rules, rules)
+        self.assertListEqual(
+            sorted(Flag.objects.values_list('name', flat=True)),
+            ['old_flag', 'test_flag'])
+        self.assertListEqual(
+            list(Criteria.objects.values_list('name', flat=True)),
+            ['test_crit'])
+
+    def test_published_once(self):
+        self.rules['flags'][0]['priority'] = 5
+        self.rules['criteria'] = [
+            {'name': 'crit_%d' % i, 'flags': ['test_flag']}
+            for i in range(50)]
+        utils.flush_invalidations()
+        mock = mox.Mox()
+        mock.StubOutWithMock(utils, 'publish')
+        utils.publish()
+
+        mock.ReplayAll()
+        import_rules(self.rules, delete=True)
+        utils.flush_invalidations()
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+
+class TransferAdminTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        self.crit = Criteria.objects.create(name='test_crit')
+        self.crit.flags.add(Flag.objects.create(name='test_flag'))
+
+    def test_export_action(self):
+        response = self.client.post('/admin/affect/criteria/', {
+            'action': 'export_selected',
+            '_selected_action': [self.crit.pk]})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        rules = loads(response.content)
+        self.assertListEqual(
+            [row['name'] for row in rules['criteria']], ['test_crit'])
+        self.assertListEqual(
+            [row['name'] for row in rules['flags']], ['test_flag'])
+
+    def test_import(self):
+        rules = export_rules()
+        rules['criteria'][0]['name'] = 'new_crit'
+        upload = SimpleUploadedFile('rules.json', dumps(rules))
+        response = self.client.post('/admin/affect/criteria/import/', {
+            'file': upload, 'dry_run': 'on'})
+        self.assertContains(response, '+ criteria new_crit')
+        self.assertContains(response, 'Dry run')
+        self.assertFalse(Criteria.objects.filter(name='new_crit').exists())
+
+        upload = SimpleUploadedFile('rules.json', dumps(rules))
+        response = self.client.post('/admin/affect/flag/import/', {
+            'file': upload, 'delete': 'on'})
+        self.assertContains(response, '- criteria test_crit')
+        self.assertListEqual(
+            list(Criteria.objects.values_list('name', flat=True)),
+            ['new_crit'])
+
+    def test_import_invalid(self):
+        upload = SimpleUploadedFile('rules.json', '{"version": 2}')
+        response = self.client.post('/admin/affect/criteria/import/', {
+            'file': upload}, follow=True)
+        self.assertContains(response, 'Could not import')
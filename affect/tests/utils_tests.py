@@ -1,14 +1,21 @@
 from django.contrib.auth.models import AnonymousUser, User, Group
 from django.core.cache import cache
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
 from django.test.client import RequestFactory
 import mox
 
 from affect import utils
-from affect.models import Criteria, Flag
+from affect.matching import (
+    HostIndex, LanguageIndex, PathIndex, QueryIndex)
+from affect.middleware import AffectMiddleware
+from affect.models import CompiledRules, Criteria, Flag
+from affect.networks import RangeIndex
+from affect.rules import store_compiled
 from affect.utils import (
-    cache_criteria, detect_device, flag_is_affected, meets_criteria, random,
-    set_persist_criteria, uncache_criteria, uncache_flag)
+    cache_criteria, detect_device, flag_is_affected, flags_affected,
+    meets_criteria, random, set_persist_criteria, uncache_criteria,
+    uncache_flag)
 
 
 class CacheCriteriaTest(TestCase):
@@ -124,6 +131,22 @@ class FlagAffectedTest(TestCase):
         request = RequestFactory().get('')
         self.assertIs(flag_is_affected(request, 'test_flag'), False)
 
+    def test_bulk(self):
+        request = RequestFactory().get('')
+        request.affected_flags = frozenset(['test_flag'])
+        request.affected_checked = set()
+        self.assertDictEqual(
+            flags_affected(request, 'test_flag', 'other_flag'),
+            {'test_flag': True, 'other_flag': False})
+        self.assertSetEqual(
+            request.affected_checked, set(['test_flag', 'other_flag']))
+
+    def test_bulk_affected_flags_missing(self):
+        request = RequestFactory().get('')
+        self.assertDictEqual(
+            flags_affected(request, 'test_flag'), {'test_flag': False})
+        self.assertDictEqual(flags_affected(request), {})
+
 
 class MeetsCriteriaTest(TestCase):
     def setUp(self):
@@ -174,6 +197,14 @@ class MeetsCriteriaTest(TestCase):
         self.assertIs(
             meets_criteria(self.request, 'test_crit'), True)
 
+    def test_outside_schedule(self):
+        self.crit.everyone = True
+        self.crit.end = self.crit.created
+        self.crit.save()
+
+        self.assertIs(
+            meets_criteria(self.request, 'test_crit'), False)
+
     def test_off_for_everyone(self):
         self.crit.everyone = False
         self.crit.save()
@@ -387,6 +418,16 @@ class MeetsCriteriaTest(TestCase):
         self.assertIs(
             meets_criteria(self.request, 'test_crit'), True)
 
+    def test_entry_url_prefix(self):
+        self.crit.entry_url = '/other.html,/blog/*'
+        self.crit.save()
+        self.request.path = '/blog/post.html'
+        self.request.META['HTTP_REFERER'] = 'http://example.com/blah'
+        self.request.META['HTTP_HOST'] = 'testserver.com'
+
+        self.assertIs(
+            meets_criteria(self.request, 'test_crit'), True)
+
     def test_entry_url_nonentry_domain(self):
         with self.settings(AFFECTED_NONENTRY_DOMAINS=['example.com']):
             self.crit.entry_url = '/test.html'
@@ -406,6 +447,27 @@ class MeetsCriteriaTest(TestCase):
         self.assertIs(
             meets_criteria(self.request, 'test_crit'), True)
 
+    def test_referrer_compiled_once(self):
+        self.crit.referrer = 'example.com'
+        self.crit.save()
+        self.request.META['HTTP_REFERER'] = 'http://example.com/blah'
+        meets_criteria(self.request, 'test_crit')
+        index = utils._matchers.get(('referrer', 'example.com'))
+        self.assertIsInstance(index, HostIndex)
+
+        self.assertIs(
+            meets_criteria(self.request, 'test_crit'), True)
+        self.assertIs(
+            utils._matchers.get(('referrer', 'example.com')), index)
+
+    def test_referrer_subdomain(self):
+        self.crit.referrer = '*.example.com'
+        self.crit.save()
+        self.request.META['HTTP_REFERER'] = 'http://www.example.com/blah'
+
+        self.assertIs(
+            meets_criteria(self.request, 'test_crit'), True)
+
     def test_query_args_exact_match(self):
         self.crit.query_args = {'foo': 'bar'}
         self.crit.save()
@@ -415,6 +477,24 @@ class MeetsCriteriaTest(TestCase):
         self.assertIs(
             meets_criteria(request, 'test_crit'), True)
 
+    def test_query_args_compiled_once(self):
+        self.crit.query_args = {'foo': 'bar'}
+        self.crit.entry_url = '/other.html'
+        self.crit.save()
+        self.request.GET = {'foo': 'bar'}
+        meets_criteria(self.request, 'test_crit')
+        urls = utils._matchers.get(('entry_url', '/other.html'))
+        queries = utils._matchers.get(('query_args', (('foo', 'bar'),)))
+        self.assertIsInstance(urls, PathIndex)
+        self.assertIsInstance(queries, QueryIndex)
+
+        self.assertIs(
+            meets_criteria(self.request, 'test_crit'), True)
+        self.assertIs(
+            utils._matchers.get(('entry_url', '/other.html')), urls)
+        self.assertIs(
+            utils._matchers.get(('query_args', (('foo', 'bar'),))), queries)
+
     def test_query_args_exact_no_match(self):
         self.crit.query_args = {'foo': 'bar'}
         self.crit.save()
@@ -451,6 +531,82 @@ class MeetsCriteriaTest(TestCase):
         self.assertIs(
             meets_criteria(request, 'test_crit'), False)
 
+    def test_query_args_patterns(self):
+        self.crit.query_args = {'utm_*': 'spring-*'}
+        self.crit.save()
+        request = RequestFactory().get('', {'utm_source': 'spring-mail'})
+        request.user = AnonymousUser()
+
+        self.assertIs(
+            meets_criteria(request, 'test_crit'), True)
+
+    def test_ip_ranges(self):
+        self.crit.ip_ranges = '192.0.2.0/24,2001:db8::/32'
+        self.crit.save()
+        request = RequestFactory().get('', REMOTE_ADDR='192.0.2.9')
+        request.user = AnonymousUser()
+        self.assertIs(meets_criteria(request, 'test_crit'), True)
+
+        request.META['REMOTE_ADDR'] = '198.51.100.1'
+        self.assertIs(meets_criteria(request, 'test_crit'), False)
+
+        request.META['HTTP_X_FORWARDED_FOR'] = '192.0.2.9'
+        self.assertIs(meets_criteria(request, 'test_crit'), False)
+        with self.settings(AFFECTED_TRUSTED_PROXIES=['198.51.100.0/24']):
+            self.assertIs(meets_criteria(request, 'test_crit'), True)
+        self.assertIsInstance(utils._matchers.get(
+            ('ip_ranges', '192.0.2.0/24,2001:db8::/32')), RangeIndex)
+
+    def test_countries(self):
+        self.crit.countries = 'gb, ie'
+        self.crit.save()
+        request = RequestFactory().get('', REMOTE_ADDR='192.0.2.9')
+        request.user = AnonymousUser()
+        geo = self.mock.CreateMockAnything()
+        self.mock.StubOutWithMock(utils, 'get_geo_database')
+        utils.get_geo_database().AndReturn(geo)
+        geo.country('192.0.2.9').AndReturn('IE')
+        utils.get_geo_database().AndReturn(geo)
+        geo.country('192.0.2.9').AndReturn('US')
+
+        self.mock.ReplayAll()
+        self.assertIs(meets_criteria(request, 'test_crit'), True)
+        self.assertIs(meets_criteria(request, 'test_crit'), False)
+        self.mock.VerifyAll()
+        self.assertEqual(utils._matchers.get(('countries', 'gb, ie')),
+                         frozenset(['GB', 'IE']))
+
+    def test_languages(self):
+        self.crit.languages = 'fr, pt-BR'
+        self.crit.save()
+        request = RequestFactory().get(
+            '', HTTP_ACCEPT_LANGUAGE='fr-CA, en;q=0.8')
+        request.user = AnonymousUser()
+        self.assertIs(meets_criteria(request, 'test_crit'), True)
+
+        request.META['HTTP_ACCEPT_LANGUAGE'] = 'pt, en'
+        self.assertIs(meets_criteria(request, 'test_crit'), False)
+        self.assertIsInstance(
+            utils._matchers.get(('languages', 'fr, pt-BR')), LanguageIndex)
+
+    def test_expression_as_middleware(self):
+        self.crit.expression = 'staff and not criteria:other'
+        self.crit.superusers = False
+        self.crit.save()
+        self.crit.flags.add(Flag.objects.create(name='test_flag'))
+        Criteria.objects.create(name='other', expression='superuser')
+        staff = User.objects.create(username='staff', is_staff=True)
+        superuser = User.objects.create(
+            username='super', is_staff=True, is_superuser=True)
+        for user, active in [(self.request.user, False), (staff, True),
+                             (superuser, False)]:
+            request = RequestFactory().get('')
+            request.user = user
+            AffectMiddleware().process_request(request)
+            self.assertIs(
+                flag_is_affected(request, 'test_flag'), active)
+            self.assertIs(meets_criteria(request, 'test_crit'), active)
+
     def test_device_type_active(self):
         self.crit.device_type = Criteria.MOBILE_DEVICE
         self.crit.save()
@@ -479,37 +635,124 @@ class SetPersistCriteriaTest(TestCase):
 
 
 class UncacheCriteriaTest(TestCase):
+    def setUp(self):
+        self.criteria = Criteria.objects.create(name='test_crit')
+        utils.flush_invalidations()
+        self.mock = mox.Mox()
+
+    def tearDown(self):
+        self.mock.UnsetStubs()
+
     def test_uncache(self):
-        criteria = Criteria.objects.create(name='test_crit')
-        mock = mox.Mox()
-        mock.StubOutWithMock(cache, 'set_many')
+        self.mock.StubOutWithMock(cache, 'set_many')
         cache.set_many({
             'criteria:test_crit:users': None,
             'criteria:test_crit:flags': None,
-            'criteria:all': None,
             'criteria:test_crit': None,
             'criteria:test_crit:groups': None}, 5)
 
+        self.mock.ReplayAll()
+        uncache_criteria(instance=self.criteria)
+        utils.flush_invalidations()
+        self.mock.VerifyAll()
+
+    def test_applied_once(self):
+        self.mock.StubOutWithMock(cache, 'set_many')
+        self.mock.StubOutWithMock(utils, 'publish')
+        cache.set_many(mox.Func(lambda keys: len(keys) == 8), 5)
+        utils.publish()
+
+        self.mock.ReplayAll()
+        other = Criteria.objects.create(name='other_crit')
+        self.criteria.flags.add(Flag.objects.create(name='test_flag'))
+        self.criteria.users.add(User.objects.create(username='test_user'))
+        other.save()
+        self.assertIs(utils.in_transaction(), True)
+        utils.flush_invalidations()
+        utils.flush_invalidations()
+        self.mock.VerifyAll()
+
+    def test_applied_on_request_finished(self):
+        self.mock.StubOutWithMock(utils, 'publish')
+        utils.publish()
+
+        self.mock.ReplayAll()
+        self.criteria.save()
+        self.client.get('/')
+        self.mock.VerifyAll()
+
+    def test_applied_without_transaction(self):
+        self.mock.StubOutWithMock(utils, 'in_transaction')
+        self.mock.StubOutWithMock(utils, 'publish')
+        utils.in_transaction().MultipleTimes().AndReturn(False)
+        utils.publish()
+        utils.publish()
+
+        self.mock.ReplayAll()
+        self.criteria.save()
+        with utils.coalesced():
+            self.criteria.save()
+            with utils.coalesced():
+                self.criteria.save()
+            self.criteria.save()
+        self.mock.VerifyAll()
+
+
+class FlushOnCommitTest(TransactionTestCase):
+    def test_applied_on_commit(self):
+        mock = mox.Mox()
+        mock.StubOutWithMock(utils, 'publish')
+        utils.publish()
+
+        mock.ReplayAll()
+        with transaction.atomic():
+            Criteria.objects.create(name='test_crit')
+            Criteria.objects.create(name='other_crit')
+            self.assertIs(utils._pending().dirty, True)
+        self.assertIs(utils._pending().dirty, False)
+        mock.VerifyAll()
+        mock.UnsetStubs()
+
+    def test_no_queries_on_commit(self):
+        store_compiled('v1')
+        with self.settings(AFFECTED_COMPILED_RULES=True):
+            with transaction.atomic():
+                Criteria.objects.create(name='test_crit')
+        self.assertIs(utils._pending().dirty, False)
+        self.assertIs(connection.get_autocommit(), True)
+        self.assertEqual(CompiledRules.objects.get().version, 'v1')
+
+    def test_coalesced_until_block_ends(self):
+        mock = mox.Mox()
+        mock.StubOutWithMock(utils, 'publish')
+        utils.publish()
+
         mock.ReplayAll()
-        uncache_criteria(instance=criteria)
+        with utils.coalesced():
+            with transaction.atomic():
+                Criteria.objects.create(name='test_crit')
+            with transaction.atomic():
+                Criteria.objects.create(name='other_crit')
+            self.assertIs(utils._pending().dirty, True)
         mock.VerifyAll()
         mock.UnsetStubs()
 
 
 class UncacheFlagTest(TestCase):
     def test_uncache(self):
-        criteria = Criteria.objects.create(name='test_crit')
         flag = Flag.objects.create(name='test_flag')
+        for i in range(50):
+            Criteria.objects.create(name='crit_%d' % i).flags.add(flag)
         conflict = Flag.objects.create(name='nega-test_flag')
         flag.conflicts.add(conflict)
-        criteria.flags.add(flag, conflict)
+        utils.flush_invalidations()
         mock = mox.Mox()
-        mock.StubOutWithMock(cache, 'set')
-        cache.set('flag_conflicts:test_flag', None, 5)
-        mock.StubOutWithMock(utils, 'uncache_criteria')
-        utils.uncache_criteria(instance=criteria)
+        mock.StubOutWithMock(cache, 'set_many')
+        cache.set_many(mox.Func(lambda keys: len(keys) == 200), 5)
 
         mock.ReplayAll()
-        uncache_flag(instance=flag)
+        with self.assertNumQueries(1):
+            uncache_flag(instance=flag)
+        utils.flush_invalidations()
         mock.VerifyAll()
         mock.UnsetStubs()
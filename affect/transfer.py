@@ -0,0 +1,346 @@
+"""Export and import complete rule sets.
+
+A rule set is a dictionary of ``flags`` and ``criteria``, each a list of
+dictionaries of field values, with flags, conflicts, users and groups
+referred to by name, so rule sets can be moved between databases and kept
+in version control as JSON or YAML.
+
+Importing compares the rule set with the database and applies only the
+differences, with bulk queries in one transaction and without saving each
+row, so the change is published once and every worker rebuilds its rules
+once however many rows changed.
+"""
+from collections import namedtuple
+from decimal import Decimal
+import json
+
+from django.contrib.auth.models import Group, User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+try:
+    from django.utils import timezone as datetime
+except ImportError:
+    from datetime import datetime
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from .expressions import ExpressionError, find_cycle, parse, references
+from .models import Criteria, Flag
+from .utils import coalesced, forget_on_error, invalidate
+
+FORMAT_VERSION = 1
+FORMATS = ('json', 'yaml')
+SKIPPED_FIELDS = ('id', 'created', 'modified')
+RELATED_FIELDS = {Flag: ('conflicts',),
+                  Criteria: ('flags', 'users', 'groups')}
+
+ImportResult = namedtuple('ImportResult', ('created', 'updated', 'deleted'))
+
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
+def _fields(model):
+    return [field for field in model._meta.fields
+            if field.name not in SKIPPED_FIELDS]
+
+
+def _dump(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _row(obj):
+    return dict((field.name, _dump(getattr(obj, field.name)))
+                for field in _fields(type(obj)))
+
+
+def export_rules(criteria=None, flags=None):
+    """Return the rule set of ``criteria`` and ``flags``, by default all of
+    them.  When only ``criteria`` are given, the flags they activate are
+    exported with them."""
+    if criteria is None and flags is None:
+        criteria, flags = Criteria.objects.all(), Flag.objects.all()
+    criteria = list(criteria if criteria is not None else [])
+    if flags is None:
+        flags = Flag.objects.filter(criteria__in=criteria).distinct()
+    rules = {'version': FORMAT_VERSION, 'flags': [], 'criteria': []}
+    for flag in sorted(flags, key=lambda f: f.name):
+        row = _row(flag)
+        row['conflicts'] = sorted(c.name for c in flag.conflicts.all())
+        rules['flags'].append(row)
+    for crit in sorted(criteria, key=lambda c: c.name):
+        row = _row(crit)
+        row['flags'] = sorted(f.name for f in crit.flags.all())
+        row['users'] = sorted(u.username for u in crit.users.all())
+        row['groups'] = sorted(g.name for g in crit.groups.all())
+        rules['criteria'].append(row)
+    return rules
+
+
+def dumps(rules, format='json'):
+    """Serialize a rule set as JSON or YAML, which requires PyYAML."""
+    if format == 'yaml':
+        if yaml is None:
+            raise ValueError('YAML rule sets require PyYAML.')
+        return yaml.safe_dump(rules, default_flow_style=False)
+    return json.dumps(rules, indent=2, sort_keys=True)
+
+
+def loads(data, format='json'):
+    """Parse a JSON or YAML rule set."""
+    if format == 'yaml':
+        if yaml is None:
+            raise ValueError('YAML rule sets require PyYAML.')
+        return yaml.safe_load(data)
+    return json.loads(data)
+
+
+def _values(model, row):
+    """Convert a row to model field values, raising ``ValueError`` for
+    unknown or invalid fields.  Expressions are checked together by
+    :func:`_check_expressions`."""
+    fields = dict((field.name, field) for field in _fields(model))
+    unknown = set(row) - set(fields) - set(SKIPPED_FIELDS) - set(
+        RELATED_FIELDS[model])
+    if unknown:
+        raise ValueError('Unknown fields for %s %s: %s' % (
+            model._meta.verbose_name, row.get('name'),
+            ', '.join(sorted(unknown))))
+    values = {}
+    for name, field in fields.items():
+        value = row.get(name, field.get_default())
+        try:
+            values[name] = field.to_python(value)
+        except Exception as e:
+            raise ValueError('Invalid %s for %s %s: %s' % (
+                name, model._meta.verbose_name, row.get('name'), e))
+    obj = model(**values)
+    try:
+        obj.clean_fields(exclude=SKIPPED_FIELDS)
+        obj.clean_values()
+    except ValidationError as e:
+        raise ValueError('Invalid %s %s: %s' % (
+            model._meta.verbose_name, row.get('name'), ' '.join(e.messages)))
+    return values
+
+
+def _check(rules):
+    if not isinstance(rules, dict) or (
+            rules.get('version', FORMAT_VERSION) != FORMAT_VERSION):
+        raise ValueError('Not a version %d rule set.' % FORMAT_VERSION)
+    for key in ('flags', 'criteria'):
+        names = [row.get('name') for row in rules.get(key) or ()]
+        if not all(names):
+            raise ValueError('Every one of %s needs a name.' % key)
+        if len(set(names)) != len(names):
+            raise ValueError('Duplicate names in %s.' % key)
+
+
+def _check_expressions(expressions):
+    graph = {}
+    for name, expression in expressions.items():
+        graph[name] = set()
+        if expression:
+            try:
+                graph[name] = references(parse(expression))
+            except ExpressionError as e:
+                raise ValueError('Invalid expression for criteria %s: %s' % (
+                    name, e))
+    for name in sorted(graph):
+        unknown = graph[name] - set(graph)
+        if unknown:
+            raise ValueError('Unknown criteria in expression of %s: %s' % (
+                name, ', '.join(sorted(unknown))))
+        cycle = find_cycle(graph, name)
+        if cycle:
+            raise ValueError('Expression cycle: %s' % ' -> '.join(cycle))
+
+
+def _related(model, field, names):
+    found = dict(model.objects.filter(**{
+        '%s__in' % field: names}).values_list(field, 'pk'))
+    missing = set(names) - set(found)
+    if missing:
+        raise ValueError('Unknown %s: %s' % (
+            model._meta.verbose_name_plural, ', '.join(sorted(missing))))
+    return found
+
+
+def _sync(model, rows, delete):
+    """Create, update and delete rows of ``model`` to match ``rows``, a
+    dictionary of names to field values.  Returns the names created,
+    updated and deleted, and a dictionary of names to primary keys."""
+    existing = dict((obj.name, obj) for obj in model.objects.all())
+    now = datetime.now()
+    created, updated = [], []
+    for name, values in sorted(rows.items()):
+        obj = existing.get(name)
+        if obj is None:
+            created.append(model(modified=now, **values))
+        elif any(getattr(obj, field) != value
+                 for field, value in values.items()):
+            updated.append(name)
+            model.objects.filter(pk=obj.pk).update(modified=now, **values)
+    model.objects.bulk_create(created)
+    deleted = []
+    if delete:
+        deleted = sorted(set(existing) - set(rows))
+        model.objects.filter(name__in=deleted).delete()
+    ids = dict(model.objects.filter(name__in=list(rows)).values_list(
+        'name', 'pk'))
+    return [new.name for new in created], updated, deleted, ids
+
+
+def _sync_m2m(through, source, target, wanted):
+    """Make the ``(source id, target id)`` pairs of ``through`` for the
+    source ids in ``wanted``, a dictionary of source ids to sets of target
+    ids, equal to it.  Returns the source ids that changed."""
+    current = dict((source_id, set()) for source_id in wanted)
+    rows = {}
+    for pk, source_id, target_id in through.objects.filter(**{
+            '%s__in' % source: list(wanted)}).values_list(
+                'pk', source, target):
+        current[source_id].add(target_id)
+        rows[(source_id, target_id)] = pk
+    changed = set()
+    added, removed = [], []
+    for source_id, targets in wanted.items():
+        for target_id in targets - current[source_id]:
+            added.append(through(**{source: source_id, target: target_id}))
+            changed.add(source_id)
+        for target_id in current[source_id] - targets:
+            removed.append(rows[(source_id, target_id)])
+            changed.add(source_id)
+    through.objects.bulk_create(added)
+    if removed:
+        through.objects.filter(pk__in=removed).delete()
+    return changed
+
+
+def _sync_conflicts(conflicts):
+    """Make the conflicts of the flag ids in ``conflicts`` equal to it.
+    Conflicts are symmetrical, a pair is kept when either flag lists the
+    other.  Returns the ids of flags whose conflicts changed."""
+    through = Flag.conflicts.through
+    wanted = set()
+    for from_id, to_ids in conflicts.items():
+        for to_id in to_ids:
+            wanted.update([(from_id, to_id), (to_id, from_id)])
+    current = dict(
+        ((from_id, to_id), pk) for pk, from_id, to_id in
+        through.objects.filter(
+            Q(from_flag__in=list(conflicts)) |
+            Q(to_flag__in=list(conflicts))).values_list(
+                'pk', 'from_flag_id', 'to_flag_id'))
+    added = wanted - set(current)
+    removed = set(current) - wanted
+    through.objects.bulk_create(
+        [through(from_flag_id=from_id, to_flag_id=to_id)
+         for from_id, to_id in sorted(added)])
+    if removed:
+        through.objects.filter(
+            pk__in=[current[pair] for pair in removed]).delete()
+    return set(pk for pair in added | removed for pk in pair)
+
+
+def import_rules(rules, delete=False, dry_run=False):
+    """Make the database match ``rules``, returning an
+    :class:`ImportResult` of sorted ``(kind, name)`` pairs.
+
+    Flags, criteria and their relations missing from ``rules`` are kept,
+    unless ``delete`` is true.  With ``dry_run`` the changes are worked out
+    and rolled back.  Raises ``ValueError`` for invalid rule sets, leaving
+    the database unchanged.
+    """
+    _check(rules)
+    flags = dict((row['name'], _values(Flag, row))
+                 for row in rules.get('flags') or ())
+    criteria = dict((row['name'], _values(Criteria, row))
+                    for row in rules.get('criteria') or ())
+    expressions = dict((name, values['expression'])
+                       for name, values in criteria.items())
+    if not delete:
+        for name, expression in Criteria.objects.exclude(
+                name__in=list(criteria)).values_list('name', 'expression'):
+            expressions[name] = expression
+    _check_expressions(expressions)
+    users = _related(User, 'username', set(
+        name for row in rules.get('criteria') or ()
+        for name in row.get('users') or ()))
+    groups = _related(Group, 'name', set(
+        name for row in rules.get('criteria') or ()
+        for name in row.get('groups') or ()))
+
+    with coalesced():
+        try:
+            with forget_on_error():
+                with atomic():
+                    result = _apply(
+                        rules, flags, criteria, users, groups, delete)
+                    if dry_run:
+                        raise _DryRun(result)
+        except _DryRun as e:
+            return e.args[0]
+        if result.created or result.updated or result.deleted:
+            invalidate([name for kind, name in
+                        result.created + result.updated + result.deleted
+                        if kind == 'criteria'])
+    return result
+
+
+class _DryRun(Exception):
+    pass
+
+
+def _apply(rules, flags, criteria, users, groups, delete):
+    flags_created, flags_updated, flags_deleted, flag_ids = _sync(
+        Flag, flags, delete)
+    known_flags = dict(Flag.objects.values_list('name', 'pk'))
+
+    def flag_ids_of(names, owner):
+        missing = set(names) - set(known_flags)
+        if missing:
+            raise ValueError('Unknown flags for %s: %s' % (
+                owner, ', '.join(sorted(missing))))
+        return set(known_flags[name] for name in names)
+
+    conflicts = dict(
+        (flag_ids[row['name']],
+         flag_ids_of(row.get('conflicts') or (), row['name']))
+        for row in rules.get('flags') or ())
+    changed = _sync_conflicts(conflicts)
+    flags_updated = set(flags_updated) | set(
+        name for name, pk in known_flags.items() if pk in changed)
+
+    criteria_created, criteria_updated, criteria_deleted, criteria_ids = (
+        _sync(Criteria, criteria, delete))
+    changed = set()
+    for field, target, wanted in [
+            ('flags', 'flag_id', lambda row: flag_ids_of(
+                row.get('flags') or (), row['name'])),
+            ('users', 'user_id', lambda row: set(
+                users[name] for name in row.get('users') or ())),
+            ('groups', 'group_id', lambda row: set(
+                groups[name] for name in row.get('groups') or ()))]:
+        changed |= _sync_m2m(
+            getattr(Criteria, field).through, 'criteria_id', target,
+            dict((criteria_ids[row['name']], wanted(row))
+                 for row in rules.get('criteria') or ()))
+    criteria_updated = set(criteria_updated) | set(
+        name for name, pk in criteria_ids.items() if pk in changed)
+    criteria_updated -= set(criteria_created)
+    flags_updated -= set(flags_created)
+
+    return ImportResult(
+        sorted([('flag', n) for n in flags_created] +
+               [('criteria', n) for n in criteria_created]),
+        sorted([('flag', n) for n in flags_updated] +
+               [('criteria', n) for n in criteria_updated]),
+        sorted([('flag', n) for n in flags_deleted] +
+               [('criteria', n) for n in criteria_deleted]))
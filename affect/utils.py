@@ -1,29 +1,68 @@
+from contextlib import contextmanager
 from decimal import Decimal
 from urlparse import urlparse
 import random
+import threading
+import uuid
 
 from django.conf import settings
 from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models.signals import post_save, post_delete, m2m_changed
 
+from .broadcast import publish
+from .counters import count_criteria
+from .matching import (
+    HostIndex, LRUCache, LanguageIndex, PathIndex, QueryIndex, query_pairs)
 from .models import Criteria, Flag
+from .networks import RangeIndex, client_address, get_geo_database
 
 
-settings.AFFECTED_COOKIE = getattr(settings, 'AFFECTED_COOKIE', 'dac_%s')
-settings.AFFECTED_TESTING_COOKIE = getattr(
-    settings, 'AFFECTED_TESTING_COOKIE', 'dact_%s')
-settings.AFFECTED_NONENTRY_DOMAINS = getattr(
-    settings, 'AFFECTED_NONENTRY_DOMAINS', [])
-ALL_CRITERIA_KEY = 'criteria:all'
+RULES_VERSION_KEY = 'criteria:rules:version'
+RULES_VERSION_TIMEOUT = 30 * 24 * 3600
 CRITERIA_KEY = 'criteria:%s'
 CRITERIA_FLAGS_KEY = 'criteria:%s:flags'
 CRITERIA_USERS_KEY = 'criteria:%s:users'
 CRITERIA_GROUPS_KEY = 'criteria:%s:groups'
-FLAG_CONFLICTS_KEY = 'flag_conflicts:%s'
+
+
+def cookie_name(criteria_name):
+    """Name of the cookie keeping a persistent criteria decision."""
+    return getattr(settings, 'AFFECTED_COOKIE', 'dac_%s') % criteria_name
+
+
+def testing_cookie_name(criteria_name):
+    """Name of the querystring argument and cookie forcing a criteria."""
+    return getattr(
+        settings, 'AFFECTED_TESTING_COOKIE', 'dact_%s') % criteria_name
+
+
+def rules_version():
+    """Return the token of the current version of the rules, kept in the
+    cache and replaced whenever criteria or flags change.  A new token is
+    added when there is none, so every process rebuilds its rules once."""
+    version = cache.get(RULES_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(RULES_VERSION_KEY, version, RULES_VERSION_TIMEOUT)
+        version = cache.get(RULES_VERSION_KEY) or version
+    return version
+
+
+def nonentry_domains():
+    """Referring domains that are not entries to the site."""
+    return getattr(settings, 'AFFECTED_NONENTRY_DOMAINS', [])
 
 
 def detect_device(request):
-    user_agent = request.META.get('HTTP_USER_AGENT', '').lower()
+    return detect_user_agent(request.META.get('HTTP_USER_AGENT', ''),
+                             request.META.get('HTTP_ACCEPT', ''))
+
+
+def detect_user_agent(user_agent, accept=''):
+    """Classify a raw ``User-Agent``/``Accept`` header pair as a device."""
+    user_agent = user_agent.lower()
     if user_agent:
         if (
                 'ipod' in user_agent or
@@ -35,16 +74,39 @@ def detect_device(request):
             return Criteria.MOBILE_DEVICE
         elif (
                 'opera mini' in user_agent or
-                'application/vnd.wap.xhtml+xml' in request.META.get(
-                    'HTTP_ACCEPT', '')):
+                'application/vnd.wap.xhtml+xml' in accept):
             return Criteria.SIMPLE_DEVICE
     return Criteria.DESKTOP_DEVICE
 
 
 def flag_is_affected(request, flag_name):
-    if hasattr(request, 'affected_flags'):
-        return flag_name in request.affected_flags
-    return False
+    checked = getattr(request, 'affected_checked', None)
+    if checked is not None:
+        checked.add(flag_name)
+    return flag_name in getattr(request, 'affected_flags', ())
+
+
+def flags_affected(request, *flag_names):
+    """Check several flags at once, returning ``{flag_name: affected}``."""
+    checked = getattr(request, 'affected_checked', None)
+    if checked is not None:
+        checked.update(flag_names)
+    flags = getattr(request, 'affected_flags', ())
+    return dict((name, name in flags) for name in flag_names)
+
+
+_matchers = LRUCache(1000)
+
+
+def _matcher(kind, text, build):
+    """Return ``build(text)`` for the ``kind`` field of a criteria, kept
+    for the process, so each field value is compiled once."""
+    key = (kind, text)
+    matcher = _matchers.get(key)
+    if matcher is None:
+        matcher = build(text)
+        _matchers.set(key, matcher)
+    return matcher
 
 
 def meets_criteria(request, criteria_name):
@@ -56,71 +118,93 @@ def meets_criteria(request, criteria_name):
         except Criteria.DoesNotExist:
             return False
 
+    if not criteria.scheduled():
+        return False
+
     if criteria.everyone:
-        return True
+        return count_criteria(criteria, 'everyone')
     elif criteria.everyone is False:
         return False
 
     if criteria.testing:
-        tc = settings.AFFECTED_TESTING_COOKIE % criteria_name
+        tc = testing_cookie_name(criteria_name)
         if tc in request.GET:
             active = request.GET[tc] == '1'
             if not hasattr(request, 'affected_tests'):
                 request.affected_tests = {}
             request.affected_tests[criteria_name] = active
-            return active
+            return count_criteria(criteria, 'testing', active)
         if tc in request.COOKIES:
-            return request.COOKIES[tc] == 'True'
+            return count_criteria(
+                criteria, 'testing', request.COOKIES[tc] == 'True')
 
     if criteria.persistent:
-        criteria_cookie = request.COOKIES.get(
-            settings.AFFECTED_COOKIE % criteria.name, '')
+        criteria_cookie = request.COOKIES.get(cookie_name(criteria.name), '')
         if criteria_cookie:
-            return criteria_cookie == 'True'
+            return count_criteria(
+                criteria, 'persistent', criteria_cookie == 'True')
 
     user = request.user
 
     if criteria.authenticated and user.is_authenticated():
-        return True
+        return count_criteria(criteria, 'authenticated')
 
     if criteria.staff and user.is_staff:
-        return True
+        return count_criteria(criteria, 'staff')
 
     if criteria.superusers and user.is_superuser:
-        return True
+        return count_criteria(criteria, 'superusers')
 
     referrer = urlparse(request.META.get('HTTP_REFERER', '')).hostname
 
     if criteria.referrer:
-        criteria_referrers = criteria.referrer.split(',')
-        if referrer in criteria_referrers:
-            return True
+        referrers = _matcher('referrer', criteria.referrer, lambda text:
+                             HostIndex([(True, text.split(','))]))
+        if referrers.match(referrer):
+            return count_criteria(criteria, 'referrer')
 
     if criteria.entry_url:
         if (referrer != request.META.get('HTTP_HOST', '') and
-                not referrer in settings.AFFECTED_NONENTRY_DOMAINS):
-            urls = criteria.entry_url.split(',')
-            if request.path in urls:
-                return True
+                not referrer in nonentry_domains()):
+            urls = _matcher('entry_url', criteria.entry_url, lambda text:
+                            PathIndex([(True, text.split(','))]))
+            if urls.match(request.path):
+                return count_criteria(criteria, 'entry_url')
 
     if criteria.query_args:
-        for k, v in criteria.query_args.items():
-            req_arg = request.GET.get(k, '')
-            if req_arg:
-                if isinstance(v, list) and req_arg in v:
-                    return True
-                if v == req_arg or v == '*':
-                    return True
+        queries = _matcher('query_args', query_pairs(criteria.query_args),
+                           lambda pairs: QueryIndex([(True, pairs)]))
+        if queries.match(request.GET):
+            return count_criteria(criteria, 'query_args')
+
+    if criteria.ip_ranges or criteria.countries:
+        address = client_address(request.META)
+        if criteria.ip_ranges:
+            networks = _matcher('ip_ranges', criteria.ip_ranges, lambda text:
+                                RangeIndex([(True, text.split(','))]))
+            if networks.match(address):
+                return count_criteria(criteria, 'ip_ranges')
+        geo = get_geo_database() if criteria.countries else None
+        if geo is not None and geo.country(address) in _matcher(
+                'countries', criteria.countries, lambda text: frozenset(
+                    code.strip().upper() for code in text.split(','))):
+            return count_criteria(criteria, 'countries')
+
+    if criteria.languages:
+        languages = _matcher('languages', criteria.languages, lambda text:
+                             LanguageIndex([(True, text.split(','))]))
+        if languages.match(request.META.get('HTTP_ACCEPT_LANGUAGE', '')):
+            return count_criteria(criteria, 'languages')
 
     if criteria.device_type and criteria.device_type == detect_device(request):
-        return True
+        return count_criteria(criteria, 'device_type')
 
     criteria_users = cache.get(CRITERIA_USERS_KEY % criteria_name)
     if criteria_users is None:
         criteria_users = criteria.users.all()
         cache_criteria(instance=criteria)
     if user in criteria_users:
-        return True
+        return count_criteria(criteria, 'users')
 
     criteria_groups = cache.get(CRITERIA_GROUPS_KEY % criteria_name)
     if criteria_groups is None:
@@ -129,21 +213,37 @@ def meets_criteria(request, criteria_name):
     user_groups = user.groups.all()
     for group in criteria_groups:
         if group in user_groups:
-            return True
+            return count_criteria(criteria, 'groups')
+
+    if criteria.expression and _meets_expression(request, criteria_name):
+        return count_criteria(criteria, 'expression')
 
     if criteria.percent > 0:
-        cookie = settings.AFFECTED_COOKIE % criteria
+        cookie = cookie_name(criteria.name)
         if cookie in request.COOKIES:
             criteria_active = request.COOKIES[cookie] == 'True'
             set_persist_criteria(request, criteria_name, criteria_active)
-            return criteria_active
+            return count_criteria(criteria, 'percent', criteria_active)
         if Decimal(str(random.uniform(0, 100))) <= criteria.percent:
             set_persist_criteria(request, criteria_name, True)
-            return True
+            return count_criteria(criteria, 'percent')
         set_persist_criteria(request, criteria_name, False)
     return False
 
 
+def _meets_expression(request, criteria_name):
+    """Evaluate the expression of a criteria in the compiled graph of the
+    current rule set, as the middleware does."""
+    from .rules import RequestContext, get_rules
+    rules = get_rules()
+    record = rules.by_name.get(criteria_name)
+    if record not in rules.expressions:
+        return False
+    context = RequestContext.from_request(request)
+    return rules.value(
+        rules.expressions[record], context, rules.match(context))
+
+
 def set_persist_criteria(request, criteria_name, active=True):
     """Set a criteria value on a request object."""
     if not hasattr(request, 'affect_persist'):
@@ -161,14 +261,126 @@ def cache_criteria(**kwargs):
         cache.add(CRITERIA_GROUPS_KEY % criteria, criteria.groups.all())
 
 
+_invalidations = threading.local()
+
+
+def _pending():
+    if not hasattr(_invalidations, 'names'):
+        _invalidations.names = set()
+        _invalidations.dirty = False
+        _invalidations.depth = 0
+    return _invalidations
+
+
+def in_transaction(using=DEFAULT_DB_ALIAS):
+    """Return whether changes made now are in a transaction that has not
+    been committed yet."""
+    connection = connections[using]
+    if hasattr(connection, 'in_atomic_block'):
+        return connection.in_atomic_block
+    return transaction.is_managed(using=using)
+
+
+def _flush_on_commit(using=DEFAULT_DB_ALIAS):
+    """Make the thread's connection apply collected invalidations after
+    each commit outside of :func:`coalesced` blocks.  They are applied
+    before the connection is back in autocommit mode, so they must not
+    query the database."""
+    connection = connections[using]
+    if getattr(connection, 'affect_commit', None) is not None:
+        return
+    commit = connection.affect_commit = connection.commit
+
+    def flushing_commit(*args, **kwargs):
+        result = commit(*args, **kwargs)
+        if not _pending().depth:
+            flush_invalidations()
+        return result
+    connection.commit = flushing_commit
+
+
+def invalidate(criteria_names=()):
+    """Replace the rules version, uncache ``criteria_names`` and publish the
+    change.
+
+    Inside a transaction or a :func:`coalesced` block, invalidations are
+    collected for the thread and applied together by
+    :func:`flush_invalidations` when the transaction commits or the block or
+    request ends, so other processes never reload rules from the middle of
+    a transaction.
+    """
+    pending = _pending()
+    pending.names.update(criteria_names)
+    pending.dirty = True
+    if not pending.depth and not in_transaction():
+        flush_invalidations()
+    else:
+        _flush_on_commit()
+
+
+def flush_invalidations(**kwargs):
+    """Apply the thread's collected invalidations with one cache write for
+    the criteria keys, a new rules version and one broadcast.  The version
+    is written last, so processes rebuilding for it see every change.
+
+    Nothing is written to the database, since this runs from within the
+    commit of the transaction that made the changes.  Stored rule sets of
+    the old version are ignored once the version changes.
+    """
+    pending = _pending()
+    if not pending.dirty:
+        return
+    names, pending.names, pending.dirty = pending.names, set(), False
+    keys = {}
+    for name in names:
+        for key in (CRITERIA_KEY, CRITERIA_FLAGS_KEY, CRITERIA_USERS_KEY,
+                    CRITERIA_GROUPS_KEY):
+            keys[key % name] = None
+    if keys:
+        cache.set_many(keys, 5)
+    cache.set(RULES_VERSION_KEY, uuid.uuid4().hex, RULES_VERSION_TIMEOUT)
+    publish()
+
+request_finished.connect(
+    flush_invalidations, dispatch_uid='affect_flush_invalidations')
+
+
+@contextmanager
+def coalesced():
+    """Collect invalidations made in the block and apply them once at its
+    end, or once its transaction commits.  Wrap several transactions
+    outside of requests, such as in commands, with it::
+
+        with coalesced():
+            with transaction.atomic():
+                ...
+    """
+    pending = _pending()
+    pending.depth += 1
+    try:
+        yield
+    finally:
+        pending.depth -= 1
+        if not pending.depth and not in_transaction():
+            flush_invalidations()
+
+
+@contextmanager
+def forget_on_error():
+    """Forget the invalidations collected in the block when it raises, for
+    blocks whose transaction is then rolled back."""
+    pending = _pending()
+    names, dirty = set(pending.names), pending.dirty
+    try:
+        yield
+    except Exception:
+        pending.names, pending.dirty = names, dirty
+        raise
+
+
 def uncache_criteria(**kwargs):
     criteria = kwargs.get('instance')
-    cache.set_many({
-        CRITERIA_KEY % criteria.name: None,
-        CRITERIA_FLAGS_KEY % criteria.name: None,
-        CRITERIA_USERS_KEY % criteria.name: None,
-        CRITERIA_GROUPS_KEY % criteria.name: None,
-        ALL_CRITERIA_KEY: None}, 5)
+    invalidate([criteria.name])
 
 post_save.connect(uncache_criteria, sender=Criteria,
                   dispatch_uid='save_criteria')
@@ -184,10 +396,7 @@ m2m_changed.connect(uncache_criteria, sender=Criteria.flags.through,
 
 def uncache_flag(**kwargs):
     flag = kwargs.get('instance')
-    cache.set(FLAG_CONFLICTS_KEY % flag.name, None, 5)
-
-    for criteria in flag.criteria_set.all():
-        uncache_criteria(instance=criteria)
+    invalidate(flag.criteria_set.values_list('name', flat=True))
 
 post_save.connect(uncache_flag, sender=Flag, dispatch_uid='save_flag')
 post_delete.connect(uncache_flag, sender=Flag, dispatch_uid='delete_flag')
@@ -11,7 +11,9 @@ setup(
     url='https://github.com/ConsumerAffairs/django-affect',
     #license='',
     packages=[
-        'affect', 'affect.migrations'],
+        'affect', 'affect.management', 'affect.management.commands',
+        'affect.migrations', 'affect.templatetags'],
+    package_data={'affect': ['templates/admin/affect/*.html']},
     install_requires=[
         'Django>=1.4',
         'django-extensions'],